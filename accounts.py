@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# Runs the report over many AWS accounts at once. Accounts are named either
+# by a credentials profile or by the ARN of a role to assume from the
+# default credentials. Each account is analyzed in a worker process and the
+# results are merged into one report.
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+    as_completed
+import os
+import threading
+
+from helpers import *
+from report import TextWriter, merge_reports
+from throttle import RateLimiters, ThrottledClient, get_client_config
+
+ROLE_ARN_PREFIX = 'arn:aws:iam::'
+ROLE_SESSION_NAME = 'benjamin'
+MAX_POOL_CONNECTIONS = 25
+
+worker_pool = None
+
+
+def get_account_label(account):
+    if account.startswith(ROLE_ARN_PREFIX):
+        return account.split(':')[4]
+    return account
+
+
+class SessionPool(object):
+    # Keeps one boto3 session per account and one client per account and
+    # region, so repeated calls reuse the client's HTTP connection pool
+    # instead of opening new connections. Sessions for role ARNs are made
+    # from credentials returned by assume_role on the base session. EC2
+    # limits requests per account, so clients of an account share rate
+    # limiters.
+
+    def __init__(self, base_session=None,
+                 max_pool_connections=MAX_POOL_CONNECTIONS):
+        self.base_session = base_session
+        self.max_pool_connections = max_pool_connections
+        self.sessions = {}
+        self.clients = {}
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def get_session(self, account):
+        with self.lock:
+            session = self.sessions.get(account)
+            if session is None:
+                session = self.make_session(account)
+                self.sessions[account] = session
+            return session
+
+    def make_session(self, account):
+        import boto3
+        if account.startswith(ROLE_ARN_PREFIX):
+            base_session = self.base_session or boto3.session.Session()
+            credentials = base_session.client('sts').assume_role(
+                RoleArn=account,
+                RoleSessionName=ROLE_SESSION_NAME)['Credentials']
+            return boto3.session.Session(
+                aws_access_key_id=credentials['AccessKeyId'],
+                aws_secret_access_key=credentials['SecretAccessKey'],
+                aws_session_token=credentials['SessionToken'])
+        return boto3.session.Session(profile_name=account)
+
+    def get_client(self, account, region, service_name='ec2'):
+        key = (account, region, service_name)
+        client = self.clients.get(key)
+        if client is None:
+            session = self.get_session(account)
+            # Clients are thread safe once created but creating them is not,
+            # hence the lock.
+            with self.lock:
+                client = self.clients.get(key)
+                if client is None:
+                    client = ThrottledClient(session.client(
+                        service_name, region, config=get_client_config(
+                            max_pool_connections=self.max_pool_connections)),
+                        self.limiters.setdefault(account, RateLimiters()),
+                        region)
+                    self.clients[key] = client
+        return client
+
+    def account_session(self, account):
+        return AccountSession(self, account)
+
+
+class AccountSession(object):
+    # Looks like a boto3 session to go() and friends but hands out pooled
+    # clients for a single account.
+
+    def __init__(self, pool, account):
+        self.pool = pool
+        self.account = account
+
+    def client(self, service_name, region_name=None):
+        return self.pool.get_client(self.account, region_name or DEFAULT_REGION,
+                                    service_name)
+
+
+def init_worker():
+    global worker_pool
+    worker_pool = SessionPool()
+
+
+def analyze_account(account, regions=None, concurrency=None, use_cache=True):
+    # Runs in a worker process. Returns a list of (region, report) pairs.
+    # Reports hold the slotted records they were built from, which are cheap
+    # to pickle back to the parent.
+    from benjamin import collect_region, get_report
+    session = worker_pool.account_session(account)
+    if regions is None:
+        regions = [DEFAULT_REGION]
+    elif regions == 'all':
+        regions = get_enabled_regions(session.client('ec2', DEFAULT_REGION))
+
+    offering_cache = get_offering_cache() if use_cache else None
+
+    def analyze_region(region):
+        client = session.client('ec2', region)
+        account_type, reservations, instances, instance_class_counts, \
+            offerings_by_class = collect_region(client, offering_cache,
+                                                concurrency, use_cache)
+        return get_report(reservations, instances, instance_class_counts,
+                          client, account_type, offerings_by_class)
+
+    with ThreadPoolExecutor(max_workers=len(regions)) as pool:
+        return list(zip(regions, pool.map(analyze_region, regions)))
+
+
+def go_accounts(accounts, regions=None, processes=None, concurrency=None,
+                use_cache=True, writers=None):
+    # Report only; purchases are always made one account at a time.
+    # Flushed so forked workers do not inherit and repeat buffered output.
+    print('collecting ' + str(len(accounts)) + ' accounts...', flush=True)
+    results = {}
+    if processes is None:
+        processes = min(len(accounts), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=processes,
+                             initializer=init_worker) as executor:
+        futures = {}
+        for account in accounts:
+            future = executor.submit(analyze_account, account, regions,
+                                     concurrency, use_cache)
+            futures[future] = account
+        for future in as_completed(futures):
+            account = futures[future]
+            results[account] = future.result()
+            print('collected ' + get_account_label(account))
+
+    labelled_reports = []
+    for account in accounts:
+        for region, report in results[account]:
+            labels = OrderedDict([('account', get_account_label(account)),
+                                  ('region', region)])
+            labelled_reports.append((labels, report))
+    report = merge_reports(labelled_reports)
+    for writer in writers or [TextWriter()]:
+        writer.write(report)
+    return report
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from helpers import *
+from matching import ReservationMatcher
+
+DEFAULT_CONCURRENCY = 10
+
+
+def collect(client, concurrency=DEFAULT_CONCURRENCY, offering_cache=None,
+            persist_image_names=True):
+    return asyncio.run(collect_async(client, concurrency, offering_cache,
+                                     persist_image_names))
+
+
+async def collect_async(client, concurrency=DEFAULT_CONCURRENCY,
+                        offering_cache=None, persist_image_names=True):
+    # Runs the same calls as the serial path in go(), but overlaps them:
+    # account type, reservations and instance pages are fetched together, and
+    # each page is processed while the next one is fetched. Instances are
+    # matched to reservations as they arrive, and offerings for an instance
+    # class are requested as soon as an unreserved instance of that class
+    # shows up. Matching in instance order gives the same unreserved
+    # instances as matching the whole fleet at the end. boto3 is blocking,
+    # so calls run on a thread pool whose size is the concurrency limit.
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def run(fn, *args):
+        return loop.run_in_executor(executor, fn, *args)
+
+    try:
+        account_type_task = run(determine_account_type, client)
+        reservations_task = run(get_ris, client)
+
+        instances = []
+        instance_class_counts = {}
+        image_names = load_map(IMAGE_NAMES_FILE) if persist_image_names \
+            else {}
+        image_count = len(image_names)
+        offering_tasks = {}
+        matcher = None
+        pages = iter_instance_pages(client)
+        next_page = run(next, pages, None)
+        while True:
+            page = await next_page
+            if page is None:
+                break
+            next_page = run(next, pages, None)
+            account_type = await account_type_task
+            if matcher is None:
+                matcher = ReservationMatcher(await reservations_task)
+            page_instances = await run(get_running_instances, page,
+                                       account_type, client,
+                                       instance_class_counts, image_names)
+            instances += page_instances
+            unreserved = [instance for instance in page_instances
+                          if matcher.match(instance) is None]
+            for instance_class in get_reservable_classes(unreserved):
+                if instance_class not in offering_tasks:
+                    offering_tasks[instance_class] = run(
+                        get_class_offerings, [instance_class], client,
+                        account_type, offering_cache)
+
+        if persist_image_names and len(image_names) != image_count:
+            save_map(IMAGE_NAMES_FILE, image_names)
+
+        account_type = await account_type_task
+        reservations = await reservations_task
+        offerings_by_class = {}
+        for offerings in await asyncio.gather(*offering_tasks.values()):
+            offerings_by_class.update(offerings)
+    finally:
+        executor.shutdown(wait=False)
+
+    return account_type, reservations, instances, instance_class_counts, \
+        offerings_by_class
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+# Benchmarks the go() pipeline against a synthetic fleet served by an
+# in-process fake EC2 client, reporting per-phase time, API call counts and
+# peak memory. Usage: python benchmark.py [instance counts...]
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+import argparse
+import contextlib
+import io
+import random
+import time
+import tracemalloc
+
+import benjamin
+from helpers import *
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_FAMILIES = ['c4', 'm4', 'r3', 't2', 'c5', 'm5']
+DEFAULT_SIZES_IN_FAMILY = ['micro', 'small', 'medium', 'large', 'xlarge',
+                           '2xlarge', '4xlarge', '8xlarge']
+DEFAULT_ZONES = ['us-east-1a', 'us-east-1b', 'us-east-1c', 'us-east-1d']
+DEFAULT_PLATFORMS = OrderedDict([('Linux/UNIX', 0.85), ('Windows', 0.1),
+                                 ('Red Hat Enterprise Linux', 0.05)])
+TIMED_PHASES = [
+    (benjamin, 'determine_account_type'),
+    (benjamin, 'get_ris'),
+    (benjamin, 'get_instances'),
+    (benjamin, 'collect'),
+    (benjamin, 'get_class_offerings'),
+    (benjamin.ReservationMatcher, 'match'),
+    (benjamin, 'get_naive_reservation_changes'),
+    (benjamin, 'pack_reservations'),
+    (benjamin, 'analyze_offerings_by_class'),
+    (benjamin, 'get_suggested_reservations'),
+    (benjamin, 'make_recommendations'),
+]
+PAGE_SIZE = 1000
+PRICE_PER_UNIT = 100.0
+YEAR = int(HOURS_IN_YEAR * SECONDS_IN_HOUR)
+
+
+def generate_fleet(instance_count, families=DEFAULT_FAMILIES,
+                   sizes=DEFAULT_SIZES_IN_FAMILY, zones=DEFAULT_ZONES,
+                   platforms=DEFAULT_PLATFORMS, reservation_count=None,
+                   marketplace_offerings=5, image_count=200, seed=0):
+    rand = random.Random(seed)
+    if reservation_count is None:
+        reservation_count = max(1, instance_count // 20)
+    types = [family + '.' + size for family in families for size in sizes]
+    platform_names = list(platforms)
+    platform_weights = [platforms[name] for name in platform_names]
+
+    images = {}
+    for platform in platform_names:
+        for i in range(max(1, image_count // len(platform_names))):
+            image_id = 'ami-%08x' % len(images)
+            images[image_id] = platform + ' image ' + str(i)
+    images_by_platform = {}
+    for image_id, name in images.items():
+        images_by_platform.setdefault(name.split(' image ')[0], []).append(
+            image_id)
+
+    instances = []
+    for i in range(instance_count):
+        platform = rand.choices(platform_names, platform_weights)[0]
+        instance = {
+            'InstanceId': 'i-%08x' % i,
+            'InstanceType': rand.choice(types),
+            'Placement': {'AvailabilityZone': rand.choice(zones)},
+            'State': {'Name': 'running' if rand.random() < 0.95
+                      else 'stopped'},
+            'ImageId': rand.choice(images_by_platform[platform]),
+            'SecurityGroups': [{'GroupName': 'sg-' + str(rand.randint(0, 9))}],
+            'Tags': [{'Key': 'Name', 'Value': 'instance-' + str(i)}],
+            'LaunchTime': datetime(2016, 1, 1) +
+            timedelta(minutes=rand.randint(0, 60 * 24 * 365)),
+        }
+        if platform == 'Windows':
+            instance['Platform'] = 'Windows'
+        if rand.random() < 0.8:
+            instance['VpcId'] = 'vpc-' + str(rand.randint(0, 3))
+        instances.append(instance)
+
+    reservations = []
+    for i in range(reservation_count):
+        template = rand.choice(instances)
+        platform = template.get('Platform', 'Linux/UNIX')
+        reservations.append({
+            'ReservedInstancesId': 'ri-%08x' % i,
+            'InstanceType': template['InstanceType'],
+            'AvailabilityZone': rand.choice(zones),
+            'ProductDescription': platform,
+            'InstanceCount': rand.randint(1, 40),
+            'State': rand.choice(['active'] * 9 + ['retired']),
+        })
+
+    return {
+        'instances': instances,
+        'reservations': reservations,
+        'images': images,
+        'marketplace_offerings': marketplace_offerings,
+        'seed': seed,
+    }
+
+
+class FakeEC2Client(object):
+    # Serves the describe calls benjamin makes from a generated fleet and
+    # counts them by operation.
+
+    def __init__(self, fleet):
+        self.fleet = fleet
+        self.calls = Counter()
+
+    def describe_account_attributes(self, **kwargs):
+        self.calls['describe_account_attributes'] += 1
+        return {'AccountAttributes': [{
+            'AttributeName': 'supported-platforms',
+            'AttributeValues': [{'AttributeValue': 'VPC'}]}]}
+
+    def describe_regions(self, **kwargs):
+        self.calls['describe_regions'] += 1
+        return {'Regions': [{'RegionName': benjamin.DEFAULT_REGION}]}
+
+    def describe_reserved_instances(self, **kwargs):
+        self.calls['describe_reserved_instances'] += 1
+        return {'ReservedInstances': self.fleet['reservations']}
+
+    def describe_instances(self, MaxResults=PAGE_SIZE, NextToken=None,
+                           **kwargs):
+        self.calls['describe_instances'] += 1
+        instances = self.fleet['instances']
+        for instance_filter in kwargs.get('Filters', []):
+            instances = [instance for instance in instances
+                         if matches_filter(instance, instance_filter)]
+        start = int(NextToken or 0)
+        end = start + MaxResults
+        page = {'Reservations': [{'Instances': [instance]}
+                                 for instance in instances[start:end]]}
+        if end < len(instances):
+            page['NextToken'] = str(end)
+        return page
+
+    def describe_images(self, ImageIds=None, Filters=None, **kwargs):
+        self.calls['describe_images'] += 1
+        image_ids = list(ImageIds or [])
+        for image_filter in Filters or []:
+            if image_filter['Name'] == 'image-id':
+                image_ids += image_filter['Values']
+        images = self.fleet['images']
+        return {'Images': [{'ImageId': image_id, 'Name': images[image_id]}
+                           for image_id in image_ids if image_id in images]}
+
+    def describe_reserved_instances_offerings(self, InstanceType='m4.large',
+                                              AvailabilityZone='us-east-1a',
+                                              ProductDescription='Linux/UNIX',
+                                              **kwargs):
+        self.calls['describe_reserved_instances_offerings'] += 1
+        rand = random.Random(InstanceType + AvailabilityZone +
+                             ProductDescription + str(self.fleet['seed']))
+        units = RESERVATION_MAP.get(InstanceType.split('.')[1], 1)
+        price = units * PRICE_PER_UNIT
+        offerings = []
+        for years in (1, 3):
+            for offering_type, upfront, hourly in (
+                    ('All Upfront', 1.0, 0.0),
+                    ('Partial Upfront', 0.5, 0.6),
+                    ('No Upfront', 0.0, 1.2)):
+                offerings.append(self.offering(
+                    InstanceType, AvailabilityZone, ProductDescription,
+                    YEAR * years, offering_type, price * years * upfront,
+                    price * hourly / HOURS_IN_YEAR, False))
+        for i in range(self.fleet['marketplace_offerings']):
+            months = rand.randint(1, 35)
+            offerings.append(self.offering(
+                InstanceType, AvailabilityZone, ProductDescription,
+                YEAR * months // 12, 'Partial Upfront',
+                price * months / 24.0 * rand.uniform(0.05, 1.2),
+                price * 0.6 / HOURS_IN_YEAR, True))
+        return {'ReservedInstancesOfferings': offerings}
+
+    def offering(self, i_type, zone, platform, duration, offering_type,
+                 upfront, hourly, marketplace):
+        return {
+            'ReservedInstancesOfferingId': '%s-%s-%s-%s-%s-%s' % (
+                i_type, zone, platform, duration, offering_type, upfront),
+            'InstanceType': i_type,
+            'AvailabilityZone': zone,
+            'ProductDescription': platform,
+            'Duration': duration,
+            'FixedPrice': upfront,
+            'UsagePrice': 0.0,
+            'RecurringCharges': [{'Frequency': 'Hourly', 'Amount': hourly}],
+            'Marketplace': marketplace,
+            'OfferingType': offering_type,
+            'InstanceTenancy': 'default',
+            'CurrencyCode': 'USD',
+        }
+
+
+def matches_filter(instance, instance_filter):
+    name = instance_filter['Name']
+    if name == 'instance-state-name':
+        return instance['State']['Name'] in instance_filter['Values']
+    elif name == 'instance-id':
+        return instance['InstanceId'] in instance_filter['Values']
+    elif name == 'launch-time':
+        launch_time = instance['LaunchTime'].isoformat()
+        return any(launch_time.startswith(value.rstrip('*'))
+                   for value in instance_filter['Values'])
+    raise Exception('Unsupported filter ' + name)
+
+
+class FakeSession(object):
+    def __init__(self, client):
+        self.fake_client = client
+
+    def client(self, service_name, region_name=None, **kwargs):
+        return self.fake_client
+
+
+@contextlib.contextmanager
+def timed_phases(phase_times):
+    # Temporarily wraps the pipeline functions in TIMED_PHASES so each call
+    # adds its wall time to phase_times.
+    originals = []
+    for owner, name in TIMED_PHASES:
+        original = getattr(owner, name)
+        originals.append((owner, name, original))
+        setattr(owner, name, make_timed(name, original, phase_times))
+    try:
+        yield
+    finally:
+        for owner, name, original in originals:
+            setattr(owner, name, original)
+
+
+def make_timed(name, fn, phase_times):
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            phase_times[name] += time.perf_counter() - start
+    return timed
+
+
+def run(fleet, concurrency=None, measure_memory=True):
+    client = FakeEC2Client(fleet)
+    phase_times = Counter()
+    output = io.StringIO()
+    with timed_phases(phase_times), contextlib.redirect_stdout(output):
+        start = time.perf_counter()
+        benjamin.go(session=FakeSession(client), concurrency=concurrency,
+                    use_cache=False, unreserved_csv=None)
+        total = time.perf_counter() - start
+
+    peak_memory = None
+    if measure_memory:
+        tracemalloc.start()
+        with contextlib.redirect_stdout(io.StringIO()):
+            benjamin.go(session=FakeSession(FakeEC2Client(fleet)),
+                        concurrency=concurrency, use_cache=False,
+                        unreserved_csv=None)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        'total': total,
+        'phases': phase_times,
+        'calls': client.calls,
+        'peak_memory': peak_memory,
+        'output_lines': output.getvalue().count('\n'),
+    }
+
+
+def print_result(instance_count, result):
+    print('instances: ' + str(instance_count) + '  total: ' +
+          '%.3fs' % result['total'] + '  report lines: ' +
+          str(result['output_lines']))
+    if result['peak_memory'] is not None:
+        print('  peak memory: %.1f MB' % (result['peak_memory'] / 1e6))
+    print('  phases:')
+    for owner, name in TIMED_PHASES:
+        if name in result['phases']:
+            print('    %-32s %9.3fs' % (name, result['phases'][name]))
+    print('  api calls:')
+    for operation in sorted(result['calls']):
+        print('    %-40s %7d' % (operation, result['calls'][operation]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sizes', nargs='*', type=int, default=DEFAULT_SIZES)
+    parser.add_argument('--reservations', type=int, default=None)
+    parser.add_argument('--marketplace-offerings', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=None)
+    parser.add_argument('--no-memory', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        fleet = generate_fleet(size, reservation_count=args.reservations,
+                               marketplace_offerings=args.marketplace_offerings,
+                               seed=args.seed)
+        result = run(fleet, args.concurrency, not args.no_memory)
+        print_result(size, result)
+        print()
+
+
+if __name__ == '__main__':
+    main()
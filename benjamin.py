@@ -1,240 +1,317 @@
 # -*- coding: utf-8 -*-
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import cProfile
+from datetime import datetime
+import os
 
-import boto3
-import csv
-import json
-import pprint
-import locale
-locale.setlocale(locale.LC_ALL, 'en_US')
-
+from async_collect import collect
 from helpers import *
+from matching import ReservationMatcher, match_instances
+from metrics import MeteredClient, activate, get_metered_session
+from offering_analytics import analyze_offerings_by_class
+from packing import pack_reservations
+from report import TextWriter, UNRESERVED_CSV, build_report, merge_reports, \
+    write_unreserved_csv
+from snapshot import RecordingClient, ReplayClient
 
 # Account type matters only slightly for reserved instances in that
 # capacity is not guaranteed in your VPC if you have a classic RI that applies
 # and visa-versa.
 
 
-# TODO: Search for All-upfront amazing deals - like one cent, or one dollar and buy those.
+# TODO: Buy the all-upfront amazing deals deals.py finds - like one cent, or one dollar.
+
+ALL_REGIONS = 'all'
+PROFILE_DIR = os.path.join(os.path.expanduser('~'), '.benjamin', 'profiles')
+
+
+def go(dry_run=True, regions=None, max_workers=None, concurrency=None,
+       record=None, replay=None, session=None, use_cache=True, writers=None,
+       metrics=None, profile=None, unreserved_csv=UNRESERVED_CSV):
+    # metrics is a metrics.Metrics that phase times and EC2 calls of this run
+    # are added to. profile is a file to write cProfile stats of the run to,
+    # or True for a new file in PROFILE_DIR per run. unreserved_csv is where
+    # the unreserved instances are written, or None to skip the file.
+    profiler = None
+    if profile:
+        if profile is True:
+            profile = get_profile_filename()
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with activate(metrics), phase('go'):
+            return run(dry_run, regions, max_workers, concurrency, record,
+                       replay, session, use_cache, writers, metrics,
+                       unreserved_csv)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile)
+            print('profile written to ' + profile)
+
+
+def get_profile_filename():
+    if not os.path.isdir(PROFILE_DIR):
+        os.makedirs(PROFILE_DIR)
+    return os.path.join(PROFILE_DIR, 'go-' +
+                        datetime.utcnow().strftime('%Y%m%dT%H%M%S') + '-' +
+                        str(os.getpid()) + '.prof')
+
+
+def run(dry_run, regions, max_workers, concurrency, record, replay, session,
+        use_cache, writers, metrics, unreserved_csv=UNRESERVED_CSV):
+    # record names a snapshot file to capture every EC2 response into, replay
+    # runs the whole report from such a file without an EC2 client. Local
+    # caches are bypassed in both cases so the snapshot is self-contained.
+    # session is anything with boto3's client() method and defaults to the
+    # boto3 module itself.
+    session = get_session(session)
+    if metrics:
+        session = get_metered_session(session, metrics)
+    if replay:
+        client = ReplayClient(replay)
+        if metrics:
+            client = MeteredClient(client, metrics)
+        dry_run = True
+    else:
+        if regions is None:
+            regions = [DEFAULT_REGION]
+        elif regions == ALL_REGIONS:
+            regions = get_enabled_regions(session.client('ec2',
+                                                         DEFAULT_REGION))
+
+        if len(regions) > 1:
+            if record:
+                raise Exception('Snapshots can only record a single region')
+            return go_multi_region(regions, dry_run, max_workers, concurrency,
+                                   session, use_cache, writers,
+                                   unreserved_csv)
+
+        client = session.client('ec2', regions[0])
+        if record:
+            client = RecordingClient(client, record)
+
+    use_cache = use_cache and not (record or replay)
+    offering_cache = get_offering_cache() if use_cache else None
+    try:
+        if concurrency:
+            print('collecting with ' + str(concurrency) +
+                  ' concurrent calls...')
+            with phase('collect'):
+                account_type, reservations, instances, \
+                    instance_class_counts, offerings_by_class = collect(
+                        client, concurrency, offering_cache, use_cache)
+            print('getting recommendations...')
+            make_recommendations(reservations, instances,
+                                 instance_class_counts, client, account_type,
+                                 dry_run, offerings_by_class, writers=writers,
+                                 unreserved_csv=unreserved_csv)
+            return
+
+        print('determining account type...')
+        with phase('determine_account_type'):
+            account_type = determine_account_type(client)
+
+        print('getting my reserved instances...')
+        with phase('get_ris'):
+            reservations = get_ris(client)
+
+        print('getting running instances...')
+        with phase('get_instances'):
+            instances, instance_class_counts = get_instances(
+                account_type, client, use_cache)
+
+        print('getting recommendations...')
+        make_recommendations(reservations, instances, instance_class_counts,
+                             client, account_type, dry_run,
+                             offering_cache=offering_cache, writers=writers,
+                             unreserved_csv=unreserved_csv)
+    finally:
+        if record or replay:
+            client.close()
 
-def go(dry_run=True):
-    client = boto3.client('ec2', 'us-east-1')
-    ec2 = boto3.resource('ec2', 'us-east-1')
 
-    print('determining account type...')
-    account_type = determine_account_type(client)
+def go_multi_region(regions, dry_run=True, max_workers=None,
+                    concurrency=None, session=None, use_cache=True,
+                    writers=None, unreserved_csv=UNRESERVED_CSV):
+    # Clients are created up front as creating them from the default session
+    # is not thread safe. Each region is then collected in its own worker so
+    # the total time is close to that of the slowest region.
+    session = get_session(session)
+    clients = {}
+    for region in regions:
+        clients[region] = session.client('ec2', region)
 
-    print('getting my reserved instances...')
-    reservations = get_ris(client)
+    print('collecting ' + str(len(regions)) + ' regions...')
+    region_data = {}
+    offering_cache = get_offering_cache() if use_cache else None
+    with ThreadPoolExecutor(max_workers=max_workers or len(regions)) as pool:
+        futures = {}
+        for region in regions:
+            future = pool.submit(collect_region, clients[region],
+                                 offering_cache, concurrency, use_cache)
+            futures[future] = region
+        for future in as_completed(futures):
+            region = futures[future]
+            region_data[region] = future.result()
+            print('collected ' + region)
 
-    print('getting running instances...')
-    instances, instance_class_counts = get_instances(account_type, client, ec2)
+    # One report per region, written once as a single report labelled by
+    # region.
+    labelled_reports = []
+    clients_by_zone = {}
+    for region in regions:
+        client = clients[region]
+        account_type, reservations, instances, instance_class_counts, \
+            offerings_by_class = region_data[region]
+        report = get_report(reservations, instances, instance_class_counts,
+                            client, account_type, offerings_by_class)
+        report.labels['region'] = region
+        labelled_reports.append((report.labels, report))
+        for instance in instances:
+            clients_by_zone[instance.zone] = client
+    report = merge_reports(labelled_reports)
+    buy = None if dry_run else get_buy_prompt(None, clients_by_zone)
+    write_report(report, buy, writers, unreserved_csv)
+    return report
 
-    print('getting recommendations...')
-    make_recommendations(reservations, instances, instance_class_counts, client,
-                         ec2, account_type, dry_run)
+
+def collect_region(client, offering_cache=None, concurrency=None,
+                   persist_image_names=True):
+    with phase('collect_region'):
+        if concurrency:
+            return collect(client, concurrency, offering_cache,
+                           persist_image_names)
+        account_type = determine_account_type(client)
+        reservations = get_ris(client)
+        instances, instance_class_counts = get_instances(
+            account_type, client, persist_image_names)
+        matches, unreserved_instances = match_instances(reservations,
+                                                        instances)
+        offerings_by_class = get_class_offerings(
+            get_reservable_classes(unreserved_instances), client,
+            account_type, offering_cache)
+        return account_type, reservations, instances, \
+            instance_class_counts, offerings_by_class
 
 
 def make_recommendations(reservations, instances, instance_class_counts, client,
-                         ec2, account_type, dry_run):
-    unreserved_instances = list(instances)
-
-    print()
-    print('Instance class counts --------------------------------------------')
-    for klass in sorted(instance_class_counts, key=instance_class_counts.get,
-                        reverse=True):
-        print(str(instance_class_counts[klass]) + str(klass) + ' ')
-
-    print()
-    print('Utilized reserved instances --------------------------------------')
-    for instance in instances:
-        match = match_reservations(instance, instance_class_counts,
-                                   reservations, unreserved_instances)
-        if match:
-            reservation, rtype, rzone, rplatform, iid = match
-            print(str((rtype, rzone, rplatform)) +
-                  ' reservation is utilized by instance: ' + iid + ' ' +
-                  str(instance_name(instance)) + ' security-groups: ' +
-                  str(get_groups(instance)) + ' ' +
-                  instance.get('VpcId', 'non-vpc'))
-
-    print()
-    print('Unreserved instances ----------------------------------------------')
-    writer = csv.writer(open("unreserved_instances.csv", 'w'))
-    for instance in sorted(unreserved_instances,
-                           key=lambda x: x['InstanceType']):
-        groups = get_groups(instance)
-        unreserved_instances_out = [
-            instance['InstanceId'],
-            instance['InstanceType'],
-            instance['Placement']['AvailabilityZone'],
-            instance['bj_Platform'],
-            instance_name(instance),
-            'security-groups:' + str(groups),
-            instance.get('VpcId', 'non-vpc')
-        ]
-        print(*unreserved_instances_out)
-        writer.writerow(unreserved_instances_out)
-
-    print()
-    print('Unused reservations -----------------------------------------------')
-    unused_reservations = get_unused_reservations(reservations)
-    for reservation in unused_reservations:
-        r_type = reservation['InstanceType']
-        r_zone = reservation['AvailabilityZone']
-        r_platform = reservation['ProductDescription']
-        r_id = reservation['ReservedInstancesId']
-        diff = reservation['UnusedInstanceCount']
-        print(str((r_type, r_zone, r_platform, r_id)) + ' has ' + str(diff) +
-              ' unused instance(s)!')
-
-    print()
-    print('Naive recommended reservation changes -----------------------------')
-    az_only_different = []
-    family_and_zone_different = []
-    family_only_different = []
-    for reservation in unused_reservations:
-        for instance in unreserved_instances:
-            have_same_type = same_instance_type(instance, reservation)
-            have_same_platform = same_platform(instance, reservation)
-            have_same_az = same_availability_zone(instance, reservation)
-            have_same_family = same_family(instance, reservation)
-            r_id = reservation['ReservedInstancesId']
-            if have_same_type and have_same_platform and not have_same_az:
-                # Only zone is different
-                az_only_different.append(reservation)
-                print('Change reservation: ' + r_id + ' ZONE CHANGE ONLY -'
-                    ' to availability zone ' +
-                    instance['Placement']['AvailabilityZone'] +
-                    ' to utilize this reservation')
-                # TODO: Change zone, no-brainer, and remove unreserved instance
-            elif have_same_family and not have_same_type and have_same_platform and not have_same_az:
-                family_and_zone_different.append(reservation)
-                print('Change reservation: ' + r_id + ' to availability zone ' +
-                      instance['Placement']['AvailabilityZone'] + ' and instance type from ' +
-                      reservation['InstanceType'] + ' to ' +
-                      instance['InstanceType'] + ' to utilize this reservation')
-                check_reservation_sizing(instance, reservation)
-            elif have_same_family and have_same_platform and have_same_az:
-                # Just need to change type
-                family_only_different.append(reservation)
-                print('Change reservation: ' + r_id + ' instance type from ' +
-                      reservation['InstanceType'] + ' to ' +
-                      instance['InstanceType'] + ' to utilize this reservation')
-                check_reservation_sizing(instance, reservation)
-
-    print()
-    print('Recommended reservation changes ------------------------------------------')
-    type_changes = pack_reservations(unused_reservations, unreserved_instances)
-    for suggestion in type_changes:
-        print('Change reservation ' + suggestion['reservation']['ReservedInstancesId'])
-        print('  current instance type: ' + suggestion['reservation_type'])
-        print('  suggest instance type: ' + suggestion['instance_type'])
-        if suggestion['same_zone']:
-            print('  both already in same zone: ' + suggestion['instance_zone'])
-        else:
-            print('  plus change zone from: ' + suggestion['instance_zone'] +
-                  ' to ' + suggestion['reservation_zone'])
-        print('  new utilization: ' + str(suggestion['utilization']))
-        print('  instances: ')
-        for instance in suggestion['instances']:
-            print('    ' + str(instance_name(instance)) + ' security-groups: ' +
-                  str(get_groups(instance)) + ' ' +
-                  instance.get('VpcId', 'non-vpc'))
-
-    # TODO: See if we can split reservation into two different types
-
-    print()
-    print('Recommended reserved instances ------------------------------------')
-    suggested_reservations = get_suggested_reservations(unreserved_instances,
-                                                        client, account_type)
-
-    total_upfront = 0
-    total_savings = 0
-    max_years = -1000
-    for instance, offerings in suggested_reservations:
-        print('  \nFor instance-id: ' + instance['InstanceId'] + ' ' +
-              str(instance_name(instance)) + ' security-groups: ' +
-              str(get_groups(instance)) + ' ' + instance.get('VpcId', 'non-vpc'))
-        for i, offering in enumerate(offerings):
-            upfront = offering['FixedPrice']
-            savings = offering['Savings']
-            years = offering['Hours'] / HOURS_IN_YEAR
-            max_years = max(years, max_years)
-            total_upfront += upfront
-            total_savings += savings
-            print(str(i) + ') Recommended offering:')
-            print('  instance type:             ' + offering['InstanceType'])
-            if offering['Marketplace']:
-                print('  savings over standard:     ' + str(savings))
-                print('  comparable total cost:     ' + str(offering['ComparableTotalCost']))
-                print('  standard total cost:       ' + str(offering['StdTotalCost']))
-                print('  effective hourly:          ' + str(offering['EffectiveHourly']))
-                print('  standard effective hourly: ' + str(offering['StdEffectiveHourly']))
-                print('  comparable upfront:        ' + str(offering['ComparableUpfront']))
-            print('  3rd-party:                 ' + str(offering['Marketplace']))
-            print('  zone:                      ' + offering['AvailabilityZone'])
-            print('  effective hourly:          ' + str(offering['EffectiveHourly']))
-            print('  upfront:                   ' + str(upfront))
-            print('  total cost:                ' + str(offering['TotalCost']))
-            print('  years:                     ' + str(years))
-            print('  id:                        ' + offering['ReservedInstancesOfferingId'])
-            print('  platform                   ' + offering['ProductDescription'])
-            print('  type                       ' + offering['OfferingType'])
-            print('  amazing deal               ' + str(offering.get('AmazingDeal', False)))
-
-        if not dry_run:
-            print('What reservation do you want? Press enter to skip: ')
-            valid = False
-            while not valid:
-                choice = input()
-                if choice.isdigit() or choice == '':
-                    valid = True
-            if choice.isdigit():
-                #  Buy reservation
-                reservation = offerings[int(choice)]
-                reservation_id = reservation['ReservedInstancesOfferingId']
-                amount = reservation['FixedPrice']
-                count = 1
-                print('Are you sure you want to buy ' + reservation_id +
-                      ' for $' + str(amount) + '? (y/n) ')
-                confirm = input()
-                if confirm == 'y':
-                    try:
-                        purchase_reserved_instance(reservation_id, client, count, amount)
-                    except Exception as e:
-                        print('Problem reserving instance, exception below :\n'
-                              + str(e))
-                else:
-                    print('Skipping')
-            else:
-                print('Skipping')
+                         account_type, dry_run, offerings_by_class=None,
+                         offering_cache=None, writers=None,
+                         unreserved_csv=UNRESERVED_CSV):
+    # writers render the finished report, see report.WRITERS. The console
+    # report is the default. The unreserved instances are also written to
+    # unreserved_csv unless it is None.
+    report = get_report(reservations, instances, instance_class_counts,
+                        client, account_type, offerings_by_class,
+                        offering_cache)
+    region = get_client_region(client)
+    if region:
+        report.labels['region'] = region
+    buy = None if dry_run else get_buy_prompt(client)
+    write_report(report, buy, writers, unreserved_csv)
+    return report
 
-        # See what reservations are available, especially third-party, that you would need
-        # - Allow non-VPC instances to be reserved by VPC reservations?
-        # - Notify about EBS encryption ability of c3+, m3+, r3+
-        # - Notify about HVM / PV compatibility
-        # - Notify about cost effectiveness of later class c4/m4
-        # x Advise changing availibility zone
-        # - Advise changing between EC2-VPC and Classic
-        # x make sure you select the right type (Linux or Windows)
-        # x Check if you are in EC2 classic by seeing if any reserved instance has VPC in its name.
-        # x Add VPC to the RI type tuple - non-EC2 classic will all get vpc for that part of the tuple
-        # x check availability zone
-        # x check VPC only if you just want VPC
-        # x make sure instance is running
-
-        # Send email asking if you want to purchase the instance with the months left and months to break even.
-        # Allow sending email back with number of option you wish to buy
-    # TODO: Recommend instance reservations that can be changed, make sure you cancel current listings.
 
-    print()
-    print('Total upfront: ', locale.currency(total_upfront, grouping=True))
+def write_report(report, buy=None, writers=None,
+                 unreserved_csv=UNRESERVED_CSV):
+    with phase('write_report'):
+        if unreserved_csv:
+            write_unreserved_csv(report, unreserved_csv)
+        for writer in writers or [TextWriter()]:
+            writer.write(report,
+                         buy if isinstance(writer, TextWriter) else None)
+
+
+def get_report(reservations, instances, instance_class_counts, client,
+               account_type, offerings_by_class=None, offering_cache=None):
+    with phase('match_instances'):
+        matches, unreserved_instances = match_instances(reservations,
+                                                        instances)
+        unused_reservations = get_unused_reservations(reservations)
+    with phase('get_naive_reservation_changes'):
+        naive_changes = get_naive_reservation_changes(unused_reservations,
+                                                      unreserved_instances)
+    with phase('pack_reservations'):
+        type_changes = pack_reservations(unused_reservations,
+                                         unreserved_instances)
+
+    reservable_classes = get_reservable_classes(unreserved_instances)
+    if offerings_by_class is None:
+        with phase('get_class_offerings'):
+            offerings_by_class = get_class_offerings(
+                reservable_classes, client, account_type, offering_cache)
+    with phase('analyze_offerings'):
+        analyzed_by_class = analyze_offerings_by_class(OrderedDict(
+            (instance_class, offerings_by_class[instance_class])
+            for instance_class in reservable_classes))
+        suggested_reservations = get_suggested_reservations(
+            unreserved_instances, client, account_type,
+            analyzed_by_class=analyzed_by_class)
 
+    with phase('build_report'):
+        return build_report(instance_class_counts, matches,
+                            unreserved_instances, unused_reservations,
+                            naive_changes, type_changes,
+                            suggested_reservations)
 
-def get_groups(instance):
-    groups = [group['GroupName'] for group in instance['SecurityGroups']]
-    return groups
+    # See what reservations are available, especially third-party, that you would need
+    # - Allow non-VPC instances to be reserved by VPC reservations?
+    # - Notify about EBS encryption ability of c3+, m3+, r3+
+    # - Notify about HVM / PV compatibility
+    # - Notify about cost effectiveness of later class c4/m4
+    # x Advise changing availibility zone
+    # - Advise changing between EC2-VPC and Classic
+    # x make sure you select the right type (Linux or Windows)
+    # x Check if you are in EC2 classic by seeing if any reserved instance has VPC in its name.
+    # x Add VPC to the RI type tuple - non-EC2 classic will all get vpc for that part of the tuple
+    # x check availability zone
+    # x check VPC only if you just want VPC
+    # x make sure instance is running
+
+    # Send email asking if you want to purchase the instance with the months left and months to break even.
+    # Allow sending email back with number of option you wish to buy
+    # TODO: Recommend instance reservations that can be changed, make sure you cancel current listings.
+
+
+def get_buy_prompt(client, clients_by_zone=None):
+    # Called by the text writer after each suggested instance with the rows
+    # of its recommended offerings. To buy many at once, see plan.py.
+    # clients_by_zone picks the client of the offering's region when the
+    # report covers several regions.
+    def buy(rows):
+        print('What reservation do you want? Press enter to skip: ')
+        valid = False
+        while not valid:
+            choice = input()
+            if choice.isdigit() or choice == '':
+                valid = True
+        if choice.isdigit():
+            #  Buy reservation
+            row = rows[int(choice)]
+            region_client = clients_by_zone[row['zone']] \
+                if clients_by_zone else client
+            reservation_id = row['offering_id']
+            amount = row['upfront']
+            count = 1
+            print('Are you sure you want to buy ' + reservation_id +
+                  ' for $' + str(amount) + '? (y/n) ')
+            confirm = input()
+            if confirm == 'y':
+                try:
+                    purchase_reserved_instance(reservation_id, region_client,
+                                               count, amount)
+                except Exception as e:
+                    print('Problem reserving instance, exception below :\n'
+                          + str(e))
+            else:
+                print('Skipping')
+        else:
+            print('Skipping')
+    return buy
 
 
 if __name__ == '__main__':
-    go()
+    import cli
+    cli.main()
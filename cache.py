@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import threading
+import time
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.benjamin', 'cache')
+IMAGE_NAMES_FILE = os.path.join(CACHE_DIR, 'image_names.json')
+
+
+class DiskCache(object):
+    # A directory of JSON files, one per key. Entries older than ttl seconds
+    # are ignored and, once the directory grows past max_bytes, the least
+    # recently written entries are evicted.
+
+    def __init__(self, name, ttl, max_bytes, root=CACHE_DIR):
+        self.path = os.path.join(root, name)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.sizes = None
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def get(self, key):
+        filename = self.filename(key)
+        try:
+            if time.time() - os.path.getmtime(filename) > self.ttl:
+                return None
+            with open(filename) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def set(self, key, value):
+        filename = self.filename(key)
+        data = json.dumps(value, default=str)
+        tmp_filename = filename + '.' + str(os.getpid()) + '.' + \
+            str(threading.current_thread().ident)
+        with open(tmp_filename, 'w') as f:
+            f.write(data)
+        os.replace(tmp_filename, filename)
+        with self.lock:
+            self.scan()
+            self.sizes[filename] = len(data)
+            self.evict()
+
+    def filename(self, key):
+        digest = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest + '.json')
+
+    def scan(self):
+        if self.sizes is not None:
+            return
+        self.sizes = {}
+        for name in os.listdir(self.path):
+            if name.endswith('.json'):
+                filename = os.path.join(self.path, name)
+                self.sizes[filename] = os.path.getsize(filename)
+
+    def evict(self):
+        total = sum(self.sizes.values())
+        if total <= self.max_bytes:
+            return
+        by_age = sorted(self.sizes, key=lambda x: self.mtime(x))
+        for filename in by_age:
+            if total <= self.max_bytes:
+                break
+            total -= self.sizes.pop(filename)
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def mtime(self, filename):
+        try:
+            return os.path.getmtime(filename)
+        except OSError:
+            return 0
+
+
+def load_map(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_map(filename, values):
+    # Regions collected in threads save at the same time, so the temporary
+    # file is per thread as well as per process.
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp_filename = filename + '.' + str(os.getpid()) + '.' + \
+        str(threading.current_thread().ident)
+    with open(tmp_filename, 'w') as f:
+        json.dump(values, f)
+    os.replace(tmp_filename, filename)
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+# A local copy of the reserved instance offerings catalog in SQLite. sync
+# bulk-loads every offering of a region, one (product description,
+# marketplace) partition at a time, and only refetches partitions older than
+# their ttl, so marketplace listings can be refreshed hourly while Amazon's
+# own offerings are refreshed daily. Once a region is synced its offerings
+# are looked up in the index rather than fetched from EC2.
+# Usage: python catalog.py [regions...]
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from cache import CACHE_DIR
+from helpers import *
+
+CATALOG_FILE = os.path.join(CACHE_DIR, 'offerings.sqlite')
+CATALOG_PAGE_SIZE = 100
+CATALOG_CONCURRENCY = 8
+AMAZON_SYNC_TTL = 24 * SECONDS_IN_HOUR
+MARKETPLACE_SYNC_TTL = SECONDS_IN_HOUR
+# Lookups fall back to EC2 when a partition was last synced longer ago than
+# this, e.g. because the cron job stopped running.
+CATALOG_MAX_AGE = 2 * AMAZON_SYNC_TTL
+SCHEMA = [
+    'PRAGMA journal_mode=WAL',
+    '''CREATE TABLE IF NOT EXISTS offerings (
+        id TEXT NOT NULL,
+        region TEXT NOT NULL,
+        instance_type TEXT NOT NULL,
+        zone TEXT,
+        product_description TEXT NOT NULL,
+        duration INTEGER NOT NULL,
+        offering_type TEXT NOT NULL,
+        marketplace INTEGER NOT NULL,
+        data TEXT NOT NULL)''',
+    '''CREATE INDEX IF NOT EXISTS offerings_lookup ON offerings (
+        instance_type, zone, product_description, duration, offering_type,
+        marketplace)''',
+    '''CREATE INDEX IF NOT EXISTS offerings_partition ON offerings (
+        region, product_description, marketplace)''',
+    '''CREATE TABLE IF NOT EXISTS syncs (
+        region TEXT NOT NULL,
+        product_description TEXT NOT NULL,
+        marketplace INTEGER NOT NULL,
+        synced_at REAL NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (region, product_description, marketplace))''',
+    '''CREATE TABLE IF NOT EXISTS zones (
+        zone TEXT PRIMARY KEY,
+        region TEXT NOT NULL)''',
+]
+
+
+class OfferingCatalog(object):
+    # Has the same get and set as DiskCache so it can be passed anywhere an
+    # offering cache is. Classes in regions that have not been synced are
+    # looked up in, and stored to, fallback.
+
+    def __init__(self, filename=CATALOG_FILE, fallback=None):
+        self.filename = filename
+        self.fallback = fallback
+        self.local = threading.local()
+        self.zone_regions = {}
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        db = self.connect()
+        for statement in SCHEMA:
+            db.execute(statement)
+        db.commit()
+
+    def connect(self):
+        # sqlite connections can't be shared between threads, and regions
+        # are analyzed on threads of their own.
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.filename, timeout=60)
+            self.local.db = db
+        return db
+
+    def get(self, key):
+        account_type, i_type, zone, platform = key
+        platforms = get_offering_platforms(platform, account_type)
+        if not self.is_synced(zone, platforms):
+            return self.fallback.get(key) if self.fallback else None
+        with phase('catalog_lookup'):
+            rows = self.connect().execute(
+                'SELECT data FROM offerings WHERE instance_type = ? AND '
+                'zone = ? AND product_description IN (' +
+                ','.join('?' * len(platforms)) + ') '
+                'ORDER BY product_description != ?, marketplace, rowid',
+                [i_type, zone] + platforms + [platform]).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def set(self, key, value):
+        if self.fallback:
+            self.fallback.set(key, value)
+
+    def get_region(self, zone):
+        try:
+            return self.zone_regions[zone]
+        except KeyError:
+            pass
+        row = self.connect().execute(
+            'SELECT region FROM zones WHERE zone = ?', (zone,)).fetchone()
+        region = row[0] if row else None
+        self.zone_regions[zone] = region
+        return region
+
+    def is_synced(self, zone, platforms):
+        region = self.get_region(zone)
+        if region is None:
+            return False
+        oldest = time.time() - CATALOG_MAX_AGE
+        for platform in platforms:
+            count = self.connect().execute(
+                'SELECT COUNT(*) FROM syncs WHERE region = ? AND '
+                'product_description = ? AND synced_at > ?',
+                (region, platform, oldest)).fetchone()[0]
+            if count < 2:
+                return False
+        return True
+
+    def get_stale_partitions(self, region, now):
+        synced = dict(((row[0], row[1]), row[2]) for row in
+                      self.connect().execute(
+                          'SELECT product_description, marketplace, '
+                          'synced_at FROM syncs WHERE region = ?', (region,)))
+        stale = []
+        for platform in PRODUCT_DESCRIPTIONS:
+            for marketplace, ttl in ((False, AMAZON_SYNC_TTL),
+                                     (True, MARKETPLACE_SYNC_TTL)):
+                if now - synced.get((platform, marketplace), 0) > ttl:
+                    stale.append((platform, marketplace))
+        return stale
+
+    def sync(self, client, region, concurrency=CATALOG_CONCURRENCY):
+        # Partitions are fetched in parallel and each one replaces its old
+        # rows in a single transaction, so lookups never see a partition half
+        # loaded. Returns the number of offerings loaded.
+        now = time.time()
+        partitions = self.get_stale_partitions(region, now)
+        loaded = 0
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = dict((pool.submit(fetch_partition, client, platform,
+                                        marketplace), (platform, marketplace))
+                           for platform, marketplace in partitions)
+            for future in as_completed(futures):
+                platform, marketplace = futures[future]
+                with phase('catalog_load'):
+                    loaded += self.load_partition(region, platform,
+                                                  marketplace, future.result(),
+                                                  now)
+        return loaded
+
+    def load_partition(self, region, platform, marketplace, offerings, now):
+        db = self.connect()
+        with db:
+            db.execute('DELETE FROM offerings WHERE region = ? AND '
+                       'product_description = ? AND marketplace = ?',
+                       (region, platform, marketplace))
+            db.executemany(
+                'INSERT INTO offerings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                ((offering['ReservedInstancesOfferingId'], region,
+                  offering['InstanceType'], offering.get('AvailabilityZone'),
+                  offering['ProductDescription'], offering['Duration'],
+                  offering['OfferingType'], offering.get('Marketplace', False),
+                  json.dumps(offering, default=str))
+                 for offering in offerings))
+            db.executemany(
+                'INSERT OR REPLACE INTO zones VALUES (?, ?)',
+                ((zone, region) for zone in
+                 set(offering.get('AvailabilityZone') for offering in offerings)
+                 if zone))
+            db.execute('INSERT OR REPLACE INTO syncs VALUES (?, ?, ?, ?, ?)',
+                       (region, platform, marketplace, now, len(offerings)))
+        self.zone_regions.clear()
+        return len(offerings)
+
+
+def fetch_partition(client, platform, marketplace):
+    kwargs = {
+        'ProductDescription': platform,
+        'IncludeMarketplace': marketplace,
+        'Filters': [{'Name': 'marketplace',
+                     'Values': ['true' if marketplace else 'false']}],
+        'MaxResults': CATALOG_PAGE_SIZE,
+    }
+    offerings = []
+    while True:
+        with phase('catalog_fetch'):
+            page = client.describe_reserved_instances_offerings(**kwargs)
+        offerings += page['ReservedInstancesOfferings']
+        next_token = page.get('NextToken')
+        if not next_token:
+            return offerings
+        kwargs['NextToken'] = next_token
+
+
+if __name__ == '__main__':
+    session = get_session()
+    regions = sys.argv[1:] or \
+        get_enabled_regions(session.client('ec2', DEFAULT_REGION))
+    catalog = OfferingCatalog()
+    for region in regions:
+        start = time.time()
+        count = catalog.sync(session.client('ec2', region), region)
+        print(region + ': ' + str(count) + ' offerings loaded in ' +
+              str(round(time.time() - start, 1)) + 's')
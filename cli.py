@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+# Command line entry point. Each subcommand fetches only what it reports on:
+#   utilization  reservations, instances and how they match
+#   unreserved   running instances no reservation applies to
+#   suggest      the full report with recommended changes and offerings
+#   buy          the full report, then prompts to buy offerings
+#   plan         the full report, then writes the offerings to buy to a plan
+#                file for review
+#   purchase     buys everything left in a plan file
+# Usage: python cli.py [command] [regions...] [options]
+# Heavy modules are imported inside the commands that use them.
+import argparse
+import sys
+
+COMMANDS = ['utilization', 'unreserved', 'suggest', 'buy', 'plan',
+            'purchase']
+DEFAULT_COMMAND = 'suggest'
+USAGE_SECTIONS = {
+    'utilization': ['utilized', 'unused_reservations', 'coverage'],
+    'unreserved': ['instance_class_counts', 'unreserved'],
+}
+ACCOUNT_UNSUPPORTED = [('--replay', 'replay'), ('--record', 'record'),
+                       ('--profile', 'profile'),
+                       ('--max-workers', 'max_workers'),
+                       ('--metrics-json', 'metrics_json'),
+                       ('--metrics-prom', 'metrics_prom')]
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='benjamin')
+    commands = parser.add_subparsers(dest='command')
+    for command in COMMANDS:
+        subparser = commands.add_parser(command)
+        subparser.add_argument('--metrics-json',
+                               help='file to write run metrics to')
+        subparser.add_argument('--metrics-prom',
+                               help='Prometheus textfile to write run '
+                                    'metrics to')
+        if command == 'purchase':
+            subparser.add_argument('plan_file', nargs='?',
+                                   default='purchase_plan.json')
+            subparser.add_argument('--dry-run', action='store_true',
+                                   help='only check each purchase would be '
+                                        'allowed')
+            subparser.add_argument('--yes', action='store_true',
+                                   help='do not ask for confirmation')
+            continue
+        subparser.add_argument('regions', nargs='*',
+                               help="region names, or 'all' for every "
+                                    "enabled region")
+        subparser.add_argument('--format', action='append', dest='formats',
+                               choices=['text', 'csv', 'json', 'jsonl',
+                                        'arrow'])
+        subparser.add_argument('--replay', help='snapshot file to report on')
+        subparser.add_argument('--no-cache', action='store_true')
+        subparser.add_argument('--store',
+                               help='Postgres DSN to save the report to')
+        if command in ('suggest', 'buy', 'plan'):
+            subparser.add_argument('--concurrency', type=int)
+            subparser.add_argument('--max-workers', type=int)
+            subparser.add_argument('--record',
+                                   help='snapshot file to record into')
+            subparser.add_argument('--profile', nargs='?', const=True,
+                                   help='write cProfile stats to this file, '
+                                        'or to ~/.benjamin/profiles')
+        if command == 'suggest':
+            subparser.add_argument('--account', action='append',
+                                   dest='accounts',
+                                   help='profile name or role ARN, repeat '
+                                        'for a consolidated report')
+            subparser.add_argument('--processes', type=int)
+        if command == 'plan':
+            subparser.add_argument('--plan-file', default='purchase_plan.json')
+            subparser.add_argument('--rank', type=int, default=0,
+                                   help='which of the suggested offerings to '
+                                        'buy for each instance')
+    return parser
+
+
+def parse_args(argv):
+    # Without a command, arguments are regions for the full report, as
+    # before subcommands existed.
+    if not argv or argv[0] not in COMMANDS and argv[0] not in ('-h', '--help'):
+        argv = [DEFAULT_COMMAND] + list(argv)
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if getattr(args, 'accounts', None):
+        # Accounts are analyzed in worker processes, which take none of the
+        # options that apply to a single account's run.
+        unsupported = [option for option, value in ACCOUNT_UNSUPPORTED
+                       if getattr(args, value) not in (None, False)]
+        if unsupported:
+            parser.error(', '.join(unsupported) +
+                         ' cannot be used with --account')
+    return args
+
+
+def get_regions(args):
+    if args.regions == ['all']:
+        return 'all'
+    return args.regions or None
+
+
+def run_report(args, metrics=None):
+    import benjamin
+    from report import get_writers
+    writers = get_writers(args.formats) if args.formats else None
+    if args.store:
+        from report import TextWriter
+        from store import StoreWriter
+        writers = (writers or [TextWriter()]) + [StoreWriter(args.store)]
+    if args.command == 'plan':
+        from plan import PlanWriter
+        from report import TextWriter
+        writers = (writers or [TextWriter()]) + \
+            [PlanWriter(args.plan_file, args.rank)]
+    if getattr(args, 'accounts', None):
+        from accounts import go_accounts
+        go_accounts(args.accounts, regions=get_regions(args),
+                    processes=args.processes, concurrency=args.concurrency,
+                    use_cache=not args.no_cache, writers=writers)
+        return
+    benjamin.go(dry_run=args.command != 'buy', regions=get_regions(args),
+                max_workers=args.max_workers, concurrency=args.concurrency,
+                record=args.record, replay=args.replay,
+                use_cache=not args.no_cache, writers=writers,
+                metrics=metrics, profile=args.profile)
+
+
+def run_usage(args, metrics=None):
+    from helpers import DEFAULT_REGION, get_enabled_regions, get_session
+    from metrics import MeteredClient, get_metered_session
+
+    if args.replay:
+        from snapshot import ReplayClient
+        client = ReplayClient(args.replay)
+        if metrics:
+            client = MeteredClient(client, metrics)
+        report_usage(args, client)
+        return
+
+    session = get_session()
+    if metrics:
+        session = get_metered_session(session, metrics)
+    regions = get_regions(args) or [DEFAULT_REGION]
+    if regions == 'all':
+        regions = get_enabled_regions(session.client('ec2', DEFAULT_REGION))
+    for region in regions:
+        if len(regions) > 1:
+            print()
+            print('Region: ' + region + ' ' + '=' * (70 - len(region)))
+        report_usage(args, session.client('ec2', region))
+
+
+def report_usage(args, client):
+    from helpers import get_unused_reservations, get_usage
+    from matching import match_instances
+    from report import (TextWriter, WRITERS, build_report,
+                        write_unreserved_csv)
+
+    use_cache = not (args.no_cache or args.replay)
+    account_type, reservations, instances, instance_class_counts = \
+        get_usage(client, use_cache)
+    matches, unreserved_instances = match_instances(reservations, instances)
+    report = build_report(instance_class_counts, matches, unreserved_instances,
+                          get_unused_reservations(reservations), [], [], [])
+    if args.command == 'unreserved':
+        write_unreserved_csv(report)
+    for name in args.formats or ['text']:
+        if name == 'text':
+            writer = TextWriter(sections=USAGE_SECTIONS[args.command])
+        else:
+            writer = WRITERS[name]()
+        writer.write(report)
+    if args.store:
+        from helpers import get_client_region
+        from store import StoreWriter
+        report.labels['region'] = get_client_region(client)
+        StoreWriter(args.store).write(report)
+
+
+def run_purchase(args, metrics=None):
+    from helpers import get_session
+    from metrics import get_metered_session
+    from plan import STATUS_PURCHASED, execute_plan, load_plan, print_plan
+
+    plan = load_plan(args.plan_file)
+    print_plan(plan)
+    if all(item['status'] == STATUS_PURCHASED for item in plan['items']):
+        print('Nothing left to buy')
+        return
+    if not (args.yes or args.dry_run):
+        answer = input('Buy everything not yet purchased? [y/N] ')
+        if answer.strip().lower() not in ('y', 'yes'):
+            return
+    session = get_session()
+    if metrics:
+        session = get_metered_session(session, metrics)
+    execute_plan(plan, args.plan_file, session, args.dry_run)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    metrics = None
+    if args.metrics_json or args.metrics_prom:
+        from metrics import Metrics, activate, phase
+        metrics = Metrics()
+        with activate(metrics), phase(args.command):
+            run_command(args, metrics)
+        if args.metrics_json:
+            metrics.write_json(args.metrics_json)
+        if args.metrics_prom:
+            metrics.write_prometheus(args.metrics_prom)
+    else:
+        run_command(args)
+
+
+def run_command(args, metrics=None):
+    if args.command in USAGE_SECTIONS:
+        run_usage(args, metrics)
+    elif args.command == 'purchase':
+        run_purchase(args, metrics)
+    else:
+        run_report(args, metrics)
+
+
+if __name__ == '__main__':
+    main()
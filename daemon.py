@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+# Long-running mode that keeps the matched fleet in memory and, on each
+# tick, only fetches and re-analyzes what changed since the last one.
+# Launches are found with a launch-time filter. Stops and terminations come
+# from EC2 state-change events that an EventBridge rule sends to an SQS
+# queue when one is given, otherwise from the StopInstances and
+# TerminateInstances calls CloudTrail recorded. Either way a tick only looks
+# up the instances that changed.
+# Usage: python daemon.py [region] [queue-url]
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import heapq
+import json
+import sys
+import time
+
+from helpers import *
+from matching import ReservationMatcher
+from offering_analytics import analyze_offerings_by_class
+from packing import PACKING_TIME_BUDGET, pack_reservations
+from records import clear_interned_groups
+
+DEFAULT_INTERVAL = 300
+# A full resync corrects anything the deltas miss, such as an instance that
+# was stopped, resized and started again between two ticks.
+FULL_SYNC_INTERVAL = 288
+LAUNCH_TIME_MARGIN = timedelta(minutes=10)
+# CloudTrail can take up to 15 minutes to make a call visible.
+EVENT_DELAY_MARGIN = timedelta(minutes=15)
+DEPARTED_STATES = ['shutting-down', 'terminated', 'stopping', 'stopped']
+DEPARTURE_EVENTS = ['StopInstances', 'TerminateInstances']
+INSTANCE_ID_FILTER_SIZE = 200
+SQS_BATCH_SIZE = 10
+
+
+def get_reservation_states(reservations):
+    return dict((reservation.id, (reservation.state, reservation.count))
+                for reservation in reservations)
+
+
+def get_launch_time_filter(since, until):
+    # launch-time only supports wildcards, so match every UTC day between
+    # the two times.
+    days = []
+    day = since.date()
+    while day <= until.date():
+        days.append(day.isoformat() + '*')
+        day += timedelta(days=1)
+    return [{'Name': 'launch-time', 'Values': days},
+            {'Name': 'instance-state-name', 'Values': ['running']}]
+
+
+def get_partition(ins_or_res):
+    # Reservations and instances only affect each other's naive changes,
+    # packing and suggestions within a family and platform, so each of these
+    # is analyzed on its own.
+    return ins_or_res.family, normalize_platform(ins_or_res.platform)
+
+
+class CloudTrailEvents(object):
+    # Instances named by StopInstances and TerminateInstances calls.
+    # Instances that stop without a call, such as interrupted spot instances
+    # or ones shut down from inside, are only noticed by the next full sync.
+
+    def __init__(self, client):
+        self.client = client
+
+    def get_instance_ids(self, since, until):
+        instance_ids = []
+        for event_name in DEPARTURE_EVENTS:
+            kwargs = {
+                'LookupAttributes': [{'AttributeKey': 'EventName',
+                                      'AttributeValue': event_name}],
+                'StartTime': since - EVENT_DELAY_MARGIN,
+                'EndTime': until,
+            }
+            while True:
+                page = self.client.lookup_events(**kwargs)
+                for event in page['Events']:
+                    for resource in event.get('Resources', []):
+                        if resource.get('ResourceType') == \
+                                'AWS::EC2::Instance':
+                            instance_ids.append(resource['ResourceName'])
+                next_token = page.get('NextToken')
+                if not next_token:
+                    break
+                kwargs['NextToken'] = next_token
+        return instance_ids
+
+
+class StateChangeQueue(object):
+    # Instances named by "EC2 Instance State-change Notification" events on
+    # an SQS queue, which cover every stop and termination whatever caused
+    # it. Messages are deleted once read.
+
+    def __init__(self, client, queue_url):
+        self.client = client
+        self.queue_url = queue_url
+
+    def get_instance_ids(self, since, until):
+        instance_ids = []
+        while True:
+            messages = self.client.receive_message(
+                QueueUrl=self.queue_url,
+                MaxNumberOfMessages=SQS_BATCH_SIZE).get('Messages', [])
+            if not messages:
+                return instance_ids
+            for message in messages:
+                detail = json.loads(message['Body']).get('detail', {})
+                if detail.get('state') in DEPARTED_STATES:
+                    instance_ids.append(detail['instance-id'])
+            self.client.delete_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{'Id': str(i), 'ReceiptHandle': m['ReceiptHandle']}
+                         for i, m in enumerate(messages)])
+
+
+class FleetState(object):
+    # events is a CloudTrailEvents or StateChangeQueue. Analysis results are
+    # kept per family and platform so a tick only redoes the partitions its
+    # changes touched.
+
+    def __init__(self, client, events, offering_cache=None):
+        self.client = client
+        self.events = events
+        self.offering_cache = offering_cache
+        self.account_type = None
+        self.instances = OrderedDict()
+        self.instance_class_counts = {}
+        self.reservations = []
+        self.reservations_by_partition = {}
+        self.reservation_states = {}
+        self.matcher = None
+        self.image_names = load_map(IMAGE_NAMES_FILE)
+        self.analyzed_by_class = {}
+        self.last_sync = None
+        self.partitions = {}
+
+    @property
+    def unreserved_instances(self):
+        return self.matcher.get_unreserved() if self.matcher else []
+
+    @property
+    def unused_reservations(self):
+        return [reservation for partition in self.partitions.values()
+                for reservation in partition['unused_reservations']]
+
+    @property
+    def naive_changes(self):
+        return [change for partition in self.partitions.values()
+                for change in partition['naive_changes']]
+
+    @property
+    def type_changes(self):
+        changes = [change for partition in self.partitions.values()
+                   for change in partition['type_changes']]
+        changes.sort(key=lambda x: -x['utilization'])
+        return changes
+
+    @property
+    def suggested_reservations(self):
+        return list(heapq.merge(
+            *[partition['suggested_reservations']
+              for partition in self.partitions.values()],
+            key=lambda x: x[1][0]['TotalCost'], reverse=True))
+
+    def full_sync(self):
+        now = datetime.utcnow()
+        self.account_type = determine_account_type(self.client)
+        self.instances = OrderedDict()
+        self.instance_class_counts = {}
+        # Every instance is fetched again, so security group lists that no
+        # instance uses any more can be dropped.
+        clear_interned_groups()
+        for instance in iter_instances(self.account_type, self.client,
+                                       self.instance_class_counts,
+                                       self.image_names):
+            self.instances[instance.id] = instance
+        self.set_reservations(get_ris(self.client))
+        # Offerings drift slowly, so they are only refreshed on full syncs.
+        self.analyzed_by_class = {}
+        self.last_sync = now
+        self.analyze()
+        save_map(IMAGE_NAMES_FILE, self.image_names)
+
+    def tick(self):
+        now = datetime.utcnow()
+        launched = self.fetch_launched(self.last_sync - LAUNCH_TIME_MARGIN, now)
+        departed = self.fetch_departed(self.last_sync, now)
+        reservations = get_ris(self.client)
+        reservations_changed = \
+            get_reservation_states(reservations) != self.reservation_states
+
+        added = [instance for instance in launched
+                 if instance.id not in self.instances]
+        removed = [self.instances[iid] for iid in departed
+                   if iid in self.instances]
+        # A known instance showing up as launched again was restarted,
+        # possibly with a new type, so it is replaced.
+        for instance in launched:
+            known = self.instances.get(instance.id)
+            if known is not None and \
+                    get_instance_class(known) != get_instance_class(instance):
+                removed.append(known)
+                added.append(instance)
+
+        rematched = set()
+        for instance in removed:
+            if not self.remove_instance(instance):
+                rematched.add(instance.family)
+        for instance in added:
+            self.add_instance(instance)
+        if reservations_changed:
+            self.set_reservations(reservations)
+        elif rematched:
+            self.rematch_families(rematched)
+
+        self.last_sync = now
+        if reservations_changed:
+            self.analyze()
+        elif added or removed:
+            self.analyze(set(get_partition(instance)
+                             for instance in added + removed))
+        return added, removed, reservations_changed
+
+    def fetch_launched(self, since, until):
+        launched = []
+        for reservations in iter_instance_pages(
+                self.client, filters=get_launch_time_filter(since, until)):
+            launched += get_running_instances(reservations, self.account_type,
+                                              self.client, {},
+                                              self.image_names)
+        return launched
+
+    def fetch_departed(self, since, until):
+        # Events can be late, repeated or followed by a restart, so the known
+        # instances they name are looked up and only those no longer running
+        # are returned. Instances terminated long enough ago are not listed
+        # at all.
+        instance_ids = [iid for iid in OrderedDict.fromkeys(
+            self.events.get_instance_ids(since, until))
+            if iid in self.instances]
+        states = {}
+        for i in range(0, len(instance_ids), INSTANCE_ID_FILTER_SIZE):
+            filters = [{'Name': 'instance-id', 'Values':
+                        instance_ids[i:i + INSTANCE_ID_FILTER_SIZE]}]
+            for reservations in iter_instance_pages(self.client,
+                                                    filters=filters):
+                for instance_data in reservations:
+                    for instance in instance_data['Instances']:
+                        states[instance['InstanceId']] = \
+                            instance['State']['Name']
+        return [iid for iid in instance_ids
+                if states.get(iid, 'terminated') in DEPARTED_STATES]
+
+    def add_instance(self, instance):
+        self.instances[instance.id] = instance
+        instance_class = get_instance_class(instance)
+        self.instance_class_counts[instance_class] = \
+            self.instance_class_counts.get(instance_class, 0) + 1
+        if self.matcher:
+            self.matcher.match(instance)
+
+    def remove_instance(self, instance):
+        # Returns False when the matcher could not release the instance on
+        # its own and its family has to be passed to rematch_families.
+        del self.instances[instance.id]
+        instance_class = get_instance_class(instance)
+        self.instance_class_counts[instance_class] -= 1
+        if not self.instance_class_counts[instance_class]:
+            del self.instance_class_counts[instance_class]
+        if not self.matcher:
+            return True
+        if instance.family in self.matcher.regional_families:
+            return False
+        self.matcher.remove(instance)
+        return True
+
+    def rematch_families(self, families):
+        instances_by_family = dict((family, []) for family in families)
+        for instance in self.instances.values():
+            if instance.family in instances_by_family:
+                instances_by_family[instance.family].append(instance)
+        for family, instances in instances_by_family.items():
+            self.matcher.rematch_family(family, instances)
+
+    def set_reservations(self, reservations):
+        # Reservation changes are rare, so the matcher is simply rebuilt.
+        self.reservations = reservations
+        self.reservations_by_partition = {}
+        for reservation in reservations:
+            self.reservations_by_partition.setdefault(
+                get_partition(reservation), []).append(reservation)
+        self.reservation_states = get_reservation_states(reservations)
+        self.matcher = ReservationMatcher(reservations)
+        for instance in self.instances.values():
+            self.matcher.match(instance)
+
+    def analyze(self, partitions=None):
+        # Redoes the given partitions, or all of them. Matching only moves
+        # capacity between instances of one family and platform, so those of
+        # the instances added or removed are the only ones that change.
+        everything = partitions is None
+        if everything:
+            self.partitions = {}
+            partitions = set(self.reservations_by_partition)
+        unreserved_by_partition = OrderedDict()
+        for waiting in self.matcher.unreserved_by_key.values():
+            if not waiting:
+                continue
+            # Instances waiting under one key share a family and platform.
+            partition = get_partition(next(iter(waiting.values())))
+            if everything or partition in partitions:
+                unreserved_by_partition.setdefault(partition, []).extend(
+                    waiting.values())
+        for partition in partitions:
+            unreserved_by_partition.setdefault(partition, [])
+
+        classes = [instance_class for instances
+                   in unreserved_by_partition.values()
+                   for instance_class in get_reservable_classes(instances)
+                   if instance_class not in self.analyzed_by_class]
+        if classes:
+            offerings_by_class = get_class_offerings(
+                classes, self.client, self.account_type, self.offering_cache)
+            self.analyzed_by_class.update(analyze_offerings_by_class(
+                OrderedDict((instance_class, offerings_by_class[instance_class])
+                            for instance_class in classes)))
+
+        deadline = time.time() + PACKING_TIME_BUDGET
+        for partition, unreserved in unreserved_by_partition.items():
+            unused = get_unused_reservations(
+                self.reservations_by_partition.get(partition, []))
+            if not unused and not unreserved:
+                self.partitions.pop(partition, None)
+                continue
+            self.partitions[partition] = OrderedDict([
+                ('unused_reservations', unused),
+                ('naive_changes', get_naive_reservation_changes(
+                    unused, unreserved)),
+                ('type_changes', pack_reservations(
+                    unused, unreserved, max(0, deadline - time.time()))),
+                ('suggested_reservations', get_suggested_reservations(
+                    unreserved, self.client, self.account_type,
+                    analyzed_by_class=self.analyzed_by_class)),
+            ])
+
+
+def print_summary(state, added=(), removed=(), reservations_changed=False):
+    print(datetime.utcnow().isoformat() + ' ' + str(len(state.instances)) +
+          ' instances (+' + str(len(added)) + ' -' + str(len(removed)) +
+          '), ' + str(len(state.reservations)) + ' reservations' +
+          (' (changed)' if reservations_changed else '') + ', ' +
+          str(len(state.unreserved_instances)) + ' unreserved, ' +
+          str(len(state.unused_reservations)) + ' with unused capacity, ' +
+          str(len(state.type_changes)) + ' suggested changes')
+    for instance in added:
+        print('  + ' + instance.id + ' ' +
+              str(get_instance_class(instance)))
+    for instance in removed:
+        print('  - ' + instance.id + ' ' +
+              str(get_instance_class(instance)))
+
+
+def run(client, events, interval=DEFAULT_INTERVAL,
+        full_sync_interval=FULL_SYNC_INTERVAL, offering_cache=None):
+    state = FleetState(client, events, offering_cache)
+    ticks = 0
+    while True:
+        if ticks % full_sync_interval == 0:
+            state.full_sync()
+            print_summary(state)
+        else:
+            added, removed, reservations_changed = state.tick()
+            if added or removed or reservations_changed:
+                print_summary(state, added, removed, reservations_changed)
+        ticks += 1
+        time.sleep(interval)
+
+
+if __name__ == '__main__':
+    region = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_REGION
+    queue_url = sys.argv[2] if len(sys.argv) > 2 else None
+    session = get_session()
+    if queue_url:
+        events = StateChangeQueue(session.client('sqs', region), queue_url)
+    else:
+        events = CloudTrailEvents(session.client('cloudtrail', region))
+    run(session.client('ec2', region), events,
+        offering_cache=get_offering_cache())
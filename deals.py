@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# Scans the whole reserved instance marketplace for the cheapest listings,
+# whatever their type, zone or platform. Listings are compared on effective
+# hourly cost per normalized unit (see RESERVATION_MAP), i.e. what one small
+# instance's worth of capacity costs per hour over the listing's remaining
+# term, upfront included, so a one dollar all upfront listing and a cheap
+# hourly one rank on the same scale.
+# Usage: python deals.py [region] [top]
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import itertools
+import sys
+import threading
+
+from helpers import *
+
+DEAL_PAGE_SIZE = 100
+DEAL_CONCURRENCY = 8
+DEFAULT_TOP = 20
+
+
+class TopDeals(object):
+    # Keeps the top best (lowest scoring) deals in a max-heap, so the worst
+    # kept deal is always at the front and anything scoring above it can be
+    # dropped before a row is built for it.
+
+    def __init__(self, top):
+        self.top = top
+        self.heap = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.threshold = float('inf')
+
+    def offer(self, score, make_deal):
+        if score >= self.threshold:
+            return False
+        deal = make_deal()
+        with self.lock:
+            entry = (-score, next(self.counter), deal)
+            if len(self.heap) < self.top:
+                heapq.heappush(self.heap, entry)
+            elif score < -self.heap[0][0]:
+                heapq.heapreplace(self.heap, entry)
+            else:
+                return False
+            if len(self.heap) == self.top:
+                self.threshold = -self.heap[0][0]
+        return True
+
+    def get_deals(self):
+        return [deal for score, count, deal in sorted(self.heap, reverse=True)]
+
+
+def get_unit_hourly(offering, units):
+    # Effective hourly cost of the listing per normalized unit.
+    hours = offering['Duration'] / SECONDS_IN_HOUR
+    if hours <= 0:
+        return None
+    hourly = sum(charge['Amount'] for charge in offering['RecurringCharges']
+                 if charge['Frequency'] == 'Hourly')
+    hourly += offering.get('UsagePrice', 0.0)
+    return (offering['FixedPrice'] / hours + hourly) / units
+
+
+def get_deal(offering, units, unit_hourly):
+    hours = offering['Duration'] / SECONDS_IN_HOUR
+    return OrderedDict([
+        ('offering_id', offering['ReservedInstancesOfferingId']),
+        ('instance_type', offering['InstanceType']),
+        ('zone', offering.get('AvailabilityZone')),
+        ('platform', offering['ProductDescription']),
+        ('offering_type', offering['OfferingType']),
+        ('upfront', offering['FixedPrice']),
+        ('hours', hours),
+        ('units', units),
+        ('unit_hourly', unit_hourly),
+        ('count', sum(detail.get('Count', 0)
+                      for detail in offering.get('PricingDetails', []))),
+    ])
+
+
+def scan_partition(client, platform, top_deals, offering_types=None,
+                   max_upfront=None, min_hours=None):
+    # Pages through the marketplace listings of one platform. Returns the
+    # number of pages fetched.
+    kwargs = {
+        'ProductDescription': platform,
+        'IncludeMarketplace': True,
+        'Filters': [{'Name': 'marketplace', 'Values': ['true']}],
+        'MaxResults': DEAL_PAGE_SIZE,
+    }
+    if min_hours:
+        kwargs['MinDuration'] = int(min_hours * SECONDS_IN_HOUR)
+    if offering_types and len(offering_types) == 1:
+        kwargs['OfferingType'] = offering_types[0]
+    pages = 0
+    while True:
+        with phase('describe_marketplace_offerings'):
+            page = client.describe_reserved_instances_offerings(**kwargs)
+        pages += 1
+        for offering in page['ReservedInstancesOfferings']:
+            if not offering.get('Marketplace'):
+                continue
+            if offering_types and \
+                    offering['OfferingType'] not in offering_types:
+                continue
+            if max_upfront is not None and \
+                    offering['FixedPrice'] > max_upfront:
+                continue
+            units = get_units(offering['InstanceType'])
+            if not units:
+                continue
+            unit_hourly = get_unit_hourly(offering, units)
+            if unit_hourly is None:
+                continue
+            top_deals.offer(unit_hourly, lambda: get_deal(offering, units,
+                                                          unit_hourly))
+        next_token = page.get('NextToken')
+        if not next_token:
+            return pages
+        kwargs['NextToken'] = next_token
+
+
+def scan_deals(client, top=DEFAULT_TOP, concurrency=DEAL_CONCURRENCY,
+               platforms=PRODUCT_DESCRIPTIONS, offering_types=None,
+               max_upfront=None, min_hours=None):
+    # The catalog is split by platform and the platforms are paged in
+    # parallel, at most concurrency at a time. Only the top deals are kept,
+    # so memory does not grow with the size of the catalog.
+    top_deals = TopDeals(top)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        pages = sum(pool.map(
+            lambda platform: scan_partition(client, platform, top_deals,
+                                            offering_types, max_upfront,
+                                            min_hours),
+            platforms))
+    return top_deals.get_deals(), pages
+
+
+def print_deals(deals):
+    print('Best marketplace deals --------------------------------------------')
+    for i, deal in enumerate(deals):
+        print(str(i) + ') ' + deal['instance_type'] + ' ' +
+              str(deal['zone']) + ' ' + deal['platform'])
+        print('  per unit hourly:           ' + str(deal['unit_hourly']))
+        print('  upfront:                   ' + str(deal['upfront']))
+        print('  type                       ' + deal['offering_type'])
+        print('  years:                     ' +
+              str(deal['hours'] / HOURS_IN_YEAR))
+        print('  available:                 ' + str(deal['count']))
+        print('  id:                        ' + deal['offering_id'])
+
+
+if __name__ == '__main__':
+    region = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_REGION
+    top = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_TOP
+    deals, pages = scan_deals(get_session().client('ec2', region), top)
+    print_deals(deals)
+    print()
+    print(str(pages) + ' pages scanned')
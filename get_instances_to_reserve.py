@@ -1,16 +1,175 @@
 # -*- coding: utf-8 -*-
-
+# Reservations for a planned fleet. The planned instances come from a CSV
+# with instance_type, zone and platform columns and an optional count column,
+# one row per instance or per group of instances. The file is read a row at
+# a time and only the count per (type, zone, platform) is kept, so memory
+# does not grow with the number of rows. Reservations the running fleet
+# leaves unused are packed onto the planned classes first, see packing.py,
+# and offerings are suggested for what is left.
+# Usage: python get_instances_to_reserve.py [csv] [region]
+from collections import OrderedDict
 import csv
+import sys
+
+from helpers import *
+from matching import match_instances
+from packing import get_packing_group, pack_class_counts
+from report import FILE_BUFFER_BYTES
+
+PLANNED_FILE = 'data/instance_to_reserve.csv'
+PLANNED_COLUMNS = ['instance_type', 'zone', 'platform']
+
+
+def get_planned_counts(filename=PLANNED_FILE):
+    # Returns the number of planned instances per (type, zone, platform), in
+    # the order classes first appear.
+    counts = OrderedDict()
+    with open(filename, 'r', newline='', buffering=FILE_BUFFER_BYTES) as f:
+        reader = csv.reader(f)
+        header = [name.strip().lower() for name in next(reader, [])]
+        missing = [name for name in PLANNED_COLUMNS if name not in header]
+        if missing:
+            raise Exception(filename + ' has no ' + ', '.join(missing) +
+                            ' column')
+        columns = [header.index(name) for name in PLANNED_COLUMNS]
+        count_column = header.index('count') if 'count' in header else None
+        width = max(columns + [count_column or 0]) + 1
+        for row in reader:
+            if not any(value.strip() for value in row):
+                continue
+            where = filename + ' line ' + str(reader.line_num) + ': '
+            if len(row) < width:
+                raise Exception(where + 'expected at least ' + str(width) +
+                                ' columns, got ' + str(len(row)))
+            key = tuple(row[i].strip() for i in columns)
+            blank = [name for name, value in zip(PLANNED_COLUMNS, key)
+                     if not value]
+            if blank:
+                raise Exception(where + ', '.join(blank) + ' is blank')
+            count = 1
+            if count_column is not None:
+                value = row[count_column].strip()
+                if not value.isdigit():
+                    raise Exception(where + 'count ' + repr(value) +
+                                    ' is not a whole number')
+                count = int(value)
+            counts[key] = counts.get(key, 0) + count
+    return counts
+
+
+def now(filename=PLANNED_FILE):
+    return get_planned_counts(filename)
+
+
+def get_unpacked_counts(class_counts, type_changes):
+    # The planned counts left once the packed instances are taken out.
+    remaining = OrderedDict(class_counts)
+    for suggestion in type_changes:
+        reservation = suggestion['reservation']
+        group = get_packing_group(reservation.type, reservation.platform)
+        for assignment in suggestion['assignments']:
+            count = assignment['instance_count']
+            for key in remaining:
+                i_type, zone, platform = key
+                if count == 0:
+                    break
+                if i_type != assignment['instance_type'] or \
+                        zone != assignment['instance_zone'] or \
+                        get_packing_group(i_type, platform) != group:
+                    continue
+                taken = min(count, remaining[key])
+                remaining[key] -= taken
+                count -= taken
+    return OrderedDict((key, count) for key, count in remaining.items()
+                       if count > 0)
 
 
-def now():
+def get_planned_reservations(class_counts, client, account_type, cache=None):
+    # Returns (instance class, count, analyzed offerings) for every class,
+    # most expensive first, and the classes that have no offering of the
+    # preferred term and type to suggest, such as misspelt types or types
+    # not sold in their zone. Offerings are analyzed once per class whatever
+    # its count.
+    offerings_by_class = get_class_offerings(list(class_counts), client,
+                                             account_type, cache)
     ret = []
-    f = open('data/instance_to_reserve.csv', 'r')
-    reader = csv.reader(f)
-    header_row = True
-    for row in reader:
-        if header_row:
-            header_row = False
-        else:
-            ret.append(row)
-    f.close()
+    skipped = []
+    for instance_class, count in class_counts.items():
+        offerings = offerings_by_class.get(instance_class)
+        if not offerings or not has_preferred_offering(offerings):
+            skipped.append((instance_class, count))
+            continue
+        ret.append((instance_class, count, analyze_offerings(offerings)))
+    ret.sort(key=lambda x: x[1] * x[2][0]['TotalCost'], reverse=True)
+    return ret, skipped
+
+
+def has_preferred_offering(offerings):
+    # analyze_offerings compares every offering with Amazon's own offering
+    # of the preferred term and type, so it needs one.
+    pref_seconds = int(RESERVATION_PREFERENCES['Seconds'])
+    pref_type = RESERVATION_PREFERENCES['OfferingType']
+    return any(not offering['Marketplace'] and
+               offering['Duration'] == pref_seconds and
+               offering['OfferingType'] == pref_type
+               for offering in offerings)
+
+
+def plan(client, filename=PLANNED_FILE, use_cache=True):
+    class_counts = get_planned_counts(filename)
+    account_type, reservations, instances, instance_class_counts = \
+        get_usage(client, use_cache)
+    match_instances(reservations, instances)
+    type_changes = pack_class_counts(get_unused_reservations(reservations),
+                                     class_counts)
+    planned, skipped = get_planned_reservations(
+        get_unpacked_counts(class_counts, type_changes), client, account_type,
+        get_offering_cache() if use_cache else None)
+    return class_counts, type_changes, planned, skipped
+
+
+def print_plan(class_counts, type_changes, planned, skipped=()):
+    print('Planned instances: ' + str(sum(class_counts.values())) + ' in ' +
+          str(len(class_counts)) + ' classes')
+    print()
+    print('Reservations to modify for planned instances ---------------------')
+    for suggestion in type_changes:
+        print(suggestion['reservation'].id + ' ' +
+              suggestion['reservation_type'] + ' ' +
+              suggestion['reservation_zone'] + ' utilization ' +
+              str(suggestion['utilization']))
+        for assignment in suggestion['assignments']:
+            print('  ' + str(assignment['instance_count']) + ' x ' +
+                  assignment['instance_type'] + ' ' +
+                  assignment['instance_zone'])
+    print()
+    print('Reservations to buy for planned instances ------------------------')
+    total_upfront = 0
+    total_savings = 0
+    for (i_type, zone, platform), count, offerings in planned:
+        offering = offerings[0]
+        total_upfront += count * offering['FixedPrice']
+        total_savings += count * offering.get('Savings', 0)
+        print(str(count) + ' x ' + i_type + ' ' + zone + ' ' + platform)
+        print('  offering:                  ' +
+              offering['ReservedInstancesOfferingId'])
+        print('  type                       ' + offering['OfferingType'])
+        print('  years:                     ' +
+              str(offering['Hours'] / HOURS_IN_YEAR))
+        print('  upfront:                   ' +
+              str(count * offering['FixedPrice']))
+    print()
+    print('Total upfront: ' + str(total_upfront))
+    print('Total savings: ' + str(total_savings))
+    if skipped:
+        print()
+        print('Planned instances without offerings to suggest '
+              '-------------------')
+        for (i_type, zone, platform), count in skipped:
+            print(str(count) + ' x ' + i_type + ' ' + zone + ' ' + platform)
+
+
+if __name__ == '__main__':
+    filename = sys.argv[1] if len(sys.argv) > 1 else PLANNED_FILE
+    region = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_REGION
+    print_plan(*plan(get_session().client('ec2', region), filename))
@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import os
 import sys
+import weakref
 
-import botocore
+from cache import DiskCache, IMAGE_NAMES_FILE, load_map, save_map
+from metrics import phase
+from records import InstanceRecord, ReservationRecord
 
 ACCOUNT_TYPE_VPC_DEFAULT = 'VPC-default'
 ACCOUNT_TYPE_EC2_CLASSIC = 'EC2-classic'
@@ -16,74 +22,103 @@ RESERVATION_PREFERENCES = {
     'OfferingType': 'Partial Upfront',
     'ClassesToIgnore': ['c3.8xlarge']
 }
+OFFERING_CACHE_TTL = 6 * SECONDS_IN_HOUR
+OFFERING_CACHE_MAX_BYTES = 256 * 1024 * 1024
+IMAGE_BATCH_SIZE = 200
+PRODUCT_DESCRIPTIONS = [
+    'Linux/UNIX',
+    'Linux/UNIX (Amazon VPC)',
+    'SUSE Linux',
+    'SUSE Linux (Amazon VPC)',
+    'Red Hat Enterprise Linux',
+    'Red Hat Enterprise Linux (Amazon VPC)',
+    'Windows',
+    'Windows (Amazon VPC)',
+    'Windows with SQL Server Standard',
+    'Windows with SQL Server Standard (Amazon VPC)',
+    'Windows with SQL Server Web',
+    'Windows with SQL Server Web (Amazon VPC)',
+    'Windows with SQL Server Enterprise',
+    'Windows with SQL Server Enterprise (Amazon VPC)',
+]
+NAIVE_CHANGE_ZONE = 'zone'
+NAIVE_CHANGE_TYPE = 'type'
+NAIVE_CHANGE_TYPE_AND_ZONE = 'type_and_zone'
+USAGE_WORKERS = 3
+DEFAULT_REGION = 'us-east-1'
+# Normalization factors of each size, as used by size-flexible reservations.
 RESERVATION_MAP = {
+    'nano':      0.25,
     'micro':     0.5,
     'small':     1,
     'medium':    2,
     'large':     4,
     'xlarge':    8,
     '2xlarge':  16,
+    '3xlarge':  24,
     '4xlarge':  32,
+    '6xlarge':  48,
     '8xlarge':  64,
-    '10xlarge': 80
+    '9xlarge':  72,
+    '10xlarge': 80,
+    '12xlarge': 96,
+    '16xlarge': 128,
+    '18xlarge': 144,
+    '24xlarge': 192,
+    '32xlarge': 256,
 }
+# Bare metal instances count as the largest size of their family.
+METAL_MAP = {
+    'a1': 32,
+    'c5': 192,
+    'c5d': 192,
+    'c5n': 144,
+    'g4dn': 128,
+    'i3': 128,
+    'i3en': 192,
+    'm5': 192,
+    'm5d': 192,
+    'm5zn': 96,
+    'r5': 192,
+    'r5d': 192,
+    'z1d': 96,
+}
+# Records keep their units as integers in quarters of a small instance, so
+# matching and packing never need floating point, even for nano instances.
+UNIT_SCALE = 4
+LINUX_PLATFORM = 'linux/unix'
+SCOPE_REGION = 'Region'
+account_types = weakref.WeakKeyDictionary()
 
 
 def same_family(instance, reservation):
-    return instance['InstanceType'].split('.')[0] == \
-           reservation['InstanceType'].split('.')[0]
+    return instance.family == reservation.family
 
 
 def same_availability_zone(instance, reservation):
-    return reservation['AvailabilityZone'] == instance['Placement'][
-        'AvailabilityZone']
+    return reservation.zone == instance.zone
 
 
 def same_instance_type(instance, reservation):
-    return instance['InstanceType'] == reservation['InstanceType']
+    return instance.type == reservation.type
 
 
 def same_platform(instance, reservation):
-    return get_account_agnostic_platform(instance['bj_Platform']).lower() == \
-           get_account_agnostic_platform(
-               reservation['ProductDescription']).lower()
+    return normalize_platform(instance.platform) == \
+           normalize_platform(reservation.platform)
 
 
 def get_account_agnostic_platform(platform):
     return platform.replace(' (Amazon VPC)', '')
 
 
-def get_availability_zone(ins_or_res):
-    if 'AvailabilityZone' in ins_or_res:
-        return ins_or_res['AvailabilityZone']
-    elif 'Placement' in ins_or_res:
-        return ins_or_res['Placement']['AvailabilityZone']
+@lru_cache(maxsize=None)
+def normalize_platform(platform):
+    return get_account_agnostic_platform(platform).lower()
 
 
-def match_reservations(instance, instance_class_counts, reservations,
-                       unreserved_instances):
-    for reservation in reservations:
-        # if reservation matches and not used, mark used and print utilized
-        rcount = reservation['InstanceCount']
-        if 'UsedInstanceCount' not in reservation:
-            reservation['UsedInstanceCount'] = 0
-        rused_count = reservation['UsedInstanceCount']
-        if rcount != rused_count:
-            rtype = reservation['InstanceType']
-            rzone = reservation['AvailabilityZone']
-            rplatform = get_account_agnostic_platform(
-                reservation['ProductDescription'])
-            itype = get_instance_type(instance)
-            izone = get_availability_zone(instance)
-            iid = instance['InstanceId']
-            iplatform = get_account_agnostic_platform(instance['bj_Platform'])
-            if itype == rtype and izone == rzone and \
-                            iplatform.lower() == rplatform.lower():
-                reservation['UsedInstanceCount'] += 1
-                if instance in unreserved_instances:
-                    unreserved_instances.remove(instance)
-                return reservation, rtype, rzone, rplatform, iid
-    return None
+def get_availability_zone(ins_or_res):
+    return ins_or_res.zone
 
 
 def instance_name(instance):
@@ -93,6 +128,75 @@ def instance_name(instance):
                 return tag['Value']
 
 
+def get_groups(instance):
+    groups = [group['GroupName'] for group in instance['SecurityGroups']]
+    return groups
+
+
+@lru_cache(maxsize=None)
+def get_normalization(i_type):
+    # Returns (family, normalization factor) for an instance type, computed
+    # once per type. The factor is None for sizes that are not known.
+    family, size = i_type.split('.', 1)
+    if size == 'metal':
+        return family, METAL_MAP.get(family)
+    return family, RESERVATION_MAP.get(size)
+
+
+def get_units(i_type):
+    return get_normalization(i_type)[1]
+
+
+def get_scaled_units(i_type):
+    units = get_units(i_type)
+    if units is None:
+        return None
+    return int(units * UNIT_SCALE)
+
+
+def get_normalized_units(scaled_units):
+    if scaled_units is None:
+        return None
+    return scaled_units / float(UNIT_SCALE)
+
+
+def is_size_flexible(reservation):
+    # Regional Linux/UNIX reservations with default tenancy apply to any size
+    # in their family, by normalized units.
+    return reservation.get('Scope') == SCOPE_REGION and \
+        normalize_platform(reservation['ProductDescription']) == \
+        LINUX_PLATFORM and \
+        reservation.get('InstanceTenancy', 'default') == 'default' and \
+        get_units(reservation['InstanceType']) is not None
+
+
+def get_instance_record(instance, platform):
+    # Copies what benjamin uses out of a describe_instances response so the
+    # response itself can be dropped.
+    i_type = instance['InstanceType']
+    return InstanceRecord(instance['InstanceId'], i_type,
+                          get_normalization(i_type)[0],
+                          get_scaled_units(i_type),
+                          instance['Placement']['AvailabilityZone'], platform,
+                          instance.get('VpcId'), instance_name(instance),
+                          get_groups(instance))
+
+
+def get_reservation_record(reservation):
+    # Regional reservations have no zone.
+    i_type = reservation['InstanceType']
+    zone = None
+    if reservation.get('Scope') != SCOPE_REGION:
+        zone = reservation['AvailabilityZone']
+    return ReservationRecord(reservation['ReservedInstancesId'], i_type,
+                             get_normalization(i_type)[0],
+                             get_scaled_units(i_type), zone,
+                             reservation['ProductDescription'],
+                             reservation['InstanceCount'],
+                             reservation['State'],
+                             is_size_flexible(reservation))
+
+
 def get_ris(client):
     reserved_instances = client.describe_reserved_instances(
         #DryRun=True|False,
@@ -116,66 +220,141 @@ def get_ris(client):
         reservation_state = reservation['State']
         if reservation_state == 'active' or \
                 reservation_state == 'payment-pending':
-            ret.append(reservation)
+            ret.append(get_reservation_record(reservation))
 
     return ret
 
 
-def get_instances(account_type, client, ec2):
-    max_results = 1000
-    instances = client.describe_instances(
-        #DryRun=True|False,
-        #InstanceIds=[
-        #    'string',
-        #],
-        #Filters=[
-        #    {
-        #        'Name': 'string',
-        #        'Values': [
-        #            'string',
-        #        ]
-        #    },
-        #],
-        #NextToken='string',
-        MaxResults=max_results
-    )
-    if len(instances) == max_results:
-        raise Exception('Need to implement instance paging')
-
-    running_instances = []
+def get_instances(account_type, client, persist_image_names=True):
     instance_class_counts = {}
-    cached_images = {}
-    for instance_data in instances['Reservations']:
-        info = instance_data['Instances']
-        for instance in info:
-            i_type = instance['InstanceType']
-            zone = instance['Placement']['AvailabilityZone']
-            state = instance['State']['Name']
-            if state != 'running':
-                continue
-            platform = get_platform(instance, account_type, cached_images, ec2)
-            instance['bj_Platform'] = platform
-            if not platform:
-                continue
-            running_instances.append(instance_data['Instances'][0])
-            instance_class = (i_type, zone, platform)
-            if instance_class in instance_class_counts:
-                instance_class_counts[instance_class] += 1
-            else:
-                instance_class_counts[instance_class] = 1
+    image_names = load_map(IMAGE_NAMES_FILE) if persist_image_names else {}
+    image_count = len(image_names)
+    running_instances = list(iter_instances(account_type, client,
+                                            instance_class_counts, image_names))
+    if persist_image_names and len(image_names) != image_count:
+        save_map(IMAGE_NAMES_FILE, image_names)
     return running_instances, instance_class_counts
 
 
-def get_platform(instance, account_type, cached_images, ec2):
+def get_usage(client, persist_image_names=True):
+    # Everything needed to match reservations and nothing else. The account
+    # type, reservations and first instance page are requested at the same
+    # time, so on a warm image cache a single-page fleet costs one round
+    # trip. Each instance page is processed while the next one is fetched,
+    # and only one page is held at a time.
+    image_names = load_map(IMAGE_NAMES_FILE) if persist_image_names else {}
+    image_count = len(image_names)
+    with ThreadPoolExecutor(max_workers=USAGE_WORKERS) as pool:
+        account_type = pool.submit(determine_account_type, client)
+        reservations = pool.submit(get_ris, client)
+        pages = iter_instance_pages(client)
+        next_page = pool.submit(next, pages, None)
+        account_type = account_type.result()
+        instance_class_counts = {}
+        instances = []
+        while True:
+            page = next_page.result()
+            if page is None:
+                break
+            next_page = pool.submit(next, pages, None)
+            instances += get_running_instances(page, account_type, client,
+                                               instance_class_counts,
+                                               image_names)
+        reservations = reservations.result()
+    if persist_image_names and len(image_names) != image_count:
+        save_map(IMAGE_NAMES_FILE, image_names)
+    return account_type, reservations, instances, instance_class_counts
+
+
+def iter_instance_pages(client, max_results=1000, filters=None):
+    # Follow NextToken so fleets larger than one page are not truncated.
+    kwargs = {'MaxResults': max_results}
+    if filters:
+        kwargs['Filters'] = filters
+    while True:
+        page = client.describe_instances(**kwargs)
+        yield page['Reservations']
+        next_token = page.get('NextToken')
+        if not next_token:
+            break
+        kwargs['NextToken'] = next_token
+
+
+def iter_instances(account_type, client, instance_class_counts,
+                   image_names=None):
+    # Yields running instances one page at a time, updating
+    # instance_class_counts as it goes so callers can start matching before
+    # the last page arrives.
+    if image_names is None:
+        image_names = {}
+    for reservations in iter_instance_pages(client):
+        for instance in get_running_instances(reservations, account_type,
+                                              client, instance_class_counts,
+                                              image_names):
+            yield instance
+
+
+def get_running_instances(reservations, account_type, client,
+                          instance_class_counts, image_names):
+    running = [instance for instance_data in reservations
+               for instance in instance_data['Instances']
+               if instance['State']['Name'] == 'running']
+    resolve_image_names([instance['ImageId'] for instance in running
+                         if 'Platform' not in instance], client, image_names)
+
+    running_instances = []
+    for instance in running:
+        i_type = instance['InstanceType']
+        zone = instance['Placement']['AvailabilityZone']
+        platform = get_platform(instance, account_type, image_names)
+        if not platform:
+            continue
+        running_instances.append(get_instance_record(instance, platform))
+        instance_class = (i_type, zone, platform)
+        instance_class_counts[instance_class] = \
+            instance_class_counts.get(instance_class, 0) + 1
+    return running_instances
+
+
+def resolve_image_names(image_ids, client, image_names):
+    # AMI names never change, so only images not already in image_names are
+    # looked up, IMAGE_BATCH_SIZE at a time. Filtering on image-id rather
+    # than passing ImageIds leaves deregistered or inaccessible images out of
+    # the response instead of failing the whole batch. Those are stored as
+    # None so they are not looked up again on every run.
+    missing = sorted(set(image_id for image_id in image_ids
+                         if image_id not in image_names))
+    if not missing:
+        return
+    with phase('resolve_image_names'):
+        for start in range(0, len(missing), IMAGE_BATCH_SIZE):
+            batch = missing[start:start + IMAGE_BATCH_SIZE]
+            images = client.describe_images(
+                Filters=[{'Name': 'image-id', 'Values': batch}])
+            found = set()
+            for image in images['Images']:
+                image_names[image['ImageId']] = image.get('Name') or ''
+                found.add(image['ImageId'])
+            for image_id in batch:
+                if image_id not in found:
+                    image_names[image_id] = None
+
+
+def get_platform(instance, account_type, image_names):
     if 'Platform' in instance:
         platform = instance['Platform']
     else:
-        if instance['ImageId'] in cached_images:
-            image = cached_images[instance['ImageId']]
-        else:
-            image = ec2.Image(instance['ImageId'])
-            cached_images[instance['ImageId']] = image
-        image_name = image.name.lower()
+        image_name = image_names.get(instance['ImageId'])
+        if image_name is None:
+            # The instance still runs and may use a reservation, so leaving
+            # it out would undercount the fleet. Without a Platform field it
+            # is Linux/UNIX.
+            print('Warning: could not find image ' + instance['ImageId'] +
+                  ' of instance: ' + instance['InstanceId'] +
+                  ', it may have been deregistered or not be shared. '
+                  'Assuming Linux/UNIX.')
+            return 'Linux/UNIX'
+        image_name = image_name.lower()
         if 'red' in image_name or 'windows' in image_name or \
                 'suse' in image_name:
             print('This is unexpected, instance: ' +
@@ -221,14 +400,19 @@ def get_offerings(i_type, zone, platform, client, account_type):
             MaxInstanceCount=1000)
         return offerings['ReservedInstancesOfferings']
 
-    ret = make_request(platform)
-    if account_type == ACCOUNT_TYPE_EC2_CLASSIC:
-        vpc_offerings = make_request(platform + ' (Amazon VPC)')
-        ret += vpc_offerings
-
+    ret = []
+    for mod_platform in get_offering_platforms(platform, account_type):
+        ret += make_request(mod_platform)
     return ret
 
 
+def get_offering_platforms(platform, account_type):
+    # EC2-Classic accounts can also use reservations bought for VPC.
+    if account_type == ACCOUNT_TYPE_EC2_CLASSIC:
+        return [platform, platform + ' (Amazon VPC)']
+    return [platform]
+
+
 def get_default_offerings(client):
     offerings = client.describe_reserved_instances_offerings(
         MaxResults=1000,
@@ -237,94 +421,129 @@ def get_default_offerings(client):
     return offerings
 
 
+def get_session(session=None):
+    # boto3 takes a while to import, so it is only loaded once a command
+    # actually needs to talk to AWS. Its clients are paced by the limiters
+    # shared by the whole process, see throttle.py.
+    if session is None:
+        import boto3
+        from throttle import ThrottledSession, shared_limiters
+        session = ThrottledSession(boto3, shared_limiters)
+    return session
+
+
+def format_currency(amount):
+    # Dollars as the en_US locale writes them, without depending on the
+    # process locale, which library callers may never set.
+    text = '${:,.2f}'.format(abs(amount))
+    return '-' + text if amount < 0 else text
+
+
+def get_client_region(client):
+    return getattr(getattr(client, 'meta', None), 'region_name', None)
+
+
+def get_enabled_regions(client):
+    regions = client.describe_regions()['Regions']
+    return sorted(region['RegionName'] for region in regions)
+
+
 def determine_account_type(client):
-    default_offerings = get_default_offerings(client)
-    for offering in default_offerings['ReservedInstancesOfferings']:
-        if 'VPC' in offering['ProductDescription']:
-            return ACCOUNT_TYPE_EC2_CLASSIC
-    return ACCOUNT_TYPE_VPC_DEFAULT
+    # Only accounts that can still launch into EC2-Classic list EC2 among
+    # their supported platforms. The answer never changes for an account, so
+    # it is kept for as long as the client is alive.
+    try:
+        return account_types[client]
+    except (KeyError, TypeError):
+        pass
+    attributes = client.describe_account_attributes(
+        AttributeNames=['supported-platforms'])['AccountAttributes']
+    account_type = ACCOUNT_TYPE_VPC_DEFAULT
+    for attribute in attributes:
+        if attribute['AttributeName'] == 'supported-platforms':
+            for value in attribute['AttributeValues']:
+                if value['AttributeValue'] == 'EC2':
+                    account_type = ACCOUNT_TYPE_EC2_CLASSIC
+    try:
+        account_types[client] = account_type
+    except TypeError:
+        pass
+    return account_type
 
 
 def get_instance_type(ins_or_res):
-    return ins_or_res['InstanceType']
+    return ins_or_res.type
 
 
 def get_instance_family(instance):
-    return instance['InstanceType'].split('.')[0]
+    return instance.family
 
 
 def get_instance_size(instance):
-    return RESERVATION_MAP[instance['InstanceType'].split('.')[1]]
+    return instance.units
 
 
 def check_reservation_sizing(instance, reservation):
+    # How many instances of the instance's size one reserved instance covers:
+    # the ratio of their units within a family, as a modification or a
+    # size-flexible reservation keeps the units, or 1 for the same type.
+    if instance.type == reservation.type:
+        return 1.0
     in_units = get_instance_size(instance)
     re_units = get_instance_size(reservation)
-    pass
-
+    if not in_units or not re_units or \
+            not same_family(instance, reservation):
+        return 0.0
+    return re_units / float(in_units)
 
-def pack_reservations(reservations, instances):
-    ins_by_class = {}
 
-    # Get instances by type
+def get_naive_reservation_changes(reservations, instances):
+    # Buckets instances by family and platform, then by (type, zone), so
+    # each reservation is only compared with the groups it could apply to and
+    # yields one suggestion per target type and zone.
+    buckets = {}
     for instance in instances:
-        ins_type = instance['InstanceType']
-        ins_zone = get_availability_zone(instance)
-        cls = (ins_type, ins_zone)
-        ins_in_class = ins_by_class.get(cls, [])
-        ins_in_class.append(instance)
-        ins_by_class[cls] = ins_in_class
-
-    suggestions = []
-
-    # Look for instance classes that would fulfill a reservation
-    # (i.e. 8 or less m1.small's) and give utilization rate
-    # Sort by utilization rate
+        bucket_key = (get_instance_family(instance),
+                      normalize_platform(instance.platform))
+        groups = buckets.setdefault(bucket_key, OrderedDict())
+        group_key = (get_instance_type(instance),
+                     get_availability_zone(instance))
+        groups.setdefault(group_key, []).append(instance)
+
+    changes = []
     for reservation in reservations:
-        re_type = get_instance_type(reservation)
-        re_family = get_instance_family(reservation)
-        for ins_cls in ins_by_class:
-            ins_type, ins_zone = ins_cls
-            ins_family = ins_type.split('.')[0]
-            if ins_family == re_family:
-                instances = ins_by_class[ins_cls]
-                count = len(instances)
-                instance = instances[0]
-                ins_size = get_instance_size(instances[0])
-                ins_units = count * ins_size
-                re_count = reservation['InstanceCount']
-                re_used_count = reservation['UsedInstanceCount']
-                re_unused_count = re_count - re_used_count
-                re_total_count = re_unused_count + re_used_count
-                re_used_fraction = re_used_count / re_total_count
-                re_units = get_instance_size(reservation) * re_total_count
-                re_zone = get_availability_zone(reservation)
-                ins_zone = get_availability_zone(instance)
-                same_zone = re_zone == ins_zone
-                utilization = float(ins_units) / float(re_units)
-
-                if abs(1.0 - utilization) < 0.25:
-                    suggestions.append(OrderedDict({
-                        'reservation': reservation,
-                        'instances': instances,
-                        'utilization': utilization,
-                        'instance_zone': re_zone,
-                        'reservation_zone': ins_zone,
-                        'same_zone': same_zone,
-                        'instance_count': count,
-                        'instance_units': ins_units,
-                        'reserved_units': re_units,
-                        'instance_type': ins_type,
-                        'reservation_type': re_type,
-                    }))
-        # TODO: Suggest availability zone.
-        # TODO: Utilization far from 1.0 could give better results buying on third-party.
-        # TODO: Look for opportunities to combine reserved instances to cover current large instances.
-        # TODO: Incorporate fact that reservations can be changed to multiple smaller reservations of different classes.
-
-    if len(suggestions) > 0:
-        suggestions = sorted(suggestions, key=lambda x: -x['utilization'])
-    return suggestions
+        bucket_key = (get_instance_family(reservation),
+                      normalize_platform(reservation.platform))
+        r_type = get_instance_type(reservation)
+        r_zone = get_availability_zone(reservation)
+        if reservation.flexible:
+            # Already applies to every size and zone in its family.
+            continue
+        for (i_type, i_zone), group in buckets.get(bucket_key, {}).items():
+            have_same_type = i_type == r_type
+            # Regional reservations apply in every zone of the region.
+            have_same_az = r_zone is None or i_zone == r_zone
+            if have_same_type and have_same_az:
+                continue
+            if have_same_type and not have_same_az:
+                change = NAIVE_CHANGE_ZONE
+            elif not have_same_type and not have_same_az:
+                change = NAIVE_CHANGE_TYPE_AND_ZONE
+            elif have_same_az:
+                change = NAIVE_CHANGE_TYPE
+            changes.append(OrderedDict([
+                ('reservation', reservation),
+                ('change', change),
+                ('reservation_type', r_type),
+                ('reservation_zone', r_zone),
+                ('instance_type', i_type),
+                ('instance_zone', i_zone),
+                ('instance_count', len(group)),
+                ('instances_covered',
+                 check_reservation_sizing(group[0], reservation)),
+                ('instances', group),
+            ]))
+    return changes
 
 
 def analyze_offerings(offerings):
@@ -440,25 +659,77 @@ def populate_calculated_offering_fields(offering):
     return min_effective_hourly, max_effective_hourly
 
 
-def get_suggested_reservations(instances, client, account_type):
+def get_class_offerings(instance_classes, client, account_type, cache=None):
+    # Offerings only depend on the instance class, so fetch them once per
+    # class rather than once per instance.
+    offerings_by_class = {}
+    classes_to_ignore = RESERVATION_PREFERENCES['ClassesToIgnore']
+    for instance_class in instance_classes:
+        i_type, zone, platform = instance_class
+        if i_type in classes_to_ignore or instance_class in offerings_by_class:
+            continue
+        key = (account_type, i_type, zone, platform)
+        offerings = cache.get(key) if cache else None
+        if offerings is None:
+            with phase('get_offerings'):
+                offerings = get_offerings(i_type, zone, platform, client,
+                                          account_type)
+            if cache:
+                cache.set(key, offerings)
+        offerings_by_class[instance_class] = offerings
+    return offerings_by_class
+
+
+def get_offering_cache():
+    # Once catalog.py has synced a local catalog, offerings come from it
+    # and the disk cache is only used for regions it does not cover.
+    cache = DiskCache('offerings', OFFERING_CACHE_TTL, OFFERING_CACHE_MAX_BYTES)
+    from catalog import CATALOG_FILE, OfferingCatalog
+    if os.path.exists(CATALOG_FILE):
+        return OfferingCatalog(CATALOG_FILE, cache)
+    return cache
+
+
+def get_instance_class(instance):
+    return (instance.type, instance.zone, instance.platform)
+
+
+def get_suggested_reservations(instances, client, account_type,
+                               offerings_by_class=None, cache=None,
+                               analyzed_by_class=None):
+    if analyzed_by_class is None:
+        analyzed_by_class = {}
+        if offerings_by_class is None:
+            offerings_by_class = get_class_offerings(
+                get_reservable_classes(instances), client, account_type, cache)
     ret = []
     for instance in instances:
         classes_to_ignore = RESERVATION_PREFERENCES['ClassesToIgnore']
-        if instance['InstanceType'] in classes_to_ignore:
+        if instance.type in classes_to_ignore:
             continue
-        i_type = instance['InstanceType']
-        zone = instance['Placement']['AvailabilityZone']
-        offerings = get_offerings(i_type, zone, instance['bj_Platform'], client,
-                                  account_type)
-        good_offerings = analyze_offerings(offerings)
-        ret.append((instance, good_offerings))
+        instance_class = get_instance_class(instance)
+        if instance_class not in analyzed_by_class:
+            analyzed_by_class[instance_class] = analyze_offerings(
+                offerings_by_class[instance_class])
+        ret.append((instance, analyzed_by_class[instance_class]))
     ret = sorted(ret, key=lambda x: x[1][0]['TotalCost'], reverse=True)
     return ret
 
 
-def purchase_reserved_instance(offer_id, client, count, amount):
+def get_reservable_classes(instances):
+    classes = OrderedDict()
+    classes_to_ignore = RESERVATION_PREFERENCES['ClassesToIgnore']
+    for instance in instances:
+        if instance.type not in classes_to_ignore:
+            classes[get_instance_class(instance)] = True
+    return list(classes)
+
+
+def purchase_reserved_instance(offer_id, client, count, amount,
+                               dry_run=False):
+    # amount is the most the whole purchase may cost upfront.
     response = client.purchase_reserved_instances_offering(
-        # DryRun=True|False,
+        DryRun=dry_run,
         ReservedInstancesOfferingId=offer_id,
         InstanceCount=count,
         LimitPrice={
@@ -470,13 +741,57 @@ def purchase_reserved_instance(offer_id, client, count, amount):
     return response
 
 
+def get_unit_coverage(matches, unreserved_instances, unused_reservations):
+    # Normalized units of running instances, how many of them reservations
+    # cover and how many reserved units go unused, per family.
+    families = {}
+    reservations = OrderedDict()
+
+    def get_family(family):
+        if family not in families:
+            families[family] = [0, 0, 0, 0, 0]
+        return families[family]
+
+    for instance, reservation in matches:
+        totals = get_family(instance.family)
+        totals[0] += 1
+        totals[1] += instance.units or 0
+        totals[2] += instance.units or 0
+        reservations[reservation.id] = reservation
+    for instance in unreserved_instances:
+        totals = get_family(instance.family)
+        totals[0] += 1
+        totals[1] += instance.units or 0
+    for reservation in unused_reservations:
+        reservations[reservation.id] = reservation
+    for reservation in reservations.values():
+        totals = get_family(reservation.family)
+        reserved_units = reservation.count * (reservation.units or 0)
+        totals[3] += reserved_units
+        totals[4] += reserved_units - reservation.used_units
+
+    ret = []
+    for family in sorted(families):
+        count, units, covered, reserved, unused = families[family]
+        ret.append(OrderedDict([
+            ('family', family),
+            ('instance_count', count),
+            ('instance_units', get_normalized_units(units)),
+            ('covered_units', get_normalized_units(covered)),
+            ('reserved_units', get_normalized_units(reserved)),
+            ('unused_units', get_normalized_units(unused)),
+            ('coverage', covered / float(units) if units else 0.0),
+        ]))
+    return ret
+
+
 def get_unused_reservations(reservations):
     unused_reservations = []
     for reservation in reservations:
-        r_count = reservation['InstanceCount']
-        r_used_count = reservation['UsedInstanceCount']
+        r_count = reservation.count
+        r_used_count = reservation.used_count
         diff = r_count - r_used_count
-        reservation['UnusedInstanceCount'] = diff
+        reservation.unused_count = diff
         if r_used_count != r_count:
             unused_reservations.append(reservation)
     return unused_reservations
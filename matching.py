@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+
+from helpers import *
+
+ZONAL = 'zonal'
+REGIONAL = 'regional'
+FLEXIBLE = 'flexible'
+
+
+def get_match_key(ins_or_res):
+    return (ins_or_res.type, ins_or_res.zone,
+            normalize_platform(ins_or_res.platform))
+
+
+def get_bucket_key(reservation):
+    platform = normalize_platform(reservation.platform)
+    if reservation.flexible:
+        return (FLEXIBLE, reservation.family, platform)
+    if reservation.zone is None:
+        return (REGIONAL, reservation.type, platform)
+    return (ZONAL, reservation.type, reservation.zone, platform)
+
+
+def get_candidate_keys(instance):
+    # Zonal reservations apply first, then regional ones for the same type,
+    # then size-flexible ones for the family, as on an EC2 bill.
+    platform = normalize_platform(instance.platform)
+    return ((ZONAL, instance.type, instance.zone, platform),
+            (REGIONAL, instance.type, platform),
+            (FLEXIBLE, instance.family, platform))
+
+
+def get_free_units(reservation):
+    return reservation.count * reservation.units - reservation.used_units
+
+
+class ReservationMatcher(object):
+    # Indexes reservations by what they apply to, so each instance is
+    # matched with a few dict lookups instead of a scan over every
+    # reservation. Reservations within a bucket keep their original order and
+    # are filled front to back, which gives the same first-fit assignment as
+    # walking the whole list. Size-flexible reservations are filled by
+    # integer units, so one large reservation can cover several smaller
+    # instances of its family.
+
+    def __init__(self, reservations):
+        self.buckets = {}
+        self.first_open = {}
+        self.positions = {}
+        self.matched = {}
+        self.unreserved_ids = set()
+        self.unreserved_by_key = {}
+        self.regional_families = set()
+        for reservation in reservations:
+            reservation.used_count = 0
+            reservation.used_units = 0
+            if reservation.flexible and not reservation.units:
+                reservation.flexible = False
+            if reservation.zone is None:
+                self.regional_families.add(reservation.family)
+            key = get_bucket_key(reservation)
+            bucket = self.buckets.setdefault(key, [])
+            self.positions[id(reservation)] = len(bucket)
+            bucket.append(reservation)
+            self.first_open[key] = 0
+
+    def match(self, instance):
+        for key in get_candidate_keys(instance):
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                continue
+            reservation = self.take(key, bucket, instance)
+            if reservation is not None:
+                self.matched[instance.id] = reservation
+                return reservation
+        self.unreserved_ids.add(instance.id)
+        self.unreserved_by_key.setdefault(get_match_key(instance),
+                                          OrderedDict())[instance.id] = instance
+        return None
+
+    def take(self, key, bucket, instance):
+        i = self.first_open[key]
+        while i < len(bucket) and is_full(bucket[i]):
+            i += 1
+        self.first_open[key] = i
+        if key[0] != FLEXIBLE:
+            if i == len(bucket):
+                return None
+            reservation = bucket[i]
+            reservation.used_count += 1
+            reservation.used_units += reservation.units or 0
+            return reservation
+        units = instance.units
+        if not units:
+            return None
+        for reservation in bucket[i:]:
+            if get_free_units(reservation) >= units:
+                reservation.used_units += units
+                set_used_count(reservation)
+                return reservation
+        return None
+
+    def remove(self, instance):
+        # Releases whatever the instance held. Capacity freed on a
+        # reservation goes to the longest waiting unreserved instances it can
+        # apply to. The first of them is returned so callers can report the
+        # change.
+        iid = instance.id
+        reservation = self.matched.pop(iid, None)
+        if reservation is None:
+            self.unreserved_ids.discard(iid)
+            self.unreserved_by_key.get(get_match_key(instance),
+                                       {}).pop(iid, None)
+            return None
+        if reservation.flexible:
+            reservation.used_units -= instance.units
+            set_used_count(reservation)
+        else:
+            reservation.used_count -= 1
+            reservation.used_units -= reservation.units or 0
+        key = get_bucket_key(reservation)
+        self.first_open[key] = min(self.first_open[key],
+                                   self.positions[id(reservation)])
+        rematched = None
+        for waiting_key in list(self.unreserved_by_key):
+            if is_full(reservation):
+                break
+            if not self.can_apply(key, waiting_key):
+                continue
+            # Instances waiting under one key are all the same size, so once
+            # one does not fit none of the others will.
+            waiting = self.unreserved_by_key[waiting_key]
+            for waiting_id, waiting_instance in list(waiting.items()):
+                if self.match(waiting_instance) is None:
+                    break
+                del waiting[waiting_id]
+                self.unreserved_ids.discard(waiting_id)
+                rematched = rematched or waiting_instance
+                if is_full(reservation):
+                    break
+        return rematched
+
+    def rematch_family(self, family, instances):
+        # Matches the instances of a family again from scratch, in the given
+        # order. remove frees capacity greedily, which within a zone gives
+        # the same result as a fresh match. Regional capacity, and
+        # size-flexible units above all, can end up with other instances
+        # than a fresh match would give it, so families in
+        # regional_families are rematched instead.
+        for key, bucket in self.buckets.items():
+            if bucket[0].family != family:
+                continue
+            for reservation in bucket:
+                reservation.used_count = 0
+                reservation.used_units = 0
+            self.first_open[key] = 0
+        for iid, reservation in list(self.matched.items()):
+            if reservation.family == family:
+                del self.matched[iid]
+        for key in list(self.unreserved_by_key):
+            if get_normalization(key[0])[0] == family:
+                self.unreserved_ids.difference_update(
+                    self.unreserved_by_key.pop(key))
+        for instance in instances:
+            self.match(instance)
+
+    def can_apply(self, key, waiting_key):
+        i_type, zone, platform = waiting_key
+        if key[0] == ZONAL:
+            return key[1:] == waiting_key
+        if key[0] == REGIONAL:
+            return key[1:] == (i_type, platform)
+        return key[1:] == (get_normalization(i_type)[0], platform)
+
+    def get_unreserved(self, instances=None):
+        if instances is None:
+            return [instance for waiting in self.unreserved_by_key.values()
+                    for instance in waiting.values()]
+        return [instance for instance in instances
+                if instance.id in self.unreserved_ids]
+
+
+def is_full(reservation):
+    if reservation.flexible:
+        return get_free_units(reservation) == 0
+    return reservation.used_count >= reservation.count
+
+
+def set_used_count(reservation):
+    # A size-flexible reservation counts as many reserved instances unused
+    # as its free units fill completely.
+    reservation.used_count = reservation.count - \
+        get_free_units(reservation) // reservation.units
+
+
+def match_instances(reservations, instances):
+    # Returns the (instance, reservation) pairs and the unreserved instances,
+    # both in instance order.
+    matcher = ReservationMatcher(reservations)
+    matches = []
+    for instance in instances:
+        reservation = matcher.match(instance)
+        if reservation:
+            matches.append((instance, reservation))
+    return matches, matcher.get_unreserved(instances)
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+# Run metrics: wall time per pipeline phase and, per EC2 operation, call
+# counts, latency histograms, retries, throttles and bytes received. A
+# Metrics object collects while it is active (see activate) and can be
+# written as JSON or as a Prometheus textfile for node_exporter.
+from collections import Counter, OrderedDict
+import contextlib
+import json
+import os
+import threading
+import time
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                   float('inf'))
+METERED_PREFIXES = ('describe_', 'purchase_', 'modify_')
+THROTTLE_CODES = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded')
+PROMETHEUS_PREFIX = 'benjamin_'
+
+active = []
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = Counter()
+        self.phase_calls = Counter()
+        self.calls = Counter()
+        self.errors = Counter()
+        self.retries = Counter()
+        self.throttles = Counter()
+        self.bytes_received = Counter()
+        self.latency_sums = Counter()
+        self.latency_buckets = {}
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            self.phases[name] += seconds
+            self.phase_calls[name] += 1
+
+    def add_call(self, operation, seconds, response=None, error=None):
+        metadata = (response or {}).get('ResponseMetadata', {})
+        headers = metadata.get('HTTPHeaders', {})
+        with self.lock:
+            self.calls[operation] += 1
+            self.latency_sums[operation] += seconds
+            buckets = self.latency_buckets.setdefault(
+                operation, [0] * len(LATENCY_BUCKETS))
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    buckets[i] += 1
+                    break
+            self.bytes_received[operation] += \
+                int(headers.get('content-length', 0))
+            if error is not None:
+                self.errors[operation] += 1
+                if get_error_code(error) in THROTTLE_CODES:
+                    self.throttles[operation] += 1
+
+    def add_retry(self, operation):
+        with self.lock:
+            self.retries[operation] += 1
+
+    def as_dict(self):
+        operations = OrderedDict()
+        for operation in sorted(self.calls):
+            buckets = OrderedDict()
+            total = 0
+            for bound, count in zip(LATENCY_BUCKETS,
+                                    self.latency_buckets[operation]):
+                total += count
+                buckets[get_bound_label(bound)] = total
+            operations[operation] = OrderedDict([
+                ('calls', self.calls[operation]),
+                ('errors', self.errors[operation]),
+                ('retries', self.retries[operation]),
+                ('throttles', self.throttles[operation]),
+                ('bytes_received', self.bytes_received[operation]),
+                ('latency_seconds', OrderedDict([
+                    ('sum', self.latency_sums[operation]),
+                    ('buckets', buckets),
+                ])),
+            ])
+        phases = OrderedDict()
+        for name in sorted(self.phases):
+            phases[name] = OrderedDict([
+                ('seconds', self.phases[name]),
+                ('calls', self.phase_calls[name]),
+            ])
+        return OrderedDict([('phases', phases), ('operations', operations)])
+
+    def write_json(self, filename):
+        write_atomic(filename, json.dumps(self.as_dict(), indent=2))
+
+    def write_prometheus(self, filename):
+        # node_exporter reads every *.prom file in its textfile directory,
+        # so the file is replaced in one step and never seen half written.
+        data = self.as_dict()
+        lines = []
+        add_metric(lines, 'phase_seconds', 'gauge',
+                   'Wall time spent in each pipeline phase.',
+                   [({'phase': name}, phase['seconds'])
+                    for name, phase in data['phases'].items()])
+        operations = data['operations']
+        for key, kind, description in (
+                ('calls', 'api_calls_total', 'EC2 calls made.'),
+                ('errors', 'api_errors_total', 'EC2 calls that failed.'),
+                ('retries', 'api_retries_total',
+                 'EC2 calls retried after a throttle or transient error.'),
+                ('throttles', 'api_throttles_total',
+                 'Throttled EC2 responses.'),
+                ('bytes_received', 'api_bytes_received_total',
+                 'Response bytes received.')):
+            add_metric(lines, kind, 'counter', description,
+                       [({'operation': operation}, values[key])
+                        for operation, values in operations.items()])
+
+        name = PROMETHEUS_PREFIX + 'api_latency_seconds'
+        lines.append('# HELP ' + name + ' EC2 call latency.')
+        lines.append('# TYPE ' + name + ' histogram')
+        for operation, values in operations.items():
+            latency = values['latency_seconds']
+            for bound, count in latency['buckets'].items():
+                lines.append(name + '_bucket' + get_labels(
+                    {'operation': operation, 'le': bound}) + ' ' + str(count))
+            lines.append(name + '_sum' + get_labels(
+                {'operation': operation}) + ' ' + repr(latency['sum']))
+            lines.append(name + '_count' + get_labels(
+                {'operation': operation}) + ' ' + str(values['calls']))
+        write_atomic(filename, '\n'.join(lines) + '\n')
+
+
+def get_error_code(error):
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code')
+
+
+def get_bound_label(bound):
+    if bound == float('inf'):
+        return '+Inf'
+    return repr(bound)
+
+
+def get_labels(labels):
+    return '{' + ','.join(key + '="' + str(value) + '"'
+                          for key, value in sorted(labels.items())) + '}'
+
+
+def add_metric(lines, name, kind, description, samples):
+    name = PROMETHEUS_PREFIX + name
+    lines.append('# HELP ' + name + ' ' + description)
+    lines.append('# TYPE ' + name + ' ' + kind)
+    for labels, value in samples:
+        lines.append(name + get_labels(labels) + ' ' + repr(value))
+
+
+def write_atomic(filename, data):
+    tmp_filename = filename + '.' + str(os.getpid())
+    with open(tmp_filename, 'w') as f:
+        f.write(data)
+    os.replace(tmp_filename, filename)
+
+
+@contextlib.contextmanager
+def activate(metrics):
+    # Phases timed anywhere in the process while this is open are added to
+    # metrics. Passing None is allowed and records nothing.
+    if metrics is None or metrics in active:
+        yield
+        return
+    active.append(metrics)
+    try:
+        yield
+    finally:
+        active.remove(metrics)
+
+
+def add_retry(operation):
+    # Records a call throttle.py retries.
+    for metrics in active:
+        metrics.add_retry(operation)
+
+
+@contextlib.contextmanager
+def phase(name):
+    if not active:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        for metrics in active:
+            metrics.add_phase(name, seconds)
+
+
+class MeteredClient(object):
+    # Wraps an EC2 client and records every describe, purchase and modify
+    # call in metrics. botocore's retries are off (see throttle.py), so
+    # each call is one attempt and a throttled attempt surfaces as an error.
+    # Use get_metered_session to meter inside the throttling layer, where
+    # each retry is a call of its own and backoff sleeps are not timed.
+
+    def __init__(self, client, metrics):
+        self.client = client
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        if not name.startswith(METERED_PREFIXES):
+            return method
+
+        def call(**kwargs):
+            start = time.perf_counter()
+            try:
+                response = method(**kwargs)
+            except Exception as e:
+                self.metrics.add_call(name, time.perf_counter() - start,
+                                      error=e)
+                raise
+            self.metrics.add_call(name, time.perf_counter() - start, response)
+            return response
+        return call
+
+    def close(self):
+        close = getattr(self.client, 'close', None)
+        if close:
+            close()
+
+
+class MeteredSession(object):
+    # A session whose clients are all MeteredClients.
+
+    def __init__(self, session, metrics):
+        self.session = session
+        self.metrics = metrics
+
+    def client(self, service_name, region_name=None, **kwargs):
+        return MeteredClient(self.session.client(service_name, region_name,
+                                                 **kwargs), self.metrics)
+
+
+def get_metered_session(session, metrics):
+    # Meters the clients of session. A throttled session is metered from
+    # inside, so every attempt it makes is recorded.
+    wrap = getattr(session, 'wrap', None)
+    if wrap is not None:
+        return wrap(lambda inner: MeteredSession(inner, metrics))
+    return MeteredSession(session, metrics)
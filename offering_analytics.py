@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from helpers import *
+
+
+def analyze_offerings_by_class(offerings_by_class):
+    # Columnar version of analyze_offerings for many instance classes at
+    # once. Offerings from every class are loaded into flat arrays, derived
+    # costs are computed in one vectorized pass and the standard baselines
+    # are found with a group-by on (class, duration, offering type). Each
+    # class gets the same ranked list back as analyze_offerings would give.
+    classes = list(offerings_by_class)
+    offerings = []
+    class_ids = []
+    for class_id, instance_class in enumerate(classes):
+        for offering in offerings_by_class[instance_class]:
+            recurring = offering['RecurringCharges']
+            if len(recurring) == 0:
+                offering['RecurringCharges'] = [{'Frequency': 'Hourly',
+                                                 'Amount': 0.0}]
+                recurring = offering['RecurringCharges']
+            if len(recurring) != 1:
+                raise Exception('Unexpected recurring charges format')
+            elif recurring[0]['Frequency'] != 'Hourly':
+                raise Exception('Non-hourly recurring frequency not supported')
+            offerings.append(offering)
+            class_ids.append(class_id)
+    if not offerings:
+        return dict((instance_class, analyze_offerings([]))
+                    for instance_class in classes)
+
+    class_ids = np.array(class_ids)
+    duration = np.array([o['Duration'] for o in offerings], dtype=float)
+    upfront = np.array([o['FixedPrice'] for o in offerings], dtype=float)
+    hourly = np.array([o['RecurringCharges'][0]['Amount'] for o in offerings],
+                      dtype=float)
+    marketplace = np.array([o['Marketplace'] for o in offerings], dtype=bool)
+    type_codes = {}
+    type_ids = np.array([type_codes.setdefault(o['OfferingType'],
+                                               len(type_codes))
+                         for o in offerings])
+
+    hours = duration / SECONDS_IN_HOUR
+    if np.any(hours > HOURS_IN_3_YEARS):
+        raise Exception('Only 1 and 3 year reservations supported')
+    total_cost = upfront + hours * hourly
+    effective_hourly = total_cost / hours
+    one_year = hours <= HOURS_IN_YEAR
+    std_mult = np.where(one_year, HOURS_IN_YEAR / hours,
+                        HOURS_IN_3_YEARS / hours)
+    comparable_duration = np.where(one_year, HOURS_IN_YEAR * SECONDS_IN_HOUR,
+                                   HOURS_IN_3_YEARS * SECONDS_IN_HOUR)
+    comparable_upfront = std_mult * upfront
+    comparable_total_cost = std_mult * total_cost
+    fraction_of_comparable = 1.0 / std_mult
+
+    # Group standard offerings by (class, duration, type). Like the dict in
+    # analyze_offerings, the last standard offering of a group wins.
+    durations, duration_ids = np.unique(
+        np.concatenate([duration, comparable_duration]), return_inverse=True)
+    own_duration_ids = duration_ids[:len(offerings)]
+    comparable_duration_ids = duration_ids[len(offerings):]
+    group_size = len(durations) * len(type_codes)
+
+    def group_key(class_id, duration_id, type_id):
+        return class_id * group_size + duration_id * len(type_codes) + type_id
+
+    std_keys = group_key(class_ids, own_duration_ids, type_ids)
+    comparable_keys = group_key(class_ids, comparable_duration_ids, type_ids)
+    std_index = np.full(len(classes) * group_size, -1)
+    rows = np.arange(len(offerings))
+    np.maximum.at(std_index, std_keys[~marketplace], rows[~marketplace])
+
+    std = std_index[comparable_keys]
+    has_std = std >= 0
+    std = np.where(has_std, std, 0)
+    std_upfront = upfront[std]
+    std_effective_hourly = effective_hourly[std]
+    std_total_cost = total_cost[std]
+    savings = std_total_cost * fraction_of_comparable - total_cost
+
+    pref_type = RESERVATION_PREFERENCES['OfferingType']
+    preferred = (
+        has_std &
+        marketplace &
+        (hours < RESERVATION_PREFERENCES['Hours']) &
+        (type_ids == type_codes.get(pref_type, -1)) &
+        (upfront < std_upfront) &
+        (comparable_upfront < std_upfront * 1.1) &
+        (comparable_total_cost <= std_total_cost * 1.1)
+    )
+    amazing_deal = has_std & (comparable_total_cost < std_total_cost * 0.2)
+
+    pref_seconds = int(RESERVATION_PREFERENCES['Seconds'])
+    pref_type_id = type_codes.get(pref_type)
+    pref_duration_ids = np.flatnonzero(durations == pref_seconds)
+    pref_std = np.full(len(classes), -1)
+    if pref_type_id is not None and len(pref_duration_ids):
+        pref_std = std_index[group_key(np.arange(len(classes)),
+                                       pref_duration_ids[0], pref_type_id)]
+
+    # Only the offerings that are returned get their derived fields written
+    # back, which keeps the per-row Python work proportional to the output.
+    selected = np.flatnonzero(preferred | amazing_deal)
+    returned = np.union1d(selected, pref_std[pref_std >= 0])
+    names = ['Hours', 'TotalCost', 'ComparableTotalCost', 'EffectiveHourly',
+             'ComparableUpfront', 'ComparableDuration', 'FractionOfComparable',
+             'StdUpfront', 'StdEffectiveHourly', 'StdTotalCost', 'Savings']
+    columns = [hours, total_cost, comparable_total_cost, effective_hourly,
+               comparable_upfront, comparable_duration, fraction_of_comparable,
+               std_upfront, std_effective_hourly, std_total_cost, savings]
+    for i, values in zip(returned.tolist(),
+                         zip(*[column[returned].tolist()
+                               for column in columns])):
+        offerings[i].update(zip(names, values))
+    for i in np.flatnonzero(amazing_deal).tolist():
+        offerings[i]['AmazingDeal'] = True
+    for i in range(len(offerings) - int(np.count_nonzero(has_std))):
+        print('Skipping old-style light, medium, heavy 3rd-party offering.')
+
+    ret = dict((instance_class, []) for instance_class in classes)
+    for i, class_id in zip(selected.tolist(), class_ids[selected].tolist()):
+        ret[classes[class_id]].append(offerings[i])
+    for class_id, instance_class in enumerate(classes):
+        if pref_std[class_id] < 0:
+            raise KeyError((pref_seconds, pref_type))
+        good = sorted(ret[instance_class], key=lambda x: x['Savings'],
+                      reverse=True)
+        good.append(offerings[pref_std[class_id]])
+        ret[instance_class] = good
+    return ret
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from functools import reduce
+from math import gcd
+import time
+
+from helpers import *
+
+PACKING_TIME_BUDGET = 5.0
+
+
+def get_packing_group(i_type, platform):
+    # Modifications can move any reservation to another zone, but only
+    # Linux/UNIX reservations can change size within their family.
+    platform = normalize_platform(platform)
+    if platform == LINUX_PLATFORM:
+        return i_type.split('.')[0], platform
+    return i_type, platform
+
+
+def pack_reservations(reservations, instances, time_budget=PACKING_TIME_BUDGET):
+    # Assigns the unused units of each reservation to unreserved instances of
+    # any size in the same group, maximizing the units covered. Reservations
+    # are packed largest first with an exact subset-sum search over the
+    # remaining instance classes. Once time_budget seconds have passed the
+    # remaining reservations are packed greedily. Regional reservations
+    # already apply in every zone, and to every size when size-flexible, so
+    # they are left to matching.
+    classes_by_group = {}
+    instances_by_class = {}
+    for instance in instances:
+        units = instance.units
+        if units is None:
+            continue
+        group = get_packing_group(instance.type, instance.platform)
+        classes = classes_by_group.setdefault(group, OrderedDict())
+        cls = (instance.type, instance.zone, units)
+        classes[cls] = classes.get(cls, 0) + 1
+        instances_by_class.setdefault((group, cls), []).append(instance)
+
+    def take(group, cls, count):
+        members = instances_by_class[group, cls]
+        taken = members[:count]
+        del members[:count]
+        return taken
+
+    return pack_classes(reservations, classes_by_group, time_budget, take)
+
+
+def pack_class_counts(reservations, class_counts,
+                      time_budget=PACKING_TIME_BUDGET):
+    # Like pack_reservations for instances that are only counted, such as a
+    # planned fleet. class_counts maps (type, zone, platform) to a number of
+    # instances and assignments have no 'instances'.
+    classes_by_group = {}
+    for (i_type, zone, platform), count in class_counts.items():
+        units = get_scaled_units(i_type)
+        if units is None or count <= 0:
+            continue
+        group = get_packing_group(i_type, platform)
+        classes = classes_by_group.setdefault(group, OrderedDict())
+        cls = (i_type, zone, units)
+        classes[cls] = classes.get(cls, 0) + count
+    return pack_classes(reservations, classes_by_group, time_budget)
+
+
+def pack_classes(reservations, classes_by_group, time_budget, take=None):
+    # classes_by_group maps packing groups to the number of instances of each
+    # (type, zone, units) class. take(group, cls, count) returns the
+    # instances an assignment covers.
+    deadline = time.time() + time_budget
+
+    packable = []
+    for reservation in reservations:
+        r_units = reservation.units
+        group = get_packing_group(reservation.type, reservation.platform)
+        if r_units is None or reservation.zone is None or \
+                group not in classes_by_group:
+            continue
+        capacity = r_units * reservation.unused_count
+        if capacity > 0:
+            packable.append((capacity, reservation, group))
+    packable.sort(key=lambda x: -x[0])
+
+    suggestions = []
+    for capacity, reservation, group in packable:
+        classes = classes_by_group[group]
+        items = [(cls, cls[2], classes[cls])
+                 for cls in classes if classes[cls]]
+        counts = pack_greedy(items, capacity)
+        if packed_units(items, counts) < capacity and time.time() < deadline:
+            counts = pack_exact(items, capacity)
+        covered = packed_units(items, counts)
+        if covered == 0:
+            continue
+
+        assignments = []
+        r_zone = reservation.zone
+        for (cls, units, available), count in zip(items, counts):
+            if count == 0:
+                continue
+            i_type, i_zone = cls[:2]
+            assignment = OrderedDict([
+                ('instance_type', i_type),
+                ('instance_zone', i_zone),
+                ('same_zone', i_zone == r_zone),
+                ('instance_count', count),
+                ('instance_units', units * count / float(UNIT_SCALE)),
+            ])
+            if take is not None:
+                assignment['instances'] = take(group, cls, count)
+            assignments.append(assignment)
+            classes[cls] -= count
+
+        suggestions.append(OrderedDict([
+            ('reservation', reservation),
+            ('reservation_type', reservation.type),
+            ('reservation_zone', r_zone),
+            ('reserved_units', capacity / float(UNIT_SCALE)),
+            ('instance_units', covered / float(UNIT_SCALE)),
+            ('utilization', covered / float(capacity)),
+            ('assignments', assignments),
+        ]))
+
+    suggestions.sort(key=lambda x: -x['utilization'])
+    return suggestions
+
+
+def packed_units(items, counts):
+    return sum(units * count for (cls, units, available), count
+               in zip(items, counts))
+
+
+def pack_greedy(items, capacity):
+    # First fit decreasing: take as many of the largest instances as fit.
+    counts = [0] * len(items)
+    remaining = capacity
+    order = sorted(range(len(items)), key=lambda i: -items[i][1])
+    for i in order:
+        cls, units, available = items[i]
+        count = min(available, remaining // units)
+        counts[i] = count
+        remaining -= count * units
+    return counts
+
+
+def pack_exact(items, capacity):
+    # Bounded subset sum over instance units using Python ints as bitsets.
+    # Each class is split into binary pieces (1, 2, 4, ... instances) so a
+    # class with n instances only adds log(n) stages. Bit k of a stage's
+    # bitset is set when k units can be covered exactly. Units are divided by
+    # their greatest common divisor first to keep the bitsets short.
+    scale = reduce(gcd, (units for cls, units, available in items), 0) or 1
+    capacity //= scale
+    mask = (1 << (capacity + 1)) - 1
+    pieces = []
+    for i, (cls, units, available) in enumerate(items):
+        units //= scale
+        available = min(available, capacity // units)
+        piece = 1
+        while available > 0:
+            count = min(piece, available)
+            pieces.append((i, count, units * count))
+            available -= count
+            piece *= 2
+
+    reachable = [1]
+    for i, count, weight in pieces:
+        reachable.append((reachable[-1] | (reachable[-1] << weight)) & mask)
+
+    best = reachable[-1].bit_length() - 1
+    counts = [0] * len(items)
+    for stage in range(len(pieces), 0, -1):
+        if not (reachable[stage - 1] >> best) & 1:
+            i, count, weight = pieces[stage - 1]
+            counts[i] += count
+            best -= weight
+    return counts
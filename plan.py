@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# Purchase plans. Instead of prompting once per instance, the report's
+# suggestions are written to a plan file that buys each offering once with
+# the number of instances that need it. The file can be reviewed and edited
+# (drop items, change counts) and is then executed in one go. Each item's
+# status is written back to the file as it is bought, so executing a plan
+# again only buys what is left.
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import json
+import threading
+
+from helpers import *
+from metrics import THROTTLE_CODES, get_error_code, write_atomic
+
+PLAN_FILE = 'purchase_plan.json'
+PURCHASE_WORKERS = 4
+STATUS_PENDING = 'pending'
+STATUS_PURCHASING = 'purchasing'
+STATUS_PURCHASED = 'purchased'
+STATUS_FAILED = 'failed'
+DRY_RUN_CODE = 'DryRunOperation'
+
+
+def get_plan_items(report, rank=0, region=None):
+    # Buys the offering at rank in each instance's suggestions, one item per
+    # offering.
+    items = OrderedDict()
+    for instance, rows in report.items('suggested_reservations'):
+        if len(rows) <= rank:
+            continue
+        row = rows[rank]
+        item = items.get(row['offering_id'])
+        if item is None:
+            item = OrderedDict([
+                ('region', region),
+                ('offering_id', row['offering_id']),
+                ('instance_type', row['instance_type']),
+                ('zone', row['zone']),
+                ('platform', row['platform']),
+                ('offering_type', row['offering_type']),
+                ('marketplace', row['marketplace']),
+                ('years', row['years']),
+                ('upfront', row['upfront']),
+                ('count', 0),
+                ('instance_ids', []),
+                ('status', STATUS_PENDING),
+            ])
+            items[row['offering_id']] = item
+        item['count'] += 1
+        item['instance_ids'].append(instance.id)
+    return list(items.values())
+
+
+class PlanWriter(object):
+    # Writes the plan of every report it is given, such as one per region,
+    # to a single file.
+
+    def __init__(self, filename=PLAN_FILE, rank=0):
+        self.filename = filename
+        self.rank = rank
+        self.plan = OrderedDict([
+            ('created', datetime.now(timezone.utc).isoformat()),
+            ('items', []),
+        ])
+
+    def write(self, report, buy=None):
+        labelled_reports = getattr(report, 'labelled_reports', None) or \
+            [(report.labels, report)]
+        for labels, labelled in labelled_reports:
+            self.plan['items'] += get_plan_items(labelled, self.rank,
+                                                 labels.get('region'))
+        save_plan(self.plan, self.filename)
+        print('purchase plan written to ' + self.filename)
+
+
+def load_plan(filename):
+    with open(filename) as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
+
+
+def save_plan(plan, filename):
+    write_atomic(filename, json.dumps(plan, indent=2))
+
+
+def get_limit_price(item):
+    # The most the whole purchase may cost upfront.
+    return item['upfront'] * item['count']
+
+
+def is_rejected(error):
+    # Whether EC2 answered that it did not make the purchase: a throttle, or
+    # another client error. Server and connection errors, and anything else,
+    # may come from a purchase that went through.
+    code = get_error_code(error)
+    if code is None:
+        return False
+    if code in THROTTLE_CODES:
+        return True
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return status is not None and 400 <= status < 500
+
+
+def print_plan(plan):
+    print('Purchase plan -----------------------------------------------')
+    total = 0
+    for i, item in enumerate(plan['items']):
+        print(str(i) + ') ' + str(item['count']) + ' x ' +
+              item['instance_type'] + ' ' + str(item['zone']) + ' ' +
+              item['platform'] + ' ' + item['offering_type'] +
+              (' (marketplace)' if item['marketplace'] else '') + ' ' +
+              str(item['years']) + ' years: ' + item['status'])
+        print('  offering:                  ' + item['offering_id'])
+        print('  upfront:                   ' +
+              format_currency(get_limit_price(item)))
+        if item['status'] != STATUS_PURCHASED:
+            total += get_limit_price(item)
+    print()
+    print('Upfront left to pay: ' + format_currency(total))
+
+
+def execute_plan(plan, filename, session=None, dry_run=False):
+    # Buys every item that is not bought yet, a few at a time. With dry_run
+    # EC2 only checks each purchase would be allowed and nothing is written.
+    # An item left 'purchasing' by an interrupted run, or by an error EC2
+    # did not answer with a rejection, may or may not have been bought, so
+    # the plan is refused until it has been checked and its status set by
+    # hand.
+    unknown = [item['offering_id'] for item in plan['items']
+               if item['status'] == STATUS_PURCHASING]
+    if unknown:
+        raise Exception('Purchases of ' + ', '.join(unknown) + ' may or may '
+                        'not have gone through. Check the reservations in '
+                        'EC2 and set their status to purchased or pending.')
+    session = get_session(session)
+    clients = {}
+    for item in plan['items']:
+        region = item['region'] or DEFAULT_REGION
+        if region not in clients:
+            clients[region] = session.client('ec2', region)
+    lock = threading.Lock()
+
+    def set_status(item, status, clear=(), **fields):
+        # Items are only changed under the lock, as the whole plan is
+        # written out while holding it.
+        with lock:
+            item['status'] = status
+            for key in clear:
+                item.pop(key, None)
+            item.update(fields)
+            if not dry_run:
+                save_plan(plan, filename)
+
+    def purchase(item):
+        client = clients[item['region'] or DEFAULT_REGION]
+        if not dry_run:
+            set_status(item, STATUS_PURCHASING, clear=('error',),
+                       started=datetime.now(timezone.utc).isoformat())
+        try:
+            response = purchase_reserved_instance(
+                item['offering_id'], client, item['count'],
+                get_limit_price(item), dry_run)
+        except Exception as e:
+            if dry_run and get_error_code(e) == DRY_RUN_CODE:
+                print('would buy ' + str(item['count']) + ' x ' +
+                      item['offering_id'])
+                return
+            print('Problem buying ' + item['offering_id'] + ': ' + str(e))
+            if dry_run:
+                return
+            if is_rejected(e):
+                set_status(item, STATUS_FAILED, error=str(e))
+            else:
+                # Left purchasing so the plan is refused until it has been
+                # checked, see above.
+                set_status(item, STATUS_PURCHASING, error=str(e))
+                print(item['offering_id'] + ' may have been bought, check '
+                      'the reservations in EC2 and set its status by hand.')
+            return
+        set_status(item, STATUS_PURCHASED,
+                   reserved_instances_id=response['ReservedInstancesId'])
+        print('bought ' + str(item['count']) + ' x ' + item['offering_id'] +
+              ': ' + response['ReservedInstancesId'])
+
+    items = [item for item in plan['items']
+             if item['status'] != STATUS_PURCHASED and item['count'] > 0]
+    with ThreadPoolExecutor(max_workers=PURCHASE_WORKERS) as pool:
+        list(pool.map(purchase, items))
+    return plan
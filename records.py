@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Compact records for the instances and reservations benjamin keeps around.
+# Only the fields the analysis uses are copied out of the describe responses,
+# units are integers (see helpers.UNIT_SCALE), and strings shared by many
+# records (types, zones, platforms, VPCs and security group lists) are
+# interned so each distinct value is stored once.
+import sys
+
+interned_groups = {}
+
+
+def intern_optional(value):
+    if value is None:
+        return None
+    return sys.intern(value)
+
+
+def intern_groups(groups):
+    groups = tuple(groups)
+    return interned_groups.setdefault(groups, groups)
+
+
+def clear_interned_groups():
+    # interned_groups never evicts on its own, so long-running callers clear
+    # it whenever they rebuild their records. Records made before keep their
+    # tuples, which still compare equal to the new ones.
+    interned_groups.clear()
+
+
+class InstanceRecord(object):
+    __slots__ = ('id', 'type', 'family', 'units', 'zone', 'platform', 'vpc',
+                 'name', 'groups')
+
+    def __init__(self, id, type, family, units, zone, platform, vpc=None,
+                 name=None, groups=()):
+        self.id = id
+        self.type = sys.intern(type)
+        self.family = sys.intern(family)
+        self.units = units
+        self.zone = sys.intern(zone)
+        self.platform = sys.intern(platform)
+        self.vpc = intern_optional(vpc)
+        self.name = name
+        self.groups = intern_groups(groups)
+
+    def __repr__(self):
+        return 'InstanceRecord(' + self.id + ', ' + self.type + ', ' + \
+            self.zone + ', ' + self.platform + ')'
+
+
+class ReservationRecord(object):
+    # zone is None for regional reservations and flexible is set when they
+    # apply to any size in their family. used_count and used_units are
+    # filled in by matching and unused_count by get_unused_reservations.
+    __slots__ = ('id', 'type', 'family', 'units', 'zone', 'platform', 'count',
+                 'state', 'flexible', 'used_count', 'used_units',
+                 'unused_count')
+
+    def __init__(self, id, type, family, units, zone, platform, count, state,
+                 flexible=False):
+        self.id = id
+        self.type = sys.intern(type)
+        self.family = sys.intern(family)
+        self.units = units
+        self.zone = intern_optional(zone)
+        self.platform = sys.intern(platform)
+        self.count = count
+        self.state = sys.intern(state)
+        self.flexible = flexible
+        self.used_count = 0
+        self.used_units = 0
+        self.unused_count = count
+
+    def __repr__(self):
+        return 'ReservationRecord(' + self.id + ', ' + self.type + ', ' + \
+            str(self.zone) + ', ' + self.platform + ', ' + str(self.count) + \
+            ')'
@@ -0,0 +1,710 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+import csv
+import io
+import json
+import os
+import sys
+
+from helpers import *
+
+SECTIONS = [
+    'instance_class_counts',
+    'utilized',
+    'unreserved',
+    'unused_reservations',
+    'coverage',
+    'naive_changes',
+    'type_changes',
+    'suggested_reservations',
+    'summary',
+]
+# Lines the text writer collects before writing them out.
+TEXT_CHUNK_LINES = 65536
+ARROW_BATCH_ROWS = 65536
+FILE_BUFFER_BYTES = 1024 * 1024
+UNRESERVED_CSV = 'unreserved_instances.csv'
+
+
+class Report(object):
+    # The result of one make_recommendations run. Each section keeps the
+    # records it was computed from, and flat rows are only built while a
+    # writer iterates over rows(section), so large fleets are never held in
+    # memory twice. Offering rows are built once per instance class and
+    # shared by every instance of that class.
+
+    def __init__(self):
+        self.sections = OrderedDict((section, []) for section in SECTIONS)
+        self.labels = OrderedDict()
+
+    def add(self, section, item):
+        self.sections[section].append(item)
+
+    def items(self, section):
+        return self.sections[section]
+
+    def rows(self, section):
+        get_rows = ROW_GETTERS[section]
+        for item in self.sections[section]:
+            for row in get_rows(item):
+                yield row
+
+
+class MergedReport(object):
+    # Several reports behind the Report interface, such as one per account
+    # and region. Rows are prefixed with the labels of the report they came
+    # from and the summary is summed.
+
+    def __init__(self, labelled_reports):
+        self.labelled_reports = labelled_reports
+        summary = OrderedDict([('total_upfront', 0), ('total_savings', 0)])
+        for labels, report in labelled_reports:
+            for row in report.items('summary'):
+                for key in summary:
+                    summary[key] += row[key]
+        self.summary = [summary]
+
+    def items(self, section):
+        # Items carry no labels. Writers that need to tell reports apart use
+        # rows(), or labelled_reports as TextWriter does.
+        if section == 'summary':
+            return self.summary
+        return [item for labels, report in self.labelled_reports
+                for item in report.items(section)]
+
+    def rows(self, section):
+        if section == 'summary':
+            for row in self.summary:
+                yield row
+            return
+        for labels, report in self.labelled_reports:
+            for row in report.rows(section):
+                labelled = OrderedDict(labels)
+                labelled.update(row)
+                yield labelled
+
+
+def merge_reports(labelled_reports):
+    return MergedReport(labelled_reports)
+
+
+def build_report(instance_class_counts, matches, unreserved_instances,
+                 unused_reservations, naive_changes, type_changes,
+                 suggested_reservations):
+    report = Report()
+
+    for klass in sorted(instance_class_counts, key=instance_class_counts.get,
+                        reverse=True):
+        report.add('instance_class_counts',
+                   (klass, instance_class_counts[klass]))
+
+    for match in matches:
+        report.add('utilized', match)
+
+    report.sections['unreserved'] = sorted(unreserved_instances,
+                                           key=lambda x: x.type)
+    report.sections['unused_reservations'] = list(unused_reservations)
+    report.sections['coverage'] = get_unit_coverage(
+        matches, unreserved_instances, unused_reservations)
+    report.sections['naive_changes'] = list(naive_changes)
+    report.sections['type_changes'] = list(type_changes)
+
+    total_upfront = 0
+    total_savings = 0
+    offering_rows = {}
+    for instance, offerings in suggested_reservations:
+        rows = offering_rows.get(id(offerings))
+        if rows is None:
+            rows = [get_offering_row(offering) for offering in offerings]
+            offering_rows[id(offerings)] = rows
+        for row in rows:
+            total_upfront += row['upfront']
+            total_savings += row['savings']
+        report.add('suggested_reservations', (instance, rows))
+
+    report.add('summary', OrderedDict([
+        ('total_upfront', total_upfront),
+        ('total_savings', total_savings),
+    ]))
+    return report
+
+
+def get_instance_row(instance):
+    return OrderedDict([
+        ('instance_id', instance.id),
+        ('instance_type', instance.type),
+        ('zone', instance.zone),
+        ('platform', instance.platform),
+        ('name', instance.name),
+        ('security_groups', list(instance.groups)),
+        ('vpc', instance.vpc or 'non-vpc'),
+    ])
+
+
+def get_offering_row(offering):
+    return OrderedDict([
+        ('offering_id', offering['ReservedInstancesOfferingId']),
+        ('instance_type', offering['InstanceType']),
+        ('zone', offering['AvailabilityZone']),
+        ('platform', offering['ProductDescription']),
+        ('offering_type', offering['OfferingType']),
+        ('marketplace', offering['Marketplace']),
+        ('upfront', offering['FixedPrice']),
+        ('total_cost', offering['TotalCost']),
+        ('effective_hourly', offering['EffectiveHourly']),
+        ('comparable_total_cost', offering['ComparableTotalCost']),
+        ('comparable_upfront', offering['ComparableUpfront']),
+        ('std_total_cost', offering['StdTotalCost']),
+        ('std_effective_hourly', offering['StdEffectiveHourly']),
+        ('savings', offering['Savings']),
+        ('years', offering['Hours'] / HOURS_IN_YEAR),
+        ('amazing_deal', offering.get('AmazingDeal', False)),
+    ])
+
+
+def get_class_count_rows(item):
+    (i_type, zone, platform), count = item
+    yield OrderedDict([
+        ('count', count),
+        ('instance_type', i_type),
+        ('zone', zone),
+        ('platform', platform),
+    ])
+
+
+def get_utilized_rows(item):
+    instance, reservation = item
+    row = OrderedDict([
+        ('reservation_id', reservation.id),
+        ('reservation_type', reservation.type),
+        ('reservation_zone', reservation.zone),
+        ('reservation_platform', get_account_agnostic_platform(
+            reservation.platform)),
+    ])
+    row.update(get_instance_row(instance))
+    yield row
+
+
+def get_unreserved_rows(instance):
+    yield get_instance_row(instance)
+
+
+def get_unused_reservation_rows(reservation):
+    yield OrderedDict([
+        ('reservation_id', reservation.id),
+        ('instance_type', reservation.type),
+        ('zone', reservation.zone),
+        ('platform', reservation.platform),
+        ('unused_count', reservation.unused_count),
+    ])
+
+
+def get_coverage_rows(row):
+    yield row
+
+
+def get_naive_change_rows(change):
+    yield OrderedDict([
+        ('reservation_id', change['reservation'].id),
+        ('change', change['change']),
+        ('reservation_type', change['reservation_type']),
+        ('reservation_zone', change['reservation_zone']),
+        ('instance_type', change['instance_type']),
+        ('instance_zone', change['instance_zone']),
+        ('instance_count', change['instance_count']),
+    ])
+
+
+def get_type_change_rows(suggestion):
+    for assignment in suggestion['assignments']:
+        yield OrderedDict([
+            ('reservation_id', suggestion['reservation'].id),
+            ('reservation_type', suggestion['reservation_type']),
+            ('reservation_zone', suggestion['reservation_zone']),
+            ('reserved_units', suggestion['reserved_units']),
+            ('utilization', suggestion['utilization']),
+            ('instance_type', assignment['instance_type']),
+            ('instance_zone', assignment['instance_zone']),
+            ('same_zone', assignment['same_zone']),
+            ('instance_count', assignment['instance_count']),
+            ('instance_ids', [instance.id
+                              for instance in assignment['instances']]),
+        ])
+
+
+def get_suggested_reservation_rows(item):
+    instance, offering_rows = item
+    for i, offering_row in enumerate(offering_rows):
+        row = OrderedDict([('instance_id', instance.id), ('rank', i)])
+        row.update(offering_row)
+        yield row
+
+
+def get_summary_rows(row):
+    yield row
+
+
+ROW_GETTERS = {
+    'instance_class_counts': get_class_count_rows,
+    'utilized': get_utilized_rows,
+    'unreserved': get_unreserved_rows,
+    'unused_reservations': get_unused_reservation_rows,
+    'coverage': get_coverage_rows,
+    'naive_changes': get_naive_change_rows,
+    'type_changes': get_type_change_rows,
+    'suggested_reservations': get_suggested_reservation_rows,
+    'summary': get_summary_rows,
+}
+
+
+class TextWriter(object):
+    # Renders the console report. Lines are collected and written
+    # TEXT_CHUNK_LINES at a time, or once per suggested instance when a buy
+    # callback needs to prompt in between. sections limits the output to
+    # some of SECTIONS. A merged report is rendered one labelled report at a
+    # time, each under a header with its labels, followed by the summed
+    # summary.
+
+    def __init__(self, stream=None, sections=SECTIONS):
+        self.stream = stream or sys.stdout
+        self.sections = sections
+        self.descriptions = {}
+
+    def write(self, report, buy=None):
+        lines = []
+        labelled_reports = getattr(report, 'labelled_reports', None)
+        if labelled_reports is None:
+            self.write_sections(report, self.sections, lines, buy)
+        else:
+            sections = [section for section in self.sections
+                        if section != 'summary']
+            for labels, labelled in labelled_reports:
+                lines.append('')
+                lines.append(get_label_header(labels))
+                self.write_sections(labelled, sections, lines, buy)
+            if 'summary' in self.sections:
+                self.write_summary(report, lines, buy)
+        self.flush(lines)
+
+    def write_sections(self, report, sections, lines, buy):
+        for section in sections:
+            getattr(self, 'write_' + section)(report, lines, buy)
+
+    def write_instance_class_counts(self, report, lines, buy):
+        lines.append('')
+        lines.append('Instance class counts --------------------------------------------')
+        for klass, count in report.items('instance_class_counts'):
+            lines.append(str(count) + str(klass) + ' ')
+
+    def write_utilized(self, report, lines, buy):
+        lines.append('')
+        lines.append('Utilized reserved instances --------------------------------------')
+        for instance, reservation in report.items('utilized'):
+            lines.append(str((reservation.type, reservation.zone,
+                              get_account_agnostic_platform(
+                                  reservation.platform))) +
+                         ' reservation is utilized by instance: ' +
+                         instance.id + ' ' + self.describe(instance))
+            self.check(lines)
+
+    def write_unreserved(self, report, lines, buy):
+        lines.append('')
+        lines.append('Unreserved instances ----------------------------------------------')
+        for instance in report.items('unreserved'):
+            lines.append(' '.join(str(x) for x in
+                                  get_unreserved_csv_row(instance)))
+            self.check(lines)
+
+    def write_unused_reservations(self, report, lines, buy):
+        lines.append('')
+        lines.append('Unused reservations -----------------------------------------------')
+        for reservation in report.items('unused_reservations'):
+            lines.append(str((reservation.type, reservation.zone,
+                              reservation.platform, reservation.id)) +
+                         ' has ' + str(reservation.unused_count) +
+                         ' unused instance(s)!')
+
+    def write_coverage(self, report, lines, buy):
+        lines.append('')
+        lines.append('Reserved units by family ------------------------------------------')
+        for row in report.items('coverage'):
+            lines.append(row['family'] + ': ' + str(row['covered_units']) +
+                         ' of ' + str(row['instance_units']) +
+                         ' units reserved (' +
+                         str(round(row['coverage'] * 100, 1)) + '%), ' +
+                         str(row['unused_units']) + ' of ' +
+                         str(row['reserved_units']) +
+                         ' reserved units unused')
+
+    def write_naive_changes(self, report, lines, buy):
+        lines.append('')
+        lines.append('Naive recommended reservation changes -----------------------------')
+        for change in report.items('naive_changes'):
+            r_id = change['reservation'].id
+            count = str(change['instance_count']) + ' instance(s)'
+            if change['change'] == NAIVE_CHANGE_ZONE:
+                lines.append('Change reservation: ' + r_id +
+                             ' ZONE CHANGE ONLY - to availability zone ' +
+                             change['instance_zone'] +
+                             ' to utilize this reservation for ' + count)
+            elif change['change'] == NAIVE_CHANGE_TYPE_AND_ZONE:
+                lines.append('Change reservation: ' + r_id +
+                             ' to availability zone ' +
+                             change['instance_zone'] +
+                             ' and instance type from ' +
+                             change['reservation_type'] + ' to ' +
+                             change['instance_type'] +
+                             ' to utilize this reservation for ' + count)
+            else:
+                lines.append('Change reservation: ' + r_id +
+                             ' instance type from ' +
+                             change['reservation_type'] + ' to ' +
+                             change['instance_type'] +
+                             ' to utilize this reservation for ' + count)
+
+    def write_type_changes(self, report, lines, buy):
+        lines.append('')
+        lines.append('Recommended reservation changes ------------------------------------------')
+        for suggestion in report.items('type_changes'):
+            lines.append('Change reservation ' + suggestion['reservation'].id)
+            lines.append('  current instance type: ' +
+                         suggestion['reservation_type'] + ' in ' +
+                         suggestion['reservation_zone'])
+            lines.append('  new utilization: ' +
+                         str(suggestion['utilization']) + ' of ' +
+                         str(suggestion['reserved_units']) + ' units')
+            for assignment in suggestion['assignments']:
+                lines.append('  suggest ' + str(assignment['instance_count']) +
+                             ' x ' + assignment['instance_type'] + ' in ' +
+                             assignment['instance_zone'])
+                if not assignment['same_zone']:
+                    lines.append('    plus change zone from: ' +
+                                 suggestion['reservation_zone'] + ' to ' +
+                                 assignment['instance_zone'])
+                lines.append('    instances: ')
+                for instance in assignment['instances']:
+                    lines.append('      ' + self.describe(instance))
+            self.check(lines)
+
+    def write_suggested_reservations(self, report, lines, buy):
+        lines.append('')
+        lines.append('Recommended reserved instances ------------------------------------')
+        # Every instance of a class shares its offering rows, so their text
+        # is only rendered once.
+        blocks = {}
+        for instance, rows in report.items('suggested_reservations'):
+            lines.append('  ')
+            lines.append('For instance-id: ' + instance.id + ' ' +
+                         self.describe(instance))
+            block = blocks.get(id(rows))
+            if block is None:
+                block = []
+                for i, row in enumerate(rows):
+                    block += self.offering_lines(i, row)
+                block = '\n'.join(block)
+                blocks[id(rows)] = block
+            if block:
+                lines.append(block)
+            if buy:
+                self.flush(lines)
+                buy(rows)
+            else:
+                self.check(lines)
+
+    def write_summary(self, report, lines, buy):
+        for row in report.items('summary'):
+            lines.append('')
+            lines.append('Total upfront:  ' +
+                         format_currency(row['total_upfront']))
+
+    def check(self, lines):
+        if len(lines) >= TEXT_CHUNK_LINES:
+            self.flush(lines)
+
+    def flush(self, lines):
+        if lines:
+            lines.append('')
+            self.stream.write('\n'.join(lines))
+            self.stream.flush()
+            del lines[:]
+
+    def describe(self, instance):
+        groups = self.descriptions.get(instance.groups)
+        if groups is None:
+            groups = ' security-groups: ' + str(list(instance.groups)) + ' '
+            self.descriptions[instance.groups] = groups
+        return str(instance.name) + groups + (instance.vpc or 'non-vpc')
+
+    def offering_lines(self, rank, row):
+        lines = [str(rank) + ') Recommended offering:',
+                 '  instance type:             ' + row['instance_type']]
+        if row['marketplace']:
+            lines += [
+                '  savings over standard:     ' + str(row['savings']),
+                '  comparable total cost:     ' + str(row['comparable_total_cost']),
+                '  standard total cost:       ' + str(row['std_total_cost']),
+                '  effective hourly:          ' + str(row['effective_hourly']),
+                '  standard effective hourly: ' + str(row['std_effective_hourly']),
+                '  comparable upfront:        ' + str(row['comparable_upfront']),
+            ]
+        lines += [
+            '  3rd-party:                 ' + str(row['marketplace']),
+            '  zone:                      ' + row['zone'],
+            '  effective hourly:          ' + str(row['effective_hourly']),
+            '  upfront:                   ' + str(row['upfront']),
+            '  total cost:                ' + str(row['total_cost']),
+            '  years:                     ' + str(row['years']),
+            '  id:                        ' + row['offering_id'],
+            '  platform                   ' + row['platform'],
+            '  type                       ' + row['offering_type'],
+            '  amazing deal               ' + str(row['amazing_deal']),
+        ]
+        return lines
+
+
+def get_label_header(labels):
+    text = ', '.join(key.capitalize() + ': ' + str(value)
+                     for key, value in labels.items())
+    return text + ' ' + '=' * max(3, 78 - len(text))
+
+
+def get_unreserved_csv_row(instance):
+    return [instance.id, instance.type, instance.zone, instance.platform,
+            instance.name, 'security-groups:' + str(list(instance.groups)),
+            instance.vpc or 'non-vpc']
+
+
+def write_unreserved_csv(report, filename=UNRESERVED_CSV):
+    with open(filename, 'w', newline='',
+              buffering=FILE_BUFFER_BYTES) as f:
+        writer = csv.writer(f)
+        writer.writerows(get_unreserved_csv_row(instance)
+                         for instance in report.items('unreserved'))
+
+
+def get_flat_value(value):
+    if isinstance(value, list):
+        return ' '.join(str(x) for x in value)
+    return value
+
+
+class CsvWriter(object):
+    # One CSV file with a header row per section.
+
+    def __init__(self, directory='.', prefix=''):
+        self.directory = directory
+        self.prefix = prefix
+
+    def write(self, report, buy=None):
+        for section in SECTIONS:
+            rows = report.rows(section)
+            first = next(rows, None)
+            if first is None:
+                continue
+            filename = os.path.join(self.directory,
+                                    self.prefix + section + '.csv')
+            with open(filename, 'w', newline='',
+                      buffering=FILE_BUFFER_BYTES) as f:
+                writer = csv.writer(f)
+                writer.writerow(list(first))
+                writer.writerow([get_flat_value(value)
+                                 for value in first.values()])
+                writer.writerows([get_flat_value(value)
+                                  for value in row.values()] for row in rows)
+
+
+class JsonWriter(object):
+    # A single object with a list of rows per section, written row by row.
+
+    def __init__(self, filename='report.json'):
+        self.filename = filename
+
+    def write(self, report, buy=None):
+        with open(self.filename, 'w', buffering=FILE_BUFFER_BYTES) as f:
+            f.write('{')
+            for i, section in enumerate(SECTIONS):
+                f.write((', ' if i else '') + json.dumps(section) + ': [')
+                for j, row in enumerate(report.rows(section)):
+                    f.write((', ' if j else '') + json.dumps(row))
+                f.write(']')
+            f.write('}')
+
+
+class JsonLinesWriter(object):
+    # One JSON object per row, tagged with its section.
+
+    def __init__(self, filename='report.jsonl'):
+        self.filename = filename
+
+    def write(self, report, buy=None):
+        with io.open(self.filename, 'w', buffering=FILE_BUFFER_BYTES) as f:
+            for section in SECTIONS:
+                for row in report.rows(section):
+                    line = OrderedDict([('section', section)])
+                    line.update(row)
+                    f.write(json.dumps(line))
+                    f.write('\n')
+
+
+# Arrow column types of each section, in row order. Inferring them from the
+# first batch would fail on a later batch whenever a column happened to be
+# empty at first, such as the zone of regional reservations.
+INSTANCE_ARROW_COLUMNS = [
+    ('instance_id', 'string'),
+    ('instance_type', 'string'),
+    ('zone', 'string'),
+    ('platform', 'string'),
+    ('name', 'string'),
+    ('security_groups', 'list<string>'),
+    ('vpc', 'string'),
+]
+ARROW_COLUMNS = {
+    'instance_class_counts': [
+        ('count', 'int64'),
+        ('instance_type', 'string'),
+        ('zone', 'string'),
+        ('platform', 'string'),
+    ],
+    'utilized': [
+        ('reservation_id', 'string'),
+        ('reservation_type', 'string'),
+        ('reservation_zone', 'string'),
+        ('reservation_platform', 'string'),
+    ] + INSTANCE_ARROW_COLUMNS,
+    'unreserved': INSTANCE_ARROW_COLUMNS,
+    'unused_reservations': [
+        ('reservation_id', 'string'),
+        ('instance_type', 'string'),
+        ('zone', 'string'),
+        ('platform', 'string'),
+        ('unused_count', 'int64'),
+    ],
+    'coverage': [
+        ('family', 'string'),
+        ('instance_count', 'int64'),
+        ('instance_units', 'float64'),
+        ('covered_units', 'float64'),
+        ('reserved_units', 'float64'),
+        ('unused_units', 'float64'),
+        ('coverage', 'float64'),
+    ],
+    'naive_changes': [
+        ('reservation_id', 'string'),
+        ('change', 'string'),
+        ('reservation_type', 'string'),
+        ('reservation_zone', 'string'),
+        ('instance_type', 'string'),
+        ('instance_zone', 'string'),
+        ('instance_count', 'int64'),
+    ],
+    'type_changes': [
+        ('reservation_id', 'string'),
+        ('reservation_type', 'string'),
+        ('reservation_zone', 'string'),
+        ('reserved_units', 'float64'),
+        ('utilization', 'float64'),
+        ('instance_type', 'string'),
+        ('instance_zone', 'string'),
+        ('same_zone', 'bool'),
+        ('instance_count', 'int64'),
+        ('instance_ids', 'list<string>'),
+    ],
+    'suggested_reservations': [
+        ('instance_id', 'string'),
+        ('rank', 'int64'),
+        ('offering_id', 'string'),
+        ('instance_type', 'string'),
+        ('zone', 'string'),
+        ('platform', 'string'),
+        ('offering_type', 'string'),
+        ('marketplace', 'bool'),
+        ('upfront', 'float64'),
+        ('total_cost', 'float64'),
+        ('effective_hourly', 'float64'),
+        ('comparable_total_cost', 'float64'),
+        ('comparable_upfront', 'float64'),
+        ('std_total_cost', 'float64'),
+        ('std_effective_hourly', 'float64'),
+        ('savings', 'float64'),
+        ('years', 'float64'),
+        ('amazing_deal', 'bool'),
+    ],
+    'summary': [
+        ('total_upfront', 'float64'),
+        ('total_savings', 'float64'),
+    ],
+}
+
+
+def get_label_names(report):
+    # The label columns MergedReport.rows() puts before every other column,
+    # except in the summary.
+    names = OrderedDict()
+    for labels, labelled in getattr(report, 'labelled_reports', []):
+        for name in labels:
+            names[name] = True
+    return list(names)
+
+
+def get_arrow_schema(pyarrow, section, label_names=()):
+    types = {
+        'string': pyarrow.string(),
+        'int64': pyarrow.int64(),
+        'float64': pyarrow.float64(),
+        'bool': pyarrow.bool_(),
+        'list<string>': pyarrow.list_(pyarrow.string()),
+    }
+    columns = ARROW_COLUMNS[section]
+    if section != 'summary':
+        columns = [(name, 'string') for name in label_names] + columns
+    return pyarrow.schema([(name, types[arrow_type])
+                           for name, arrow_type in columns])
+
+
+class ArrowWriter(object):
+    # One Arrow IPC file per section, written in record batches of
+    # ARROW_BATCH_ROWS with the section's schema from ARROW_COLUMNS. pyarrow
+    # is only needed when this writer is used.
+
+    def __init__(self, directory='.', prefix=''):
+        self.directory = directory
+        self.prefix = prefix
+
+    def write(self, report, buy=None):
+        import pyarrow
+        import pyarrow.ipc
+        label_names = get_label_names(report)
+        for section in SECTIONS:
+            schema = get_arrow_schema(pyarrow, section, label_names)
+            filename = os.path.join(self.directory,
+                                    self.prefix + section + '.arrow')
+            with pyarrow.OSFile(filename, 'wb') as sink:
+                with pyarrow.ipc.new_file(sink, schema) as writer:
+                    for batch in iter_batches(report.rows(section),
+                                              ARROW_BATCH_ROWS):
+                        writer.write_batch(pyarrow.RecordBatch.from_pylist(
+                            batch, schema=schema))
+
+
+def iter_batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+WRITERS = {
+    'text': TextWriter,
+    'csv': CsvWriter,
+    'json': JsonWriter,
+    'jsonl': JsonLinesWriter,
+    'arrow': ArrowWriter,
+}
+
+
+def get_writers(names):
+    return [WRITERS[name]() for name in names]
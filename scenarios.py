@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+# What-if purchase scenarios. Each scenario picks an offering type, a term,
+# whether marketplace listings may be used, whether unused reservations are
+# modified first (see packing) and a coverage target, then buys the
+# reservations that save the most per unit until the target is met. Results
+# give the cost of running the fleet over SCENARIO_HOURS, the upfront paid
+# and the coverage reached, so scenarios can be compared side by side.
+# Scenarios are evaluated in worker processes that each receive the fleet
+# once. On-demand prices come from the AWS Price List API.
+# Usage: python scenarios.py [region] [top]
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import json
+import sys
+
+from helpers import *
+from matching import match_instances
+from packing import pack_reservations
+
+# Costs are compared over three years so one and three year terms, and
+# marketplace listings of any length, are on the same footing. Shorter terms
+# are assumed to be renewed at the same price.
+SCENARIO_HOURS = HOURS_IN_3_YEARS
+SCENARIO_CHUNK_SIZE = 8
+OFFERING_TYPES = ['No Upfront', 'Partial Upfront', 'All Upfront']
+TERMS = [1, 3]
+COVERAGE_TARGETS = [0.5, 0.55, 0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95,
+                    1.0]
+# The Price List API is only served from a few regions but prices every
+# region.
+PRICING_REGION = 'us-east-1'
+# Price List operating system and pre-installed software of each product
+# description.
+PRICING_PLATFORMS = {
+    'Linux/UNIX': ('Linux', 'NA'),
+    'SUSE Linux': ('SUSE', 'NA'),
+    'Red Hat Enterprise Linux': ('RHEL', 'NA'),
+    'Windows': ('Windows', 'NA'),
+    'Windows with SQL Server Standard': ('Windows', 'SQL Std'),
+    'Windows with SQL Server Web': ('Windows', 'SQL Web'),
+    'Windows with SQL Server Enterprise': ('Windows', 'SQL Ent'),
+}
+
+worker_plans = None
+
+
+class ClassPlan(object):
+    # What a scenario needs to know about one unreserved instance class.
+    # offerings are (offering type, term, marketplace, effective hourly,
+    # upfront, available) tuples sorted by effective hourly; available is
+    # None for Amazon's own offerings, which have no limit.
+    __slots__ = ('instance_class', 'count', 'modifiable', 'units',
+                 'on_demand', 'offerings')
+
+    def __init__(self, instance_class, count, modifiable, units, on_demand,
+                 offerings):
+        self.instance_class = instance_class
+        self.count = count
+        self.modifiable = modifiable
+        self.units = units
+        self.on_demand = on_demand
+        self.offerings = offerings
+
+
+class FleetPlan(object):
+
+    def __init__(self, total_units, covered_units, modifiable_units, classes):
+        self.total_units = total_units
+        self.covered_units = covered_units
+        self.modifiable_units = modifiable_units
+        self.classes = classes
+
+
+def get_scenarios(offering_types=OFFERING_TYPES, terms=TERMS,
+                  marketplace=(False, True), modify=(False, True),
+                  coverage_targets=COVERAGE_TARGETS):
+    return [OrderedDict([
+        ('offering_type', offering_type),
+        ('term', term),
+        ('marketplace', use_marketplace),
+        ('modify', use_modify),
+        ('coverage_target', target),
+    ]) for offering_type, term, use_marketplace, use_modify, target
+        in itertools.product(offering_types, terms, marketplace, modify,
+                             coverage_targets)]
+
+
+def get_effective_hourly(offering):
+    hours = offering['Duration'] / SECONDS_IN_HOUR
+    hourly = sum(charge['Amount'] for charge in offering['RecurringCharges']
+                 if charge['Frequency'] == 'Hourly')
+    return (offering['FixedPrice'] + hours * hourly) / hours
+
+
+def get_term(offering):
+    if offering['Duration'] / SECONDS_IN_HOUR <= HOURS_IN_YEAR:
+        return 1
+    return 3
+
+
+def get_on_demand_price(client, region, i_type, platform):
+    # The hourly on-demand price of a shared tenancy instance, or None when
+    # the Price List has none.
+    pricing_platform = PRICING_PLATFORMS.get(
+        get_account_agnostic_platform(platform))
+    if pricing_platform is None:
+        return None
+    operating_system, software = pricing_platform
+    filters = [
+        ('regionCode', region),
+        ('instanceType', i_type),
+        ('operatingSystem', operating_system),
+        ('preInstalledSw', software),
+        ('tenancy', 'Shared'),
+        ('capacitystatus', 'Used'),
+        ('licenseModel', 'No License required'),
+    ]
+    response = client.get_products(
+        ServiceCode='AmazonEC2',
+        Filters=[{'Type': 'TERM_MATCH', 'Field': field, 'Value': value}
+                 for field, value in filters])
+    for price in response['PriceList']:
+        for term in json.loads(price)['terms'].get('OnDemand', {}).values():
+            for dimension in term['priceDimensions'].values():
+                return float(dimension['pricePerUnit']['USD'])
+    return None
+
+
+def get_on_demand_prices(client, region, instance_classes):
+    # Maps (instance type, platform) to the hourly on-demand price for every
+    # class the Price List has. client is a pricing client.
+    prices = {}
+    for i_type, zone, platform in instance_classes:
+        key = (i_type, get_account_agnostic_platform(platform))
+        if key in prices:
+            continue
+        price = get_on_demand_price(client, region, i_type, platform)
+        if price is not None:
+            prices[key] = price
+    return prices
+
+
+def get_fleet_plan(instances, reservations, offerings_by_class,
+                   on_demand_prices):
+    # Matches the fleet once so every scenario starts from the same
+    # coverage. on_demand_prices maps (instance type, platform) to the
+    # on-demand hourly price, see get_on_demand_prices. Savings are measured
+    # against it, so a class without one is an error.
+    matches, unreserved = match_instances(reservations, instances)
+    total_units = sum(instance.units or 0 for instance in instances)
+    covered_units = sum(instance.units or 0 for instance, reservation
+                        in matches)
+
+    modifiable_ids = set()
+    for suggestion in pack_reservations(get_unused_reservations(reservations),
+                                        unreserved):
+        for assignment in suggestion['assignments']:
+            modifiable_ids.update(instance.id
+                                  for instance in assignment['instances'])
+
+    counts = OrderedDict()
+    classes_to_ignore = RESERVATION_PREFERENCES['ClassesToIgnore']
+    for instance in unreserved:
+        if instance.type in classes_to_ignore or not instance.units:
+            continue
+        counts_for_class = counts.setdefault(get_instance_class(instance),
+                                             [0, 0, instance.units])
+        counts_for_class[0] += 1
+        if instance.id in modifiable_ids:
+            counts_for_class[1] += 1
+
+    classes = []
+    modifiable_units = 0
+    for instance_class, (count, modifiable, units) in counts.items():
+        modifiable_units += modifiable * units
+        on_demand = on_demand_prices.get(
+            (instance_class[0],
+             get_account_agnostic_platform(instance_class[2])))
+        if on_demand is None:
+            raise Exception('No on-demand price for ' + instance_class[0] +
+                            ' ' + instance_class[2])
+        offerings = []
+        for offering in offerings_by_class.get(instance_class) or []:
+            effective_hourly = get_effective_hourly(offering)
+            available = None
+            if offering['Marketplace']:
+                available = sum(detail.get('Count', 0) for detail
+                                in offering.get('PricingDetails', []))
+            offerings.append((offering['OfferingType'], get_term(offering),
+                              offering['Marketplace'], effective_hourly,
+                              offering['FixedPrice'], available))
+        offerings.sort(key=lambda x: x[3])
+        classes.append(ClassPlan(instance_class, count, modifiable, units,
+                                 on_demand, offerings))
+    return FleetPlan(total_units, covered_units, modifiable_units, classes)
+
+
+def init_worker(plan):
+    global worker_plans
+    worker_plans = plan
+
+
+def evaluate_scenario(scenario, plan=None):
+    # Buys the cheapest lots per unit first until the coverage target is met.
+    plan = plan or worker_plans
+    covered_units = plan.covered_units
+    if scenario['modify']:
+        covered_units += plan.modifiable_units
+    needed_units = scenario['coverage_target'] * plan.total_units - \
+        covered_units
+
+    lots = []
+    running_cost = 0.0
+    for class_plan in plan.classes:
+        count = class_plan.count
+        if scenario['modify']:
+            count -= class_plan.modifiable
+        running_cost += count * class_plan.on_demand
+        remaining = count
+        for offering_type, term, marketplace, effective_hourly, upfront, \
+                available in class_plan.offerings:
+            if remaining == 0:
+                break
+            if offering_type != scenario['offering_type'] or \
+                    term != scenario['term'] or \
+                    marketplace and not scenario['marketplace']:
+                continue
+            quantity = remaining if available is None else \
+                min(available, remaining)
+            if quantity == 0:
+                continue
+            remaining -= quantity
+            saving = (class_plan.on_demand - effective_hourly) / \
+                class_plan.units
+            lots.append((-saving, class_plan.units, quantity,
+                         class_plan.on_demand, effective_hourly, upfront))
+    lots.sort()
+
+    bought = 0
+    bought_units = 0
+    upfront_cost = 0.0
+    for negative_saving, units, quantity, on_demand, effective_hourly, \
+            upfront in lots:
+        if needed_units <= 0:
+            break
+        quantity = min(quantity, -int(-needed_units // units))
+        needed_units -= quantity * units
+        bought += quantity
+        bought_units += quantity * units
+        upfront_cost += quantity * upfront
+        running_cost += quantity * (effective_hourly - on_demand)
+
+    result = OrderedDict(scenario)
+    result['instances_bought'] = bought
+    result['upfront'] = upfront_cost
+    result['total_cost'] = running_cost * SCENARIO_HOURS
+    result['coverage'] = (covered_units + bought_units) / \
+        float(plan.total_units) if plan.total_units else 0.0
+    return result
+
+
+def simulate(plan, scenarios, processes=None):
+    # Results come back in the order of scenarios. Each result also gives
+    # its savings against buying and modifying nothing.
+    baseline = evaluate_scenario(OrderedDict([
+        ('offering_type', None),
+        ('term', None),
+        ('marketplace', False),
+        ('modify', False),
+        ('coverage_target', 0.0),
+    ]), plan)
+    with ProcessPoolExecutor(max_workers=processes, initializer=init_worker,
+                             initargs=(plan,)) as executor:
+        results = list(executor.map(evaluate_scenario, scenarios,
+                                    chunksize=SCENARIO_CHUNK_SIZE))
+    for result in results:
+        result['savings'] = baseline['total_cost'] - result['total_cost']
+    return results
+
+
+def print_results(results, top=None):
+    print('Purchase scenarios ------------------------------------------------')
+    ranked = sorted(results, key=lambda x: x['total_cost'])
+    for result in ranked[:top]:
+        print(str(result['offering_type']) + ', ' + str(result['term']) +
+              ' year' + (', marketplace' if result['marketplace'] else '') +
+              (', modify' if result['modify'] else '') + ', target ' +
+              str(result['coverage_target']))
+        print('  total cost:                ' + str(result['total_cost']))
+        print('  savings:                   ' + str(result['savings']))
+        print('  upfront:                   ' + str(result['upfront']))
+        print('  coverage:                  ' + str(result['coverage']))
+        print('  instances bought:          ' +
+              str(result['instances_bought']))
+
+
+if __name__ == '__main__':
+    region = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_REGION
+    top = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    session = get_session()
+    client = session.client('ec2', region)
+    account_type, reservations, instances, instance_class_counts = \
+        get_usage(client)
+    matches, unreserved = match_instances(reservations, instances)
+    classes = get_reservable_classes(unreserved)
+    offerings_by_class = get_class_offerings(classes, client, account_type,
+                                             get_offering_cache())
+    on_demand_prices = get_on_demand_prices(
+        session.client('pricing', PRICING_REGION), region, classes)
+    plan = get_fleet_plan(instances, reservations, offerings_by_class,
+                          on_demand_prices)
+    print_results(simulate(plan, get_scenarios()), top)
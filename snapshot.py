@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import threading
+import zipfile
+
+RECORDED_OPERATIONS = (
+    'describe_account_attributes',
+    'describe_images',
+    'describe_instances',
+    'describe_regions',
+    'describe_reserved_instances',
+    'describe_reserved_instances_offerings',
+)
+
+
+def get_call_name(operation, kwargs):
+    params = json.dumps(kwargs, sort_keys=True, default=str)
+    return operation + '/' + hashlib.sha1(params.encode('utf-8')).hexdigest() + \
+        '.json'
+
+
+class RecordingClient(object):
+    # Wraps an EC2 client and writes the response of every describe call
+    # into a deflate-compressed zip file, one member per distinct call.
+
+    def __init__(self, client, filename):
+        self.client = client
+        self.zip = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED)
+        self.recorded = set()
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        if name not in RECORDED_OPERATIONS:
+            return method
+
+        def call(**kwargs):
+            response = method(**kwargs)
+            self.record(name, kwargs, response)
+            return response
+        return call
+
+    def record(self, operation, kwargs, response):
+        response = dict(response)
+        response.pop('ResponseMetadata', None)
+        data = json.dumps(response, separators=(',', ':'), default=str)
+        name = get_call_name(operation, kwargs)
+        with self.lock:
+            if name not in self.recorded:
+                self.recorded.add(name)
+                self.zip.writestr(name, data)
+
+    def close(self):
+        self.zip.close()
+
+
+class ReplayClient(object):
+    # Answers describe calls from a file written by RecordingClient. Only
+    # the zip directory is read up front; each response is decompressed the
+    # first time it is asked for.
+
+    def __init__(self, filename):
+        self.zip = zipfile.ZipFile(filename)
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name not in RECORDED_OPERATIONS:
+            raise AttributeError(name + ' is not available when replaying')
+
+        def call(**kwargs):
+            member = get_call_name(name, kwargs)
+            try:
+                with self.lock:
+                    data = self.zip.read(member)
+            except KeyError:
+                raise Exception('No recorded response for ' + name + ' ' +
+                                json.dumps(kwargs, sort_keys=True))
+            return json.loads(data.decode('utf-8'))
+        return call
+
+    def close(self):
+        self.zip.close()
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+# Keeps the report of every run in Postgres. Each table is partitioned by
+# run, with one partition per run that is bulk loaded with COPY and can be
+# dropped on its own once the run is no longer needed. Needs Postgres 11 or
+# later for indexes on partitioned tables.
+# Usage: python store.py DSN              create the schema
+#        python store.py DSN drop RUN_ID  drop a run
+from collections import OrderedDict
+import csv
+import io
+import sys
+
+from helpers import *
+
+COPY_CHUNK_ROWS = 65536
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS runs (
+        run_id bigserial PRIMARY KEY,
+        created_at timestamptz NOT NULL DEFAULT now(),
+        account text,
+        region text,
+        total_upfront double precision,
+        total_savings double precision)''',
+    '''CREATE INDEX IF NOT EXISTS runs_account_region
+        ON runs (account, region, created_at)''',
+    # reservation_id is the reservation the instance was matched to, or null
+    # when it is unreserved.
+    '''CREATE TABLE IF NOT EXISTS instances (
+        run_id bigint NOT NULL,
+        instance_id text NOT NULL,
+        instance_type text NOT NULL,
+        family text NOT NULL,
+        units real,
+        zone text NOT NULL,
+        platform text NOT NULL,
+        vpc text,
+        name text,
+        reservation_id text) PARTITION BY LIST (run_id)''',
+    '''CREATE INDEX IF NOT EXISTS instances_family
+        ON instances (family, run_id)''',
+    '''CREATE INDEX IF NOT EXISTS instances_instance
+        ON instances (instance_id, run_id)''',
+    # zone is null for regional reservations.
+    '''CREATE TABLE IF NOT EXISTS reservations (
+        run_id bigint NOT NULL,
+        reservation_id text NOT NULL,
+        instance_type text NOT NULL,
+        family text NOT NULL,
+        units real,
+        zone text,
+        platform text NOT NULL,
+        flexible boolean NOT NULL,
+        count integer NOT NULL,
+        used_count integer NOT NULL,
+        state text NOT NULL) PARTITION BY LIST (run_id)''',
+    '''CREATE INDEX IF NOT EXISTS reservations_family
+        ON reservations (family, run_id)''',
+    '''CREATE INDEX IF NOT EXISTS reservations_unused
+        ON reservations (reservation_id, run_id) WHERE used_count < count''',
+    # Offerings are stored once per run and suggestions refer to them, as
+    # every instance of a class is suggested the same offerings.
+    '''CREATE TABLE IF NOT EXISTS offerings (
+        run_id bigint NOT NULL,
+        offering_id text NOT NULL,
+        instance_type text NOT NULL,
+        zone text,
+        platform text NOT NULL,
+        offering_type text NOT NULL,
+        marketplace boolean NOT NULL,
+        upfront double precision,
+        total_cost double precision,
+        effective_hourly double precision,
+        savings double precision,
+        years double precision,
+        amazing_deal boolean) PARTITION BY LIST (run_id)''',
+    '''CREATE INDEX IF NOT EXISTS offerings_offering
+        ON offerings (offering_id, run_id)''',
+    '''CREATE TABLE IF NOT EXISTS suggestions (
+        run_id bigint NOT NULL,
+        instance_id text NOT NULL,
+        offering_id text NOT NULL,
+        rank integer NOT NULL) PARTITION BY LIST (run_id)''',
+    '''CREATE INDEX IF NOT EXISTS suggestions_instance
+        ON suggestions (instance_id, run_id)''',
+    # Brings tables created before regional reservations were stored up to
+    # date, as CREATE TABLE IF NOT EXISTS leaves them as they were. Columns
+    # added here come last, so rows are copied by column name.
+    '''ALTER TABLE reservations
+        ADD COLUMN IF NOT EXISTS flexible boolean NOT NULL DEFAULT false''',
+    '''ALTER TABLE reservations ALTER COLUMN zone DROP NOT NULL''',
+]
+PARTITIONED_TABLES = ['instances', 'reservations', 'offerings', 'suggestions']
+# The columns of the rows each get_*_rows function yields, in order.
+COLUMNS = {
+    'instances': ['run_id', 'instance_id', 'instance_type', 'family', 'units',
+                  'zone', 'platform', 'vpc', 'name', 'reservation_id'],
+    'reservations': ['run_id', 'reservation_id', 'instance_type', 'family',
+                     'units', 'zone', 'platform', 'flexible', 'count',
+                     'used_count', 'state'],
+    'offerings': ['run_id', 'offering_id', 'instance_type', 'zone',
+                  'platform', 'offering_type', 'marketplace', 'upfront',
+                  'total_cost', 'effective_hourly', 'savings', 'years',
+                  'amazing_deal'],
+    'suggestions': ['run_id', 'instance_id', 'offering_id', 'rank'],
+}
+
+
+class SnapshotStore(object):
+
+    def __init__(self, dsn):
+        import psycopg2
+        self.db = psycopg2.connect(dsn)
+
+    def create_schema(self):
+        with self.db:
+            with self.db.cursor() as cursor:
+                for statement in SCHEMA:
+                    cursor.execute(statement)
+
+    def save(self, report, labels=None):
+        # Writes one report as a new run in a single transaction and returns
+        # its run_id.
+        labels = labels or {}
+        summary = report.items('summary')[0]
+        with self.db:
+            with self.db.cursor() as cursor:
+                cursor.execute(
+                    'INSERT INTO runs (account, region, total_upfront, '
+                    'total_savings) VALUES (%s, %s, %s, %s) RETURNING run_id',
+                    (labels.get('account'), labels.get('region'),
+                     summary['total_upfront'], summary['total_savings']))
+                run_id = cursor.fetchone()[0]
+                for table in PARTITIONED_TABLES:
+                    cursor.execute(
+                        'CREATE TABLE ' + get_partition(table, run_id) +
+                        ' PARTITION OF ' + table +
+                        ' FOR VALUES IN (' + str(int(run_id)) + ')')
+                with phase('store_copy'):
+                    copy_rows(cursor, 'instances', run_id,
+                              get_instance_rows(report, run_id))
+                    copy_rows(cursor, 'reservations', run_id,
+                              get_reservation_rows(report, run_id))
+                    copy_rows(cursor, 'offerings', run_id,
+                              get_offering_rows(report, run_id))
+                    copy_rows(cursor, 'suggestions', run_id,
+                              get_suggestion_rows(report, run_id))
+        return run_id
+
+    def drop_run(self, run_id):
+        with self.db:
+            with self.db.cursor() as cursor:
+                for table in PARTITIONED_TABLES:
+                    cursor.execute('DROP TABLE IF EXISTS ' +
+                                   get_partition(table, run_id))
+                cursor.execute('DELETE FROM runs WHERE run_id = %s',
+                               (run_id,))
+
+    def close(self):
+        self.db.close()
+
+
+class StoreWriter(object):
+    # Saves reports to a SnapshotStore like the other writers save them to
+    # files. Merged reports are saved as one run per account and region.
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+
+    def write(self, report, buy=None):
+        store = SnapshotStore(self.dsn)
+        try:
+            store.create_schema()
+            labelled_reports = getattr(report, 'labelled_reports', None) or \
+                [(report.labels, report)]
+            for labels, labelled in labelled_reports:
+                run_id = store.save(labelled, labels)
+                print('saved run ' + str(run_id))
+        finally:
+            store.close()
+
+
+def get_partition(table, run_id):
+    return table + '_' + str(int(run_id))
+
+
+def copy_rows(cursor, table, run_id, rows):
+    # Copies rows into the run's partition of table. Rows are sent as CSV,
+    # COPY_CHUNK_ROWS at a time so the buffer stays small however many rows
+    # there are. None is written as an empty unquoted field, which COPY
+    # reads as null.
+    statement = 'COPY ' + get_partition(table, run_id) + ' (' + \
+        ', '.join(COLUMNS[table]) + ') FROM STDIN WITH (FORMAT csv)'
+    while True:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        count = 0
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+            if count == COPY_CHUNK_ROWS:
+                break
+        if count == 0:
+            return
+        buffer.seek(0)
+        cursor.copy_expert(statement, buffer)
+        if count < COPY_CHUNK_ROWS:
+            return
+
+
+def get_instance_rows(report, run_id):
+    for instance, reservation in report.items('utilized'):
+        yield get_instance_row(run_id, instance, reservation.id)
+    for instance in report.items('unreserved'):
+        yield get_instance_row(run_id, instance, None)
+
+
+def get_instance_row(run_id, instance, reservation_id):
+    return (run_id, instance.id, instance.type, instance.family,
+            get_normalized_units(instance.units), instance.zone,
+            instance.platform, instance.vpc, instance.name, reservation_id)
+
+
+def get_reservation_rows(report, run_id):
+    # Every reservation is either used by an instance or unused, or both.
+    reservations = OrderedDict()
+    for instance, reservation in report.items('utilized'):
+        reservations[reservation.id] = reservation
+    for reservation in report.items('unused_reservations'):
+        reservations[reservation.id] = reservation
+    for reservation in reservations.values():
+        yield (run_id, reservation.id, reservation.type, reservation.family,
+               get_normalized_units(reservation.units), reservation.zone,
+               reservation.platform, reservation.flexible, reservation.count,
+               reservation.used_count, reservation.state)
+
+
+def get_offering_rows(report, run_id):
+    seen = set()
+    for instance, rows in report.items('suggested_reservations'):
+        for row in rows:
+            if row['offering_id'] in seen:
+                continue
+            seen.add(row['offering_id'])
+            yield (run_id, row['offering_id'], row['instance_type'],
+                   row['zone'], row['platform'], row['offering_type'],
+                   row['marketplace'], row['upfront'], row['total_cost'],
+                   row['effective_hourly'], row['savings'], row['years'],
+                   row['amazing_deal'])
+
+
+def get_suggestion_rows(report, run_id):
+    for instance, rows in report.items('suggested_reservations'):
+        for rank, row in enumerate(rows):
+            yield (run_id, instance.id, row['offering_id'], rank)
+
+
+if __name__ == '__main__':
+    store = SnapshotStore(sys.argv[1])
+    try:
+        if sys.argv[2:3] == ['drop']:
+            store.drop_run(int(sys.argv[3]))
+        else:
+            store.create_schema()
+    finally:
+        store.close()
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+# The modules are flat files at the top of the repository.
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
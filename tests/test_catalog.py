@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# Syncs an OfferingCatalog in a temporary file from a fake EC2 client whose
+# clock and offerings the tests control.
+from collections import Counter
+
+import pytest
+
+import catalog
+from helpers import ACCOUNT_TYPE_VPC_DEFAULT, PRODUCT_DESCRIPTIONS
+
+REGION = 'us-east-1'
+ZONE = 'us-east-1a'
+KEY = (ACCOUNT_TYPE_VPC_DEFAULT, 'm5.large', ZONE, 'Linux/UNIX')
+
+
+def make_offering(offering_id, platform, marketplace, i_type='m5.large'):
+    return {'ReservedInstancesOfferingId': offering_id,
+            'InstanceType': i_type, 'AvailabilityZone': ZONE,
+            'ProductDescription': platform, 'Duration': 31536000,
+            'OfferingType': 'Partial Upfront', 'Marketplace': marketplace,
+            'FixedPrice': 100.0, 'RecurringCharges': []}
+
+
+class FakeClient(object):
+    # Serves offerings per (product description, marketplace) partition, a
+    # few per page, and counts the partitions fetched.
+
+    def __init__(self):
+        self.partitions = {}
+        for platform in PRODUCT_DESCRIPTIONS:
+            for marketplace in (False, True):
+                self.partitions[platform, marketplace] = [
+                    make_offering('%s-%s-%d' % (platform, marketplace, i),
+                                  platform, marketplace)
+                    for i in range(5)]
+        self.fetched = Counter()
+
+    def describe_reserved_instances_offerings(self, **kwargs):
+        marketplace = kwargs['Filters'][0]['Values'] == ['true']
+        partition = (kwargs['ProductDescription'], marketplace)
+        start = int(kwargs.get('NextToken', 0))
+        if start == 0:
+            self.fetched[partition] += 1
+        end = start + kwargs['MaxResults']
+        page = {'ReservedInstancesOfferings':
+                self.partitions[partition][start:end]}
+        if end < len(self.partitions[partition]):
+            page['NextToken'] = str(end)
+        return page
+
+
+class Clock(object):
+    # Stands in for the time module in catalog.
+
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(catalog, 'time', clock)
+    monkeypatch.setattr(catalog, 'CATALOG_PAGE_SIZE', 2)
+    return clock
+
+
+@pytest.fixture
+def offering_catalog(tmp_path, clock):
+    return catalog.OfferingCatalog(str(tmp_path / 'offerings.sqlite'))
+
+
+def get_ids(offerings):
+    return [offering['ReservedInstancesOfferingId'] for offering in offerings]
+
+
+def test_only_stale_partitions_are_refetched(offering_catalog, clock):
+    client = FakeClient()
+    partition_count = len(client.partitions)
+    assert offering_catalog.sync(client, REGION) == 5 * partition_count
+    assert sorted(client.fetched) == sorted(client.partitions)
+    assert set(client.fetched.values()) == {1}
+
+    client.fetched.clear()
+    assert offering_catalog.sync(client, REGION) == 0
+    assert not client.fetched
+
+    clock.now += catalog.MARKETPLACE_SYNC_TTL + 1
+    offering_catalog.sync(client, REGION)
+    assert sorted(client.fetched) == sorted(
+        (platform, True) for platform in PRODUCT_DESCRIPTIONS)
+
+    client.fetched.clear()
+    clock.now += catalog.AMAZON_SYNC_TTL
+    offering_catalog.sync(client, REGION)
+    assert sorted(client.fetched) == sorted(client.partitions)
+
+
+def test_sync_replaces_partition(offering_catalog, clock):
+    client = FakeClient()
+    offering_catalog.sync(client, REGION)
+    assert get_ids(offering_catalog.get(KEY)) == \
+        ['Linux/UNIX-False-%d' % i for i in range(5)] + \
+        ['Linux/UNIX-True-%d' % i for i in range(5)]
+
+    client.partitions['Linux/UNIX', True] = [
+        make_offering('Linux/UNIX-True-1', 'Linux/UNIX', True),
+        make_offering('Linux/UNIX-True-new', 'Linux/UNIX', True)]
+    client.partitions['Linux/UNIX', False] = []
+    clock.now += catalog.MARKETPLACE_SYNC_TTL + 1
+    offering_catalog.sync(client, REGION)
+
+    # Amazon's offerings are not stale yet, so only the marketplace
+    # partition changes.
+    assert get_ids(offering_catalog.get(KEY)) == \
+        ['Linux/UNIX-False-%d' % i for i in range(5)] + \
+        ['Linux/UNIX-True-1', 'Linux/UNIX-True-new']
+    assert offering_catalog.connect().execute(
+        'SELECT count FROM syncs WHERE product_description = ? AND '
+        'marketplace = ?', ('Linux/UNIX', True)).fetchone() == (2,)
+
+    clock.now += catalog.AMAZON_SYNC_TTL
+    offering_catalog.sync(client, REGION)
+    assert get_ids(offering_catalog.get(KEY)) == \
+        ['Linux/UNIX-True-1', 'Linux/UNIX-True-new']
+
+
+def test_lookups_fall_back_when_not_synced(tmp_path, clock):
+    class Fallback(object):
+        def get(self, key):
+            return ['fallback']
+
+        def set(self, key, value):
+            pass
+
+    offering_catalog = catalog.OfferingCatalog(
+        str(tmp_path / 'offerings.sqlite'), fallback=Fallback())
+    assert offering_catalog.get(KEY) == ['fallback']
+    offering_catalog.sync(FakeClient(), REGION)
+    assert len(offering_catalog.get(KEY)) == 10
+    clock.now += catalog.CATALOG_MAX_AGE + 1
+    assert offering_catalog.get(KEY) == ['fallback']
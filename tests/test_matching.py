@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Checks ReservationMatcher against the scan over every reservation it
+# replaced, on generated fleets with zonal reservations only.
+import pytest
+
+import benchmark
+from helpers import get_instances, get_ris, normalize_platform
+from matching import ReservationMatcher, match_instances
+from records import InstanceRecord, ReservationRecord
+
+
+def match_reservations(instance, reservations):
+    # The first reservation of the instance's type, zone and platform that
+    # has room, as the scan before ReservationMatcher found it.
+    for reservation in reservations:
+        if reservation.count != reservation.used_count and \
+                instance.type == reservation.type and \
+                instance.zone == reservation.zone and \
+                normalize_platform(instance.platform) == \
+                normalize_platform(reservation.platform):
+            reservation.used_count += 1
+            return reservation
+    return None
+
+
+def get_fleet(instance_count, seed):
+    client = benchmark.FakeEC2Client(benchmark.generate_fleet(
+        instance_count, reservation_count=instance_count // 4, seed=seed))
+    instances, instance_class_counts = get_instances(None, client, False)
+    return client, instances
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_same_matches_as_scan(seed):
+    client, instances = get_fleet(400, seed)
+    matches, unreserved = match_instances(get_ris(client), instances)
+
+    reservations = get_ris(client)
+    expected_matches = []
+    expected_unreserved = []
+    for instance in instances:
+        reservation = match_reservations(instance, reservations)
+        if reservation:
+            expected_matches.append((instance.id, reservation.id))
+        else:
+            expected_unreserved.append(instance.id)
+
+    assert expected_matches
+    assert [(instance.id, reservation.id)
+            for instance, reservation in matches] == expected_matches
+    assert [instance.id for instance in unreserved] == expected_unreserved
+
+
+def make_instance(iid, i_type, zone='us-east-1a'):
+    family = i_type.split('.')[0]
+    units = {'large': 16, 'xlarge': 32}[i_type.split('.')[1]]
+    return InstanceRecord(iid, i_type, family, units, zone, 'Linux/UNIX')
+
+
+def test_zonal_then_regional_then_flexible():
+    zonal = ReservationRecord('ri-zonal', 'm5.large', 'm5', 16, 'us-east-1a',
+                              'Linux/UNIX', 1, 'active')
+    regional = ReservationRecord('ri-regional', 'm5.large', 'm5', 16, None,
+                                 'Linux/UNIX', 1, 'active')
+    flexible = ReservationRecord('ri-flexible', 'm5.xlarge', 'm5', 32, None,
+                                 'Linux/UNIX', 1, 'active', flexible=True)
+    instances = [make_instance('i-1', 'm5.large'),
+                 make_instance('i-2', 'm5.large', 'us-east-1b'),
+                 make_instance('i-3', 'm5.large'),
+                 make_instance('i-4', 'm5.large'),
+                 make_instance('i-5', 'm5.large')]
+    matches, unreserved = match_instances([flexible, regional, zonal],
+                                          instances)
+    assert [(instance.id, reservation.id)
+            for instance, reservation in matches] == [
+        ('i-1', 'ri-zonal'), ('i-2', 'ri-regional'), ('i-3', 'ri-flexible'),
+        ('i-4', 'ri-flexible')]
+    assert [instance.id for instance in unreserved] == ['i-5']
+    assert flexible.used_count == 1
+
+
+def test_rematch_family_matches_like_a_fresh_match():
+    reservations = [
+        ReservationRecord('ri-flexible', 'm5.xlarge', 'm5', 32, None,
+                          'Linux/UNIX', 2, 'active', flexible=True),
+        ReservationRecord('ri-c5', 'c5.large', 'c5', 16, 'us-east-1a',
+                          'Linux/UNIX', 1, 'active')]
+    instances = [make_instance('i-1', 'm5.xlarge'),
+                 make_instance('i-2', 'm5.large'),
+                 make_instance('i-3', 'm5.xlarge'),
+                 make_instance('i-4', 'm5.large'),
+                 make_instance('i-5', 'm5.large'),
+                 make_instance('i-6', 'c5.large')]
+    matcher = ReservationMatcher(reservations)
+    for instance in instances:
+        matcher.match(instance)
+    assert matcher.regional_families == {'m5'}
+
+    del instances[0]
+    matcher.rematch_family('m5', [instance for instance in instances
+                                  if instance.family == 'm5'])
+    assert [(instance.id, matcher.matched[instance.id].id)
+            for instance in instances if instance.id in matcher.matched] == [
+        ('i-2', 'ri-flexible'), ('i-3', 'ri-flexible'),
+        ('i-4', 'ri-flexible'), ('i-6', 'ri-c5')]
+    assert [instance.id for instance in matcher.get_unreserved()] == ['i-5']
+    assert reservations[0].used_units == 64
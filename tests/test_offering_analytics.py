@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# Checks the columnar analyze_offerings_by_class against analyze_offerings
+# run on each class by itself.
+import copy
+import random
+
+import pytest
+
+from helpers import analyze_offerings
+from offering_analytics import analyze_offerings_by_class
+
+YEAR = 31536000
+OFFERING_TYPES = ['Partial Upfront', 'All Upfront', 'No Upfront']
+
+
+def make_offerings(rand):
+    # Standard 1 and 3 year offerings of every type, then marketplace
+    # offerings of any length, including old-style types without a standard
+    # offering to compare with.
+    offerings = []
+    for duration in (YEAR, 3 * YEAR):
+        for offering_type in OFFERING_TYPES:
+            offerings.append({
+                'ReservedInstancesOfferingId': 'std-' + str(len(offerings)),
+                'Duration': duration,
+                'FixedPrice': rand.choice([0.0, rand.uniform(100, 2000)]),
+                'RecurringCharges': rand.choice([[], [{
+                    'Frequency': 'Hourly',
+                    'Amount': rand.uniform(0, 0.2)}]]),
+                'Marketplace': False,
+                'OfferingType': offering_type,
+            })
+    for i in range(rand.randint(0, 30)):
+        offerings.append({
+            'ReservedInstancesOfferingId': 'mkt-' + str(len(offerings)),
+            'Duration': YEAR // 12 * rand.randint(1, 35),
+            'FixedPrice': rand.uniform(0.01, 3000),
+            'RecurringCharges': [{'Frequency': 'Hourly',
+                                  'Amount': rand.uniform(0, 0.2)}],
+            'Marketplace': True,
+            'OfferingType': rand.choice(['Partial Upfront', 'All Upfront',
+                                         'Heavy Utilization']),
+        })
+    return offerings
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_same_ranking_as_analyze_offerings(seed, capsys):
+    rand = random.Random(seed)
+    offerings_by_class = dict(
+        (('m5.large', 'zone-' + str(i), 'Linux/UNIX'), make_offerings(rand))
+        for i in range(40))
+
+    expected = dict((instance_class, analyze_offerings(offerings))
+                    for instance_class, offerings in
+                    copy.deepcopy(offerings_by_class).items())
+    expected_output = capsys.readouterr().out
+    analyzed = analyze_offerings_by_class(offerings_by_class)
+
+    assert capsys.readouterr().out == expected_output
+    assert any(len(ranked) > 1 for ranked in expected.values())
+    assert list(analyzed) == list(expected)
+    for instance_class in expected:
+        assert analyzed[instance_class] == expected[instance_class]
+
+
+def test_no_offerings():
+    assert analyze_offerings_by_class({}) == {}
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# Checks pack_reservations on fixed fleets against the single class
+# suggestions it replaced and against an exhaustive search.
+from itertools import product
+import random
+
+import pytest
+
+from helpers import UNIT_SCALE, get_normalization, get_scaled_units, \
+    get_units
+from packing import pack_exact, pack_greedy, pack_reservations
+from records import InstanceRecord, ReservationRecord
+
+FAMILIES = ['m5', 'c5']
+SIZES = ['medium', 'large', 'xlarge', '2xlarge']
+ZONES = ['us-east-1a', 'us-east-1b']
+
+
+def make_instance(iid, i_type, zone, platform='Linux/UNIX'):
+    return InstanceRecord(iid, i_type, get_normalization(i_type)[0],
+                          get_scaled_units(i_type), zone, platform)
+
+
+def make_reservation(rid, i_type, zone, count, platform='Linux/UNIX'):
+    reservation = ReservationRecord(rid, i_type, get_normalization(i_type)[0],
+                                    get_scaled_units(i_type), zone, platform,
+                                    count, 'active')
+    reservation.unused_count = count
+    return reservation
+
+
+def make_fleet(seed, instance_count=12):
+    rand = random.Random(seed)
+    return [make_instance('i-%d' % i,
+                          rand.choice(FAMILIES) + '.' + rand.choice(SIZES),
+                          rand.choice(ZONES))
+            for i in range(instance_count)]
+
+
+def old_pack_reservations(reservations, instances):
+    # The suggestions before packing: a whole reservation moved onto the
+    # instances of one (type, zone) class of its family, kept when they use
+    # it within 25%.
+    ins_by_class = {}
+    for instance in instances:
+        ins_by_class.setdefault((instance.type, instance.zone),
+                                []).append(instance)
+    suggestions = []
+    for reservation in reservations:
+        re_units = get_units(reservation.type) * reservation.count
+        for (ins_type, ins_zone), members in ins_by_class.items():
+            if ins_type.split('.')[0] != reservation.family:
+                continue
+            ins_units = len(members) * get_units(ins_type)
+            utilization = float(ins_units) / re_units
+            if abs(1.0 - utilization) < 0.25:
+                suggestions.append((reservation, ins_units, utilization))
+    return suggestions
+
+
+def best_cover(reservation, instances):
+    # Exhaustive search for the most units of the reservation's family the
+    # instances can fill without going over.
+    capacity = reservation.units * reservation.unused_count
+    units = [instance.units for instance in instances
+             if instance.family == reservation.family]
+    best = 0
+    for chosen in product([0, 1], repeat=len(units)):
+        covered = sum(u for u, c in zip(units, chosen) if c)
+        if best < covered <= capacity:
+            best = covered
+    return best
+
+
+def get_covered_units(suggestion):
+    return sum(get_scaled_units(assignment['instance_type']) *
+               assignment['instance_count']
+               for assignment in suggestion['assignments'])
+
+
+@pytest.mark.parametrize('seed', range(6))
+@pytest.mark.parametrize('reservation_type,count', [
+    ('m5.xlarge', 3), ('m5.2xlarge', 2), ('c5.large', 5)])
+def test_single_reservation(seed, reservation_type, count):
+    instances = make_fleet(seed)
+    reservation = make_reservation('ri-1', reservation_type, ZONES[0], count)
+    suggestions = pack_reservations([reservation], instances)
+    covered = get_covered_units(suggestions[0]) if suggestions else 0
+
+    assert covered == best_cover(reservation, instances)
+    # Every single class the old suggestions fit the reservation to is
+    # covered at least as well.
+    for old, ins_units, utilization in old_pack_reservations([reservation],
+                                                             instances):
+        if utilization <= 1:
+            assert covered >= ins_units * UNIT_SCALE
+    for suggestion in suggestions:
+        for assignment in suggestion['assignments']:
+            assert len(assignment['instances']) == \
+                assignment['instance_count']
+            for instance in assignment['instances']:
+                assert instance.family == reservation.family
+                assert (instance.type, instance.zone) == \
+                    (assignment['instance_type'], assignment['instance_zone'])
+
+
+def test_reservations_share_instances_once():
+    instances = make_fleet(0, 40) + [
+        make_instance('i-windows-%d' % i, 'm5.large', ZONES[i % 2], 'Windows')
+        for i in range(4)]
+    reservations = [
+        make_reservation('ri-1', 'm5.2xlarge', ZONES[0], 2),
+        make_reservation('ri-2', 'm5.large', ZONES[1], 3),
+        make_reservation('ri-3', 'c5.xlarge', ZONES[0], 4),
+        make_reservation('ri-4', 'm5.xlarge', ZONES[1], 1, 'Windows'),
+        make_reservation('ri-5', 'm5.large', ZONES[1], 3, 'Windows')]
+    suggestions = pack_reservations(reservations, instances)
+
+    seen = set()
+    for suggestion in suggestions:
+        reservation = suggestion['reservation']
+        assert get_covered_units(suggestion) <= \
+            reservation.units * reservation.unused_count
+        for assignment in suggestion['assignments']:
+            for instance in assignment['instances']:
+                assert instance.id not in seen
+                seen.add(instance.id)
+                assert instance.platform == reservation.platform
+                if reservation.platform == 'Windows':
+                    # Only Linux/UNIX reservations can change size.
+                    assert instance.type == reservation.type
+                else:
+                    assert instance.family == reservation.family
+    assert [s['reservation'].id for s in suggestions
+            if s['reservation'].platform == 'Windows'] == ['ri-5']
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_pack_exact_is_optimal(seed):
+    rand = random.Random(seed)
+    items = [(i, rand.choice([2, 3, 4, 8, 16]), rand.randint(0, 4))
+             for i in range(rand.randint(1, 4))]
+    capacity = rand.randint(1, 60)
+    best = 0
+    for counts in product(*[range(available + 1)
+                            for cls, units, available in items]):
+        covered = sum(units * count for (cls, units, available), count
+                      in zip(items, counts))
+        if best < covered <= capacity:
+            best = covered
+
+    exact = pack_exact(items, capacity)
+    greedy = pack_greedy(items, capacity)
+    for counts in exact, greedy:
+        assert all(0 <= count <= available for (cls, units, available), count
+                   in zip(items, counts))
+    covered = sum(units * count for (cls, units, available), count
+                  in zip(items, exact))
+    assert covered == best
+    assert sum(units * count for (cls, units, available), count
+               in zip(items, greedy)) <= best
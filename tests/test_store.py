@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Saves reports of a small generated fleet to the Postgres database named by
+# BENJAMIN_TEST_DSN. Skipped when it is not set. Every run saved is dropped
+# again, but the schema is left in place.
+import os
+
+import pytest
+
+import benchmark
+import benjamin
+import store
+
+DSN = os.environ.get('BENJAMIN_TEST_DSN')
+
+pytestmark = pytest.mark.skipif(not DSN, reason='BENJAMIN_TEST_DSN not set')
+
+
+@pytest.fixture(scope='module')
+def report():
+    client = benchmark.FakeEC2Client(benchmark.generate_fleet(300))
+    account_type, reservations, instances, instance_class_counts, \
+        offerings_by_class = benjamin.collect_region(
+            client, persist_image_names=False)
+    return benjamin.get_report(reservations, instances, instance_class_counts,
+                               client, account_type, offerings_by_class)
+
+
+@pytest.fixture
+def snapshot_store():
+    snapshot_store = store.SnapshotStore(DSN)
+    snapshot_store.create_schema()
+    snapshot_store.run_ids = []
+    yield snapshot_store
+    for run_id in snapshot_store.run_ids:
+        snapshot_store.drop_run(run_id)
+    snapshot_store.close()
+
+
+def save(snapshot_store, report):
+    run_id = snapshot_store.save(report, {'account': 'test',
+                                          'region': 'us-east-1'})
+    snapshot_store.run_ids.append(run_id)
+    return run_id
+
+
+def query(snapshot_store, statement, values=()):
+    with snapshot_store.db:
+        with snapshot_store.db.cursor() as cursor:
+            cursor.execute(statement, values)
+            return cursor.fetchall()
+
+
+def get_partitions(snapshot_store, run_id):
+    return sorted(row[0] for row in query(
+        snapshot_store,
+        'SELECT child.relname FROM pg_inherits '
+        'JOIN pg_class child ON child.oid = inhrelid '
+        'JOIN pg_class parent ON parent.oid = inhparent '
+        'WHERE parent.relname = ANY(%s) AND child.relname LIKE %s',
+        (store.PARTITIONED_TABLES, '%\\_' + str(run_id))))
+
+
+def get_expected_rows(report, run_id):
+    return {
+        'instances': list(store.get_instance_rows(report, run_id)),
+        'reservations': list(store.get_reservation_rows(report, run_id)),
+        'offerings': list(store.get_offering_rows(report, run_id)),
+        'suggestions': list(store.get_suggestion_rows(report, run_id)),
+    }
+
+
+def test_save_creates_a_partition_per_table(snapshot_store, report):
+    run_id = save(snapshot_store, report)
+    assert get_partitions(snapshot_store, run_id) == sorted(
+        store.get_partition(table, run_id)
+        for table in store.PARTITIONED_TABLES)
+    assert query(snapshot_store,
+                 'SELECT account, region FROM runs WHERE run_id = %s',
+                 (run_id,)) == [('test', 'us-east-1')]
+
+
+# 7 splits every table into several chunks, the instance count makes the
+# last instance chunk exactly full.
+@pytest.mark.parametrize('chunk_rows', [7, 'instances'])
+def test_save_copies_every_row(snapshot_store, report, monkeypatch,
+                               chunk_rows):
+    if chunk_rows == 'instances':
+        chunk_rows = len(list(store.get_instance_rows(report, 0)))
+    monkeypatch.setattr(store, 'COPY_CHUNK_ROWS', chunk_rows)
+    run_id = save(snapshot_store, report)
+    for table, rows in get_expected_rows(report, run_id).items():
+        assert rows
+        stored = query(snapshot_store,
+                       'SELECT ' + ', '.join(store.COLUMNS[table]) +
+                       ' FROM ' + store.get_partition(table, run_id))
+        assert sorted(stored, key=repr) == sorted(rows, key=repr)
+
+
+def test_drop_run(snapshot_store, report):
+    kept = save(snapshot_store, report)
+    dropped = save(snapshot_store, report)
+    snapshot_store.drop_run(dropped)
+    snapshot_store.run_ids.remove(dropped)
+    assert get_partitions(snapshot_store, dropped) == []
+    assert query(snapshot_store, 'SELECT count(*) FROM runs '
+                 'WHERE run_id = %s', (dropped,)) == [(0,)]
+    assert len(get_partitions(snapshot_store, kept)) == \
+        len(store.PARTITIONED_TABLES)
+    assert query(snapshot_store, 'SELECT count(*) FROM instances '
+                 'WHERE run_id = %s', (dropped,)) == [(0,)]
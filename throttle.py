@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+# Paces EC2 calls so parallel collection stays under the account's request
+# limits instead of collapsing into retry storms. Each API action gets a
+# token bucket that starts at EC2's documented rate and a concurrency limit.
+# Both grow additively while calls succeed and shrink by 30% when EC2
+# throttles (AIMD), so they settle near the highest rate the account is
+# allowed.
+# Throttled calls are retried after a jittered exponential backoff. Calls
+# that only read, such as describe calls, are also retried after server and
+# connection errors. Other calls are not, as the error may come from a call
+# EC2 carried out and retrying a purchase could buy twice. botocore's own
+# retries are turned off, as they would stack with these, skip the limiters
+# and retry purchases after server and connection errors.
+# Limiters are shared by every client of a session and region, across
+# threads and the thread pool the async collector runs calls on.
+import random
+import threading
+import time
+
+from metrics import METERED_PREFIXES, THROTTLE_CODES, add_retry, \
+    get_error_code
+
+# (refill per second, bucket size) per kind of action, as EC2 documents for
+# non-mutating and mutating actions.
+ACTION_RATES = {
+    'describe_': (20.0, 100),
+    'purchase_': (5.0, 50),
+    'modify_': (5.0, 50),
+}
+MIN_RATE = 1.0
+MAX_RATE_FACTOR = 10.0
+INITIAL_CONCURRENCY = 8
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 64
+DECREASE_FACTOR = 0.7
+# Throttles from calls that were already in flight when the limit was cut
+# belong to the same congestion event and do not cut it again.
+DECREASE_INTERVAL = 1.0
+MAX_ATTEMPTS = 8
+RETRY_BASE = 0.1
+RETRY_CAP = 20.0
+# botocore retry settings for a single attempt per call.
+NO_RETRIES = {'max_attempts': 0}
+# Operations that only read and can be repeated after any error.
+IDEMPOTENT_PREFIXES = ('describe_', 'get_', 'list_', 'lookup_')
+
+
+class ActionLimiter(object):
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.max_rate = rate * MAX_RATE_FACTOR
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.limit = float(INITIAL_CONCURRENCY)
+        self.in_flight = 0
+        self.decreased = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+        while True:
+            with self.condition:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def release(self, throttled=False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.decrease()
+            else:
+                # About one more call, and one more call per second, for
+                # each round of successful calls.
+                self.limit = min(MAX_CONCURRENCY,
+                                 self.limit + 1.0 / self.limit)
+                self.rate = min(self.max_rate, self.rate + 1.0 / self.rate)
+            self.condition.notify_all()
+
+    def decrease(self):
+        now = time.monotonic()
+        if now - self.decreased < DECREASE_INTERVAL:
+            return
+        self.decreased = now
+        self.limit = max(MIN_CONCURRENCY, self.limit * DECREASE_FACTOR)
+        self.rate = max(MIN_RATE, self.rate * DECREASE_FACTOR)
+        # Empty the bucket so every caller pauses before trying again.
+        self.tokens = min(self.tokens, 0.0)
+
+
+class RateLimiters(object):
+    # One ActionLimiter per (region, operation), created on first use.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.limiters = {}
+
+    def get(self, region, operation):
+        key = (region, operation)
+        with self.lock:
+            limiter = self.limiters.get(key)
+            if limiter is None:
+                rate, burst = get_action_rate(operation)
+                limiter = ActionLimiter(rate, burst)
+                self.limiters[key] = limiter
+            return limiter
+
+
+def get_action_rate(operation):
+    for prefix, rate in ACTION_RATES.items():
+        if operation.startswith(prefix):
+            return rate
+    return ACTION_RATES['describe_']
+
+
+def get_backoff(attempt):
+    # Full jitter, so retries from many threads spread out.
+    return random.uniform(0, min(RETRY_CAP, RETRY_BASE * 2 ** attempt))
+
+
+def is_transient(error):
+    # A server error, or a connection that failed or timed out.
+    response = getattr(error, 'response', None)
+    if response is not None:
+        status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        return status is not None and status >= 500
+    try:
+        from botocore.exceptions import ConnectionError, HTTPClientError
+    except ImportError:
+        return False
+    return isinstance(error, (ConnectionError, HTTPClientError))
+
+
+class ThrottledClient(object):
+    # Wraps a client so every API call waits for its action's limiter and is
+    # retried when throttled, or after a transient error when it only reads.
+    # As botocore no longer retries, this covers
+    # every operation of the client, not just EC2's describe, purchase and
+    # modify calls.
+
+    def __init__(self, client, limiters, region=None):
+        self.client = client
+        self.limiters = limiters
+        self.region = region
+        meta = getattr(client, 'meta', None)
+        self.operations = getattr(meta, 'method_to_api_mapping', None)
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        if not self.is_operation(name):
+            return method
+        limiter = self.limiters.get(self.region, name)
+
+        def call(**kwargs):
+            attempt = 0
+            while True:
+                limiter.acquire()
+                try:
+                    response = method(**kwargs)
+                except Exception as e:
+                    throttled = get_error_code(e) in THROTTLE_CODES
+                    limiter.release(throttled)
+                    attempt += 1
+                    retry = throttled or (
+                        name.startswith(IDEMPOTENT_PREFIXES) and
+                        is_transient(e))
+                    if not retry or attempt == MAX_ATTEMPTS:
+                        raise
+                    add_retry(name)
+                    time.sleep(get_backoff(attempt))
+                    continue
+                limiter.release()
+                return response
+        return call
+
+    def is_operation(self, name):
+        # Clients without botocore's metadata, such as the fakes in
+        # benchmark.py, only have their EC2 calls throttled.
+        if self.operations is None:
+            return name.startswith(METERED_PREFIXES)
+        return name in self.operations
+
+
+class ThrottledSession(object):
+    # A session whose clients are all ThrottledClients sharing limiters.
+
+    def __init__(self, session, limiters=None):
+        self.session = session
+        self.limiters = limiters or RateLimiters()
+
+    def wrap(self, wrapper):
+        # The same throttling over wrapper(session), sharing the limiters.
+        return ThrottledSession(wrapper(self.session), self.limiters)
+
+    def client(self, service_name, region_name=None, config=None, **kwargs):
+        return ThrottledClient(self.session.client(
+            service_name, region_name, config=get_client_config(config),
+            **kwargs), self.limiters, region_name)
+
+
+def get_client_config(config=None, **kwargs):
+    # A botocore Config with its retries off, see NO_RETRIES.
+    from botocore.config import Config
+    no_retries = Config(retries=NO_RETRIES, **kwargs)
+    return config.merge(no_retries) if config else no_retries
+
+
+shared_limiters = RateLimiters()